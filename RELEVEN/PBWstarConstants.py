@@ -1,12 +1,24 @@
+import json
+import os
 import pbw
 import re
 import RELEVEN.PBWSources
+from RELEVEN.assertion_index import AssertionIndex
+from RELEVEN.update_buffer import UpdateBuffer, runs_sparql, write_triples
+from hashlib import sha1
 import sys
+from contextlib import contextmanager
 from datetime import datetime
+from functools import cached_property
 from os.path import join, dirname, basename
-from rdflib import Graph, URIRef, Literal, Namespace, OWL, RDF, RDFS, XSD
+from types import MappingProxyType
+from rdflib import Graph, URIRef, Literal, Namespace, Variable, OWL, RDF, RDFS, XSD
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.algebra import reorderTriples, traverse
+from rdflib.plugins.sparql.parserutils import CompValue
 from rdflib.query import Result
-from uuid import uuid4
+from rdflib.util import from_n3
+from uuid import uuid4, uuid5, NAMESPACE_URL
 from warnings import warn
 
 
@@ -15,17 +27,187 @@ from warnings import warn
 # class requires an RDFlib graph or remote datastore in order to do the initialisation steps.
 
 
+# Matches the things in a SPARQL string that might contain a question mark without it being a variable
+# (string literals and IRIs), as well as the variables themselves, so that we can work on the variables
+# in a single pass without touching the content of literals.
+_sparql_token = re.compile(r'("""(?:[^"\\]|\\.|"(?!""))*"""|"(?:[^"\\\n]|\\.)*"|<[^<>"\s]*>)|\?(\w+)')
+
+
+def _query_variables(sparql):
+    """Return the variable names in the given SPARQL string, in order of appearance."""
+    return [m.group(2) for m in _sparql_token.finditer(sparql) if m.group(2) is not None]
+
+
+def _rename_variables(sparql, prefix):
+    """Put the given prefix on each variable name in the SPARQL string."""
+    return _sparql_token.sub(lambda m: m.group(1) or f"?{prefix}{m.group(2)}", sparql)
+
+
+def _split_renamed_variable(name):
+    """Undo _rename_variables for a batch prefix, returning the pattern index and original variable name,
+    or None if the name is not one that the prefix was put on"""
+    m = re.match(r'b(\d+)_(\w+)$', name)
+    if m is None:
+        return None
+    return int(m.group(1)), m.group(2)
+
+
+def _substitute_variables(sparql, bindings, nsm=None):
+    """Replace each variable in the SPARQL string with the n3 representation of its binding."""
+    return _sparql_token.sub(lambda m: m.group(1) or bindings[m.group(2)].n3(nsm), sparql)
+
+
+# Tokens of the Turtle-like triple patterns that we build for ensure_entities_existence. Prefixed names
+# may contain dots, but not at the end, where the dot ends the triple.
+_pattern_token = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+    |(?P<literal>(?:"""(?:[^"\\]|\\.|"(?!""))*"""|"(?:[^"\\\n]|\\.)*")
+        (?:@[A-Za-z0-9-]+|\^\^(?:<[^<>"\s]*>|[A-Za-z][\w-]*:[\w-]*))?)
+    |(?P<iri><[^<>"\s]*>)
+    |(?P<var>\?\w+)
+    |(?P<pname>[A-Za-z][\w-]*:(?:[\w-]|\.(?=[\w-]))*)
+    |(?P<punct>[;,.])
+    |(?P<word>[\w+-]+)
+''', re.X)
+
+
+def _pattern_triples(sparql, nsmap):
+    """Parse a SPARQL triple pattern into a list of (subject, predicate, object) triples of n3 strings.
+    Prefixed names are expanded with the given prefix -> namespace dictionary, so that the same term
+    always has the same string. Raises a ValueError for anything we can't parse."""
+    tokens = []
+    pos = 0
+    while pos < len(sparql):
+        m = _pattern_token.match(sparql, pos)
+        if m is None:
+            raise ValueError(f"Cannot parse SPARQL pattern at '{sparql[pos:pos+20]}'")
+        pos = m.end()
+        kind = m.lastgroup
+        tok = m.group()
+        if kind == 'space':
+            continue
+        if kind == 'word' and tok == 'a':
+            tok = RDF.type.n3()
+        elif kind == 'pname':
+            prefix, local = tok.split(':', 1)
+            if prefix not in nsmap:
+                raise ValueError(f"Unknown prefix in SPARQL pattern: {tok}")
+            tok = URIRef(nsmap[prefix] + local).n3()
+        tokens.append(tok if kind != 'punct' else (tok,))
+
+    # Now assemble the triples from the subject; predicate object, object; predicate object . structure
+    triples = []
+    i = 0
+
+    def term():
+        nonlocal i
+        if i >= len(tokens) or isinstance(tokens[i], tuple):
+            raise ValueError(f"Malformed SPARQL pattern: {sparql}")
+        i += 1
+        return tokens[i-1]
+
+    def punct(p):
+        return i < len(tokens) and tokens[i] == (p,)
+
+    while i < len(tokens):
+        subj = term()
+        while True:
+            pred = term()
+            triples.append((subj, pred, term()))
+            while punct(','):
+                i += 1
+                triples.append((subj, pred, term()))
+            if not punct(';'):
+                break
+            while punct(';'):
+                i += 1
+            if i >= len(tokens) or punct('.'):
+                break
+        if punct('.'):
+            i += 1
+        elif i < len(tokens):
+            raise ValueError(f"Malformed SPARQL pattern: {sparql}")
+    return triples
+
+
+def _pattern_terms(sparql, nsm):
+    """Parse a SPARQL triple pattern into a list of triples of rdflib terms, with variables as Variable."""
+    return [tuple(Variable(t[1:]) if t.startswith('?') else from_n3(t, nsm=nsm) for t in triple)
+            for triple in _pattern_triples(sparql, dict(nsm.namespaces()))]
+
+
+def _bind_pattern(terms, bindings):
+    """Replace the variables in a list of term triples with their bindings, to give the triples to write."""
+    return [tuple(bindings[str(t)] if isinstance(t, Variable) else t for t in triple) for triple in terms]
+
+
+def _pattern_template(sparql, nsm):
+    """Split a SPARQL triple pattern into a template and the bindings for it. In the template, the bound
+    subjects and objects other than classes are replaced by parameter variables ?_p0, ?_p1 etc., so that
+    patterns which differ only in the entities and literals they mention share a template. Returns the
+    template's triples as n3 text, its own variables, and the parameter bindings."""
+    params = dict()
+    triples = []
+    variables = []
+    for s, p, o in _pattern_terms(sparql, nsm):
+        if not isinstance(s, Variable):
+            s = params.setdefault(s, Variable(f"_p{len(params)}"))
+        if not isinstance(o, Variable) and p != RDF.type:
+            o = params.setdefault(o, Variable(f"_p{len(params)}"))
+        triples.append(f"{s.n3()} {p.n3()} {o.n3()} .")
+        variables.extend(x for x in (s, o) if isinstance(x, Variable) and x not in variables
+                         and x not in params.values())
+    return '\n'.join(triples), variables, {v: t for t, v in params.items()}
+
+
+def _prepare_template(template, variables, params):
+    """Compile a probe query for the given pattern template. The query engine orders the triples of a
+    pattern by how many of their terms are known, and it can't know that the parameters will be bound,
+    so we redo the ordering with the parameters counted as known."""
+    query = prepareQuery(f"SELECT DISTINCT {' '.join(v.n3() for v in variables)} WHERE {{\n{template}\n}}")
+    known = {v: URIRef(f"urn:x-param:{v}") for v in params}
+    unknown = {u: v for v, u in known.items()}
+
+    def reorder(node):
+        if isinstance(node, CompValue) and node.name == 'BGP':
+            node['triples'] = [tuple(unknown.get(t, t) for t in triple)
+                               for triple in reorderTriples(tuple(known.get(t, t) for t in triple)
+                                                            for triple in node.triples)]
+    traverse(query.algebra, visitPost=reorder)
+    return query
+
+
+def _pattern_signatures(sparql, nsmap):
+    """Return a stable signature for each variable in the SPARQL pattern, derived from the bound terms
+    of the pattern rather than from its layout or (where possible) its variable names. Each variable
+    is first described by the triples it takes part in; these descriptions are then repeatedly
+    refined with the descriptions of the neighbouring variables, until every signature reflects
+    the whole connected pattern."""
+    triples = sorted(set(_pattern_triples(sparql, nsmap)))
+    variables = sorted({t for triple in triples for t in triple if t.startswith('?')})
+    signature = {v: '' for v in variables}
+    for _ in range(len(variables)):
+        refined = dict()
+        for v in variables:
+            described = sorted(' '.join('?*' if t == v else '?' + signature[t] if t in signature else t
+                                        for t in triple) for triple in triples if v in triple)
+            refined[v] = sha1('\n'.join(described).encode('utf-8')).hexdigest()
+        signature = refined
+    # Variables that are structurally indistinguishable need their names to tell them apart
+    counts = dict()
+    for v in variables:
+        counts[signature[v]] = counts.get(signature[v], 0) + 1
+    return {v[1:]: signature[v] if counts[signature[v]] == 1 else f"{signature[v]}{v}" for v in variables}
+
+
 class PBWstarConstants:
     """A class to deal with all of our constants, where the data is nicely encapsulated"""
 
-    def __init__(self, graph=None, store=None, execution=None, readonly=False):
-        self.sourcelist = RELEVEN.PBWSources.PBWSources(join(dirname(__file__), 'pbw_sources.csv'))
-
-        # These are the modern scholars who put the source information into PBW records.
-        # We need Michael, Charlotte, and Tara on the outside
-        self.mj = self.sourcelist.authorities['mj']
-        self.ta = self.sourcelist.authorities['ta']
-        self.cr = self.sourcelist.authorities['cr']
+    def __init__(self, graph=None, store=None, execution=None, readonly=False, deterministic=False,
+                 buffer_size=0, flush_persons=None, index=False, sink=None, cv_file=None):
+        # The source list, the software execution, and our external authorities are set up when they are
+        # first used; see the properties below.
+        self.execution = execution
 
         datauri = 'https://r11.eu/rdf/resource/'
         self.ns = Namespace(datauri)
@@ -54,11 +236,32 @@ class PBWstarConstants:
             self.graph = graph
             graph_exists = True
         self.readonly = readonly
+        # If we mint URIs deterministically from the content of the patterns, we don't need to check
+        # whether a pattern exists before we write it; writing it again changes nothing.
+        self.deterministic = deterministic
+        # If we are given a buffer size, our writes are collected and sent to the graph in bulk; see flush()
+        self.buffer = None
+        # If we are asked to index the assertions, most patterns can be checked without asking the graph
+        self.index = None
+        # The entity groups we know about, by class and member link; see ensure_egroup_existence
+        self.egroups = dict()
+        # The probe queries we have compiled, by their template; see _probe_prepared
+        self.prepared = dict()
+        # Documentation triples that are being held back to be written together; see collect_documentation
+        self.documentation = None
+        # The outputs of this run, if we will see the whole run, i.e. if it is a new one; see record_script_run
+        self.ledger = set() if execution is None and not readonly else None
 
         if graph_exists:
             # Bind the namespaces in our graph
             for k, v in self.namespaces.items():
                 self.graph.bind(k, v, override=True)
+            if sink is not None:
+                # Writing to a streaming sink goes through the buffer, flushing after every person by default
+                self.buffer = UpdateBuffer(self.graph, max_triples=buffer_size, flush_persons=flush_persons or 1,
+                                           sink=sink)
+            elif buffer_size and not self.readonly:
+                self.buffer = UpdateBuffer(self.graph, max_triples=buffer_size, flush_persons=flush_persons)
         else:
             warn("No graph or remote SPARQL store specified - initialising static constants only")
 
@@ -274,9 +477,29 @@ class PBWstarConstants:
             '?  XI?',
         }
 
+        # The prefixed-name strings for our classes and predicates, and for the STAR assertion classes and
+        # predicates that go with each predicate. The SPARQL we build uses these constantly, so we work
+        # them out once here.
+        self.label_strings = MappingProxyType(dict())
+        self.assertion_classes = MappingProxyType(dict())
+        self.star_predicates = MappingProxyType(dict())
 
         # Initialise our group agents and the data structures we need to start
         if graph_exists:
+            nsm = self.graph.namespace_manager
+            labels = {k: v.n3(nsm) for k, v in self.predicates.items()}
+            # Entity labels take precedence, as they did when we looked them up first
+            labels.update({k: v.n3(nsm) for k, v in self.entitylabels.items()})
+            self.label_strings = MappingProxyType(labels)
+            assertion_classes = dict()
+            star_predicates = dict()
+            for k in self.predicates:
+                nsstr, code = self._split_fqname(k)
+                assertion_classes[k] = f"star:E13_{nsstr}_{code}"
+                star_predicates[k] = (f"star:P140_{nsstr}_{code}", f"star:P141_{nsstr}_{code}")
+            self.assertion_classes = MappingProxyType(assertion_classes)
+            self.star_predicates = MappingProxyType(star_predicates)
+
             # Define our STAR model predicates
             self.star_subject = self.get_label('P140')
             self.star_object = self.get_label('P141')
@@ -288,70 +511,31 @@ class PBWstarConstants:
             # convenience
             self.label_n3 = self.entity_label.n3(self.graph.namespace_manager)
             self.link_n3 = self.entity_link.n3(self.graph.namespace_manager)
-            if not self.readonly:
-                try:
-                    print("Setting up software execution run...")
-                    # Ensure the existence of the software metadata
-                    # TODO should this be a string?
-                    whoarewe = basename(sys.argv[0])
-                    ourscript = Literal(f"https://github.com/erc-releven/PBWgraph/RELEVEN/{whoarewe}")
-                    md_query = f"""
-                    ?thisurl a {self.get_label('E42')} ;
-                        {self.get_label('P190')} {ourscript.n3()} .
-                    ?this a {self.get_label('D14')} ;
-                        {self.get_label('P1')} ?thisurl ."""
-                    res = self.ensure_entities_existence(md_query)
-                    # Create the software execution for this run, so that we can create the markers at the end
-                    if execution is not None:
-                        # If we are resuming a run, we use the same software execution entity
-                        self.swrun = URIRef(execution) if execution.startswith('http') \
-                            else self.ns[execution.lstrip('data:')]
-                    else:
-                        # If we are not resuming, we have to create the entity with the current timestamp,
-                        # assuming we have a writable store.
-                        self.swrun = self.namespaces['data'][str(uuid4())]
-                        se_query = f"""
-                        ?tstamp a {self.get_label('E52')} ;
-                            {self.get_label('P82a')} {Literal(datetime.now(), datatype=XSD.dateTimeStamp).n3()} .
-                        {self.swrun.n3()} a {self.get_label('D10')} ;
-                            {self.get_label('P4')} ?tstamp ;
-                            {self.get_label('L23')} {res['this'].n3()} ."""
-                        self.ensure_entities_existence(se_query)
-                except TypeError:
-                    print("Graph is not writable! Continuing in read-only mode")
-                    self.readonly = True
-
-            print("Setting up PBW constants...")
-            # Ensure existence of our external authorities
-            self.pbw_agent = None
-            self.viaf_agent = None
-            self.orcid_agent = None
-            self.r11_agent = None
-            f11s = [{'key': 'pbw',
-                     'title': Literal('Prosopography of the Byzantine World', 'en'),
-                     'uri': URIRef('https://pbw2016.kdl.kcl.ac.uk/')},
-                    {'key': 'viaf',
-                     'title': Literal('Virtual Internet Authority File', 'en'),
-                     'uri': URIRef('https://viaf.org/')},
-                    {'key': 'orcid',
-                     'title': Literal('ORCID', 'en'),
-                     'uri': URIRef('https://orcid.org/')},
-                    {'key': 'r11',
-                     'title': Literal('RELEVEN project', 'en'),
-                     'uri': URIRef('https://r11.eu/')}]
-            for ent in f11s:
-                f11_query = f"""
-                ?a a {self.get_label('F11')} ;
-                    {self.label_n3} {ent['title'].n3()} ;
-                    {self.link_n3} {ent['uri'].n3()} ."""
-                uris = self.ensure_entities_existence(f11_query)
-                f11_uri = uris['a']
-                # Store it in self.[key]_agent, e.g. self.pbw_agent
-                self.__setattr__(f"{ent['key']}_agent", f11_uri)
+            if index:
+                print("Indexing existing assertions...")
+                self.index = AssertionIndex(self.namespaces['star']['E13_'], self.predicates['P140'],
+                                            self.predicates['P141'], self.predicates['P14'],
+                                            self.predicates['P17'], self.predicates['P67'],
+                                            values=(self.predicates['P190'],))
+                self.index.load(self.graph)
+                print(f"Indexed {len(self.index)} assertions")
 
         # Some of these factoid types have their own controlled vocabularies.
         # Set up our structure for retaining these; we will define them when we encounter them
-        # through the accessor functions.
+        # through the accessor functions, unless they are already in the graph, in which case we read
+        # them all in the first time the vocabulary is used. The entries of each
+        # vocabulary are of the first class listed here, unless _cv_class says otherwise.
+        self.cv_classes = {
+            'Gender': ('C11',),
+            'Ethnicity': ('E74E',),
+            'Religion': ('C24',),
+            'Language': ('C29',),
+            'SocietyRole': ('C2', 'C12'),
+            'Dignity': ('C12', 'C2'),
+            'Kinship': ('C4',)
+        }
+        self.cv_file = cv_file
+        self.cv_loaded = set()
         self.cv = {
             'Gender': dict(),
             'Ethnicity': dict(),
@@ -392,6 +576,103 @@ class PBWstarConstants:
             4779: (45, 'no. 345'),
         }
     # END OF __init__
+
+    # Things we only set up when we first need them
+    @cached_property
+    def sourcelist(self):
+        return RELEVEN.PBWSources.PBWSources(join(dirname(__file__), 'pbw_sources.csv'))
+
+    # These are the modern scholars who put the source information into PBW records.
+    # We need Michael, Charlotte, and Tara on the outside
+    @property
+    def mj(self):
+        return self.sourcelist.authorities['mj']
+
+    @property
+    def ta(self):
+        return self.sourcelist.authorities['ta']
+
+    @property
+    def cr(self):
+        return self.sourcelist.authorities['cr']
+
+    @cached_property
+    def swrun(self):
+        """The software execution entity for this run. If we are not resuming a run, it is created in the graph
+        when it is first asked for, along with the metadata for this script."""
+        if self.execution is not None:
+            # If we are resuming a run, we use the same software execution entity
+            return URIRef(self.execution) if self.execution.startswith('http') \
+                else self.ns[self.execution.removeprefix('data:')]
+        if self.readonly:
+            return None
+        try:
+            print("Setting up software execution run...")
+            # Ensure the existence of the software metadata
+            # TODO should this be a string?
+            whoarewe = basename(sys.argv[0])
+            ourscript = Literal(f"https://github.com/erc-releven/PBWgraph/RELEVEN/{whoarewe}")
+            md_query = f"""
+            ?thisurl a {self.get_label('E42')} ;
+                {self.get_label('P190')} {ourscript.n3()} .
+            ?this a {self.get_label('D14')} ;
+                {self.get_label('P1')} ?thisurl ."""
+            res = self.ensure_entities_existence(md_query)
+            # We have to create the entity with the current timestamp, assuming we have a writable store.
+            swrun = self.namespaces['data'][str(uuid4())]
+            se_query = f"""
+            ?tstamp a {self.get_label('E52')} ;
+                {self.get_label('P82a')} {Literal(datetime.now(), datatype=XSD.dateTimeStamp).n3()} .
+            {swrun.n3()} a {self.get_label('D10')} ;
+                {self.get_label('P4')} ?tstamp ;
+                {self.get_label('L23')} {res['this'].n3()} ."""
+            self.ensure_entities_existence(se_query)
+            return swrun
+        except TypeError:
+            print("Graph is not writable! Continuing in read-only mode")
+            self.readonly = True
+            self.ledger = None
+            return None
+
+    @cached_property
+    def agents(self):
+        """Our external authorities, looked for (and if need be created) all together when one of them is
+        first asked for. In read-only mode the ones that aren't in the graph are None."""
+        print("Setting up PBW constants...")
+        f11s = [{'key': 'pbw',
+                 'title': Literal('Prosopography of the Byzantine World', 'en'),
+                 'uri': URIRef('https://pbw2016.kdl.kcl.ac.uk/')},
+                {'key': 'viaf',
+                 'title': Literal('Virtual Internet Authority File', 'en'),
+                 'uri': URIRef('https://viaf.org/')},
+                {'key': 'orcid',
+                 'title': Literal('ORCID', 'en'),
+                 'uri': URIRef('https://orcid.org/')},
+                {'key': 'r11',
+                 'title': Literal('RELEVEN project', 'en'),
+                 'uri': URIRef('https://r11.eu/')}]
+        f11_queries = [f"""
+            ?a a {self.get_label('F11')} ;
+                {self.label_n3} {ent['title'].n3()} ;
+                {self.link_n3} {ent['uri'].n3()} .""" for ent in f11s]
+        return {ent['key']: uris.get('a')
+                for ent, uris in zip(f11s, self.ensure_entities_existence_batch(f11_queries))}
+
+    @property
+    def pbw_agent(self):
+        return self.agents['pbw']
+
+    @property
+    def viaf_agent(self):
+        return self.agents['viaf']
+
+    @property
+    def orcid_agent(self):
+        return self.agents['orcid']
+
+    @property
+    def r11_agent(self):
+        return self.agents['r11']
     # Lookup functions
 
     def source(self, factoid):
@@ -433,10 +714,7 @@ class PBWstarConstants:
     def get_label(self, lbl):
         """Return the namespaced entity (class) or predicate string given the short name.
         We want this to throw an exception if nothing is found."""
-        try:
-            return self.entitylabels[lbl].n3(self.graph.namespace_manager)
-        except KeyError:
-            return self.predicates[lbl].n3(self.graph.namespace_manager)
+        return self.label_strings[lbl]
 
     def pbw_uri(self, resource):
         if type(resource) == pbw.Factoid:
@@ -449,14 +727,12 @@ class PBWstarConstants:
     def get_assertion_for_predicate(self, p):
         """Takes a predicate key and returns the qualified assertion class string which implies that predicate.
         This will throw an exception if no predicate is defined for the key."""
-        nsstr, code = self._split_fqname(p)
-        return f"star:E13_{nsstr}_{code}"
+        return self.assertion_classes[p]
 
     def get_starpreds_for_predicate(self, p):
         """Takes a predicate key and returns the subject and object predicates that go along with its bespoke
         STAR assertion. This will throw an exception if no predicate is defined for the key."""
-        nsstr, code = self._split_fqname(p)
-        return f"star:P140_{nsstr}_{code}", f"star:P141_{nsstr}_{code}"
+        return self.star_predicates[p]
 
     def _split_fqname(self, p):
         fqname = self.predicates[p].n3(self.graph.namespace_manager)
@@ -465,7 +741,53 @@ class PBWstarConstants:
         return nsstr, code
 
     # Accessors / creators for our controlled vocabularies
+    def load_cv(self, category):
+        """Fill the given controlled vocabulary with the entries that are already there, either from the
+        sidecar file if we have one or from the graph, with one query."""
+        if self.cv_file is not None and os.path.exists(self.cv_file) and not self.cv_loaded:
+            with open(self.cv_file, encoding='utf-8') as fh:
+                for cat, entries in json.load(fh).items():
+                    self.cv[cat].update({k: URIRef(v) for k, v in entries.items()})
+                    self.cv_loaded.add(cat)
+            print(f"Read {sum(len(x) for x in self.cv.values())} vocabulary entries from {self.cv_file}")
+        if category not in self.cv_loaded:
+            classes = self.cv_classes[category]
+            sparql = f"""
+            SELECT ?cventry ?cls ?label WHERE {{
+                VALUES ?cls {{ {' '.join(self.get_label(x) for x in classes)} }}
+                ?cventry a ?cls ;
+                    {self.label_n3} ?label .
+                FILTER(LANG(?label) = "en")
+            }}"""
+            # Take the same entry that a lookup for the label would find, if there are several
+            for row in sorted(self.graph.query(sparql), key=lambda r: r['cventry']):
+                label = str(row['label'])
+                if label not in self.cv[category] \
+                        and row['cls'] == self.entitylabels[self._cv_class(category, label)]:
+                    self.cv[category][label] = row['cventry']
+            self.cv_loaded.add(category)
+
+    def save_cv(self):
+        """Write the controlled vocabularies to the sidecar file, if we have one, for the next run to use"""
+        if self.cv_file is None:
+            return
+        tmpfile = self.cv_file + '.tmp'
+        with open(tmpfile, 'w', encoding='utf-8') as fh:
+            json.dump({category: {k: str(v) for k, v in self.cv[category].items()} for category in self.cv_loaded},
+                      fh, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.cv_file)
+
+    def _cv_class(self, category, label):
+        """Return the key of the class that an entry with the given label has in the given vocabulary"""
+        if category == 'SocietyRole' and label in self.legal_designations:
+            return 'C12'
+        if category == 'Dignity' and label in self.generic_social_roles:
+            return 'C2'
+        return self.cv_classes[category][0]
+
     def _find_or_create_cv_entry(self, category, nodeclass, label):
+        if category not in self.cv_loaded:
+            self.load_cv(category)
         # If we haven't made this label yet, do it
         if label not in self.cv[category]:
             # We have to create the node, possibly attaching it to a superclass
@@ -495,20 +817,16 @@ class PBWstarConstants:
         return self._find_or_create_cv_entry('Kinship', self.get_label('C4'), kinlabel)
 
     def get_societyrole(self, srlabel):
-        srclass = self.get_label('C2')
-        if srlabel in self.legal_designations:
-            srclass = self.get_label('C12')
+        srclass = self.get_label(self._cv_class('SocietyRole', srlabel))
         return self._find_or_create_cv_entry('SocietyRole', srclass, srlabel), srclass
 
     def get_dignity(self, dignity):
         # Dignities in PBW tend to be specific to institutions / areas;
         # make an initial selection by breaking on the 'of'
         diglabel = dignity
-        digclass = self.get_label('C12')
         if ' of the ' not in dignity:  # Don't split (yet) titles that probably don't refer to places
             diglabel = dignity.split(' of ')[0]
-        if diglabel in self.generic_social_roles:
-            digclass = self.get_label('C2')
+        digclass = self.get_label(self._cv_class('Dignity', diglabel))
         dig_uri = self._find_or_create_cv_entry('Dignity', digclass, diglabel)
         # Make sure that the URI also appears under the original label, if we shortened it
         self.cv['Dignity'][dignity] = dig_uri
@@ -519,150 +837,415 @@ class PBWstarConstants:
         return floruit in self.eleventh_century
 
     def mint_uris_for_query(self, q):
-        """Generate a URI for every variable in the given query string, and return the bindings."""
+        """Generate a URI for every variable in the given query string, and return the bindings. In
+        deterministic mode the URIs are name-based UUIDs of the pattern content, so that the same
+        pattern always gets the same URIs."""
+        if self.deterministic:
+            nsmap = dict(self.graph.namespace_manager.namespaces())
+            return {k: self.ns[str(uuid5(NAMESPACE_URL, self.ns + v))]
+                    for k, v in _pattern_signatures(q, nsmap).items()}
         minted = {}
-        for m in re.finditer(r'\?(\w+)', q):
-            var = m.group(1)
+        for var in _query_variables(q):
             if var not in minted:
                 minted[var] = self.ns[str(uuid4())]
         return minted
 
     def ensure_entities_existence(self, sparql, force_create=False):
-        # print("SPARQL is:" + sparql)
+        return self.ensure_entities_existence_batch([sparql], force_create)[0]
+
+    def ensure_entities_existence_batch(self, patterns, force_create=False):
+        """Takes a list of SPARQL patterns and ensures that each of them exists in the graph. All the patterns
+        are looked for in a single query, and all the missing ones are created in a single update. Returns a
+        list of variable bindings, one dictionary per pattern, in the order the patterns were given."""
         if force_create and self.readonly:
             raise Exception("Cannot force create triples in readonly mode!")
+        # Identical patterns should resolve to the same entities, so we only look for each one once.
+        unique = list(dict.fromkeys(patterns))
+        found = dict()
+        # With deterministic URIs we can write blindly, as long as we are allowed to write at all.
+        blind = self.deterministic and not self.readonly
         try:
-            if not force_create:
-                res = self.graph.query("SELECT DISTINCT * WHERE {" + sparql + "}")
-                if len(res):
-                    # Did we actually get a result?
-                    if not isinstance(res, Result):
-                        raise RuntimeError(f"Got unexpected result on query: {res}\nSPARQL was: {sparql}")
-                    # We should hopefully have only one row...
-                    if len(res) > 1:
-                        warn(f"More than one row returned for SPARQL expression:\n{sparql}")
-                    # In any case return the variables from the first row as a dictionary.
-                    for row in res:
-                        return row.asdict()
-
-            if self.readonly:
-                # If we got here we didn't get a result, and we can't add one.
-                return dict()
-
-            # Either force_create was specified or res had zero length.
-            new_uris = self.mint_uris_for_query(sparql)
-            q = sparql
-            # Sort the variable keys by descending length to avoid replacing subsets of variable names.
-            # Yes this is a cheap hack.
-            for k in sorted(new_uris.keys(), key=len, reverse=True):
-                q = q.replace(f'?{k}', new_uris[k].n3(self.graph.namespace_manager))
-            self.graph.update("INSERT DATA {" + q + "}")
-            return new_uris
+            if not force_create and not blind and unique:
+                # Ask the index first; a miss there is definitive, so only the patterns it can't
+                # express need to go any further.
+                remaining = list(range(len(unique)))
+                if self.index is not None:
+                    remaining = []
+                    for i, p in enumerate(unique):
+                        try:
+                            res = self.index.lookup(_pattern_terms(p, self.graph.namespace_manager))
+                        except ValueError:
+                            res = None
+                        if res is None:
+                            remaining.append(i)
+                        elif res:
+                            found[i] = res
+                # A pattern might be partly written already and partly waiting in the buffer, so we look at
+                # both together. A store that runs SPARQL itself can't see the buffer, so there we look in
+                # the buffer alone first, and write out what is still pending before we ask the store.
+                graph = self.graph
+                if remaining and self.buffer is not None and len(self.buffer):
+                    if runs_sparql(self.graph.store):
+                        found.update(self._probe_prepared(self.buffer.pending, unique, remaining))
+                        remaining = [i for i in remaining if i not in found]
+                        if remaining:
+                            self.buffer.flush()
+                    else:
+                        graph = self.buffer.overlay()
+                if remaining:
+                    # A store that runs SPARQL itself, such as the remote store or Oxigraph, does its own
+                    # query parsing, so there we send all the patterns at once
+                    if runs_sparql(graph.store):
+                        found.update(self._probe_patterns(graph, unique, remaining))
+                    else:
+                        found.update(self._probe_prepared(graph, unique, remaining))
+
+            missing = [i for i in range(len(unique)) if i not in found]
+            if missing and not self.readonly:
+                # Either force_create was specified, or we are writing blindly, or some patterns had no result.
+                # Create them all at once, as triples where we can read the pattern and as SPARQL where we can't.
+                triples = []
+                inserts = []
+                for i in missing:
+                    new_uris = self.mint_uris_for_query(unique[i])
+                    try:
+                        triples.extend(_bind_pattern(_pattern_terms(unique[i], self.graph.namespace_manager),
+                                                     new_uris))
+                    except ValueError:
+                        q = _substitute_variables(unique[i], new_uris, self.graph.namespace_manager)
+                        # Make sure the patterns are separated from each other
+                        if not q.rstrip().endswith('.'):
+                            q += ' .'
+                        inserts.append(q)
+                    found[i] = new_uris
+                self.add_all(triples)
+                if inserts:
+                    self.insert_data('\n'.join(inserts))
+            # If we are read-only, the patterns we didn't find get an empty result.
+            position = {p: i for i, p in enumerate(unique)}
+            return [found.get(position[p], dict()) for p in patterns]
         except Exception as e:
-            print(f"EXCEPTION {e}; SPARQL was {sparql}")
+            print(f"EXCEPTION {e}; SPARQL was {patterns}")
             raise e
 
+    @staticmethod
+    def _probe_patterns(graph, patterns, indices):
+        """Look for the patterns at the given indices in the given graph with a single query, and return a
+        dictionary of pattern index -> variable bindings for the patterns that were found."""
+        found = dict()
+        # Rename the variables of each pattern so that we can tell from a result row which
+        # pattern it answers, e.g. ?a1 in the third pattern becomes ?b2_a1
+        branches = ' UNION '.join(['{' + _rename_variables(patterns[i], f"b{i}_") + '}' for i in indices])
+        res = graph.query("SELECT DISTINCT * WHERE {" + branches + "}")
+        if len(res):
+            # Did we actually get a result?
+            if not isinstance(res, Result):
+                raise RuntimeError(f"Got unexpected result on query: {res}\nSPARQL was: {branches}")
+            for row in res:
+                bindings = dict()
+                i = None
+                for k, v in row.asdict().items():
+                    split = _split_renamed_variable(k)
+                    if split is None:
+                        continue
+                    i, var = split
+                    bindings[var] = v
+                if i is None:
+                    continue
+                if i in found:
+                    # We should hopefully have only one row per pattern...
+                    warn(f"More than one row returned for SPARQL expression:\n{patterns[i]}")
+                    continue
+                # In any case use the variables from the first row.
+                found[i] = bindings
+        return found
+
+    def _probe_prepared(self, graph, patterns, indices):
+        """Look for the patterns at the given indices in the given local graph, one at a time, with a query
+        compiled once for each pattern template and run with the pattern's own terms as bindings. Returns a
+        dictionary of pattern index -> variable bindings for the patterns that were found."""
+        found = dict()
+        for i in indices:
+            try:
+                template, variables, bindings = _pattern_template(patterns[i], graph.namespace_manager)
+            except ValueError:
+                template, variables = None, None
+            if not variables:
+                # Not a pattern we can make a template of, or one with nothing to find out
+                found.update(self._probe_patterns(graph, patterns, [i]))
+                continue
+            if template not in self.prepared:
+                self.prepared[template] = _prepare_template(template, variables, bindings)
+            rows = list(graph.query(self.prepared[template], initBindings=bindings))
+            if len(rows) > 1:
+                warn(f"More than one row returned for SPARQL expression:\n{patterns[i]}")
+            if rows:
+                found[i] = {str(v): rows[0][v] for v in variables}
+        return found
+
+    def assertion_counts(self):
+        """Return the number of assertions in the graph for each assertion class, from the index if we have
+        one and otherwise with a single counting query, so that the store does the work."""
+        if self.index is not None:
+            return self.index.class_counts()
+        sparql = f"""
+        SELECT ?cls (COUNT(DISTINCT ?a) AS ?ct) WHERE {{
+            ?a a ?cls ;
+                {self.star_subject} ?s .
+            FILTER(STRSTARTS(STR(?cls), "{self.namespaces['star']['E13_']}"))
+        }} GROUP BY ?cls"""
+        return {row['cls']: row['ct'].toPython() for row in self.graph.query(sparql)}
+
+    def _egroups(self, gclass, glink):
+        """Return the existing groups of the given class and member link, as a dictionary of their set of
+        members -> list of (group, set of its labels). These are read from the graph the first time they
+        are needed. The labels are kept as strings, since a store may give them back with a datatype."""
+        if (gclass, glink) not in self.egroups:
+            sparql = f"""
+            SELECT ?egroup ?label ?member WHERE {{
+                ?egroup a {self.get_label(gclass)} ;
+                    {self.get_label(glink)} ?member .
+                OPTIONAL {{ ?egroup {self.label_n3} ?label . }}
+            }}"""
+            members = dict()
+            labels = dict()
+            # We want the groups we haven't yet written as well
+            for row in self.query(sparql):
+                members.setdefault(row['egroup'], set()).add(row['member'])
+                glabels = labels.setdefault(row['egroup'], set())
+                if row['label'] is not None:
+                    glabels.add(str(row['label']))
+            groups = dict()
+            for g, mset in members.items():
+                groups.setdefault(frozenset(mset), []).append((g, labels[g]))
+            self.egroups[(gclass, glink)] = groups
+        return self.egroups[(gclass, glink)]
+
     def ensure_egroup_existence(self, gclass, glink, members, title=None):
-        # Get the URI list
-        mvalues = ', '.join([x.n3() for x in members])
+        """Find or create the group of the given class with exactly the given members, linked with the
+        given predicate. The group is labelled with the title if there is one, or else with the labels
+        of its members, and an existing group only counts if it has that label."""
+        groups = self._egroups(gclass, glink)
+        key = frozenset(members)
         # Get the group label, which is a semicolon-separated list of member labels
         if title is None:
             mnames = []
             for m in members:
-                mname = self.graph.value(m, self.entity_label)
+                mname = self.value(m, self.entity_label)
                 if mname is None:
                     warn(f"Group member {m} has no label?!")
                     mnames.append('XX ANON')
                 else:
                     mnames.append(str(mname))
-            mlabel = Literal('; '.join(mnames)).n3()
+            mlabel = Literal('; '.join(mnames))
         else:
-            mlabel = Literal(title).n3()
+            mlabel = Literal(title)
+        candidates = [g for g, labels in groups.get(key, []) if str(mlabel) in labels]
+        if candidates:
+            # Make sure there is only one egroup that fits this spec
+            if len(candidates) > 1:
+                warn(f"Multiple entity groups found with exactly the given members {mlabel}!")
+            return candidates[0]
 
-        # Look to see if a group with exactly these members exists
+        # We need to create the group and its members
+        mlist = ', '.join([x.n3() for x in members])
+        # Construct the query
         sparql = f"""
-SELECT ?egroup WHERE {{
-    {{
-        # Filter first to egroups that have our particular members
-        SELECT DISTINCT ?egroup WHERE {{
-            ?egroup a {self.get_label(gclass)} ;
-                {self.label_n3} {mlabel} ;
-                {self.get_label(glink)} {mvalues} .
-        }}
-    }}
-    #  Now make sure the group doesn't have any further members.
-    ?egroup {self.get_label(glink)} ?member .
-}}
-GROUP BY ?egroup HAVING (COUNT(?member) = {len(members)})
-"""
-        rows = [x for x in self.graph.query(sparql)]
-        if len(rows) == 0:
-            # We need to create the group and its members
-            mlist = ', '.join([x.n3() for x in members])
-            # Construct the query
-            sparql = f"""
         ?egroup {self.get_label(glink)} {mlist} ;
-            {self.label_n3} {mlabel} ;
+            {self.label_n3} {mlabel.n3()} ;
             a {self.get_label(gclass)} .
             """
-            answer = self.ensure_entities_existence(sparql, force_create=True)
-        else:
-            # Make sure there is only one egroup that fits this spec
-            if len(rows) > 1:
-                warn(f"Multiple entity groups found with exactly the given members {mlabel}!")
-            answer = rows[0]
-
-        # Either way, return the entity group
-        return answer.get('egroup')
+        answer = self.ensure_entities_existence(sparql, force_create=True)
+        egroup = answer.get('egroup')
+        if egroup is not None:
+            groups.setdefault(key, []).append((egroup, {str(mlabel)}))
+        return egroup
 
     def document(self, pbwpage, *assertions):
         """Make the E31 link between the pbwpage and whatever assertions we just pulled from it, and
         mark these assertions as having been made by this software run. Return the assertions that
         were documented."""
         # Since we don't have to mint any new URIs in this query, we can just add them normally.
+        triples = self._documentation_triples(pbwpage, assertions)
+        self.note_outputs(*assertions)
+        if self.documentation is not None:
+            self.documentation.extend(triples)
+        else:
+            self.add_all(triples)
+        return assertions
+
+    def document_many(self, documented):
+        """Document many sets of assertions in a single write. Takes a list of (pbwpage, assertions) pairs,
+        and returns the assertions that were documented."""
+        triples = []
+        for pbwpage, assertions in documented:
+            triples.extend(self._documentation_triples(pbwpage, assertions))
+        self.add_all(triples)
+        documented = [a for _, assertions in documented for a in assertions]
+        self.note_outputs(*documented)
+        return documented
+
+    @contextmanager
+    def collect_documentation(self):
+        """Hold back whatever document() is asked to write within this block, and write it all at once
+        at the end. If the block fails, what it documented is dropped, since it would be incomplete."""
+        self.documentation = []
+        try:
+            yield
+        except BaseException:
+            self.documentation = None
+            raise
+        triples = self.documentation
+        self.documentation = None
+        self.add_all(triples)
+
+    def note_outputs(self, *nodes):
+        """Take note of entities that have been marked as outputs of this run, so that they can be
+        recorded as such at the end of it"""
+        if self.ledger is not None:
+            self.ledger.update(nodes)
+
+    def _documentation_triples(self, pbwpage, assertions):
+        triples = []
         if pbwpage is not None:
-            self.graph.add((pbwpage, RDF.type, self.entitylabels['E31']))
+            triples.append((pbwpage, RDF.type, self.entitylabels['E31']))
         for a in assertions:
             if pbwpage is not None:
-                self.graph.add((pbwpage, self.predicates['P70'], a))
-            self.graph.add((a, self.predicates['L11r'], self.swrun))
-        return assertions
+                triples.append((pbwpage, self.predicates['P70'], a))
+            triples.append((a, self.predicates['L11r'], self.swrun))
+        return triples
+
+    # Reading and writing through the update buffer, if we have one
+    def _check_writable(self):
+        if self.readonly:
+            raise Exception("Cannot write to the graph in readonly mode!")
+
+    def add(self, triple):
+        """Add a triple to the graph, or to the update buffer if we are using one"""
+        self._check_writable()
+        if self.index is not None:
+            self.index.add(triple)
+        if self.buffer is not None:
+            self.buffer.add(triple)
+        else:
+            self.graph.add(triple)
+
+    def add_all(self, triples):
+        """Add the given triples to the graph in a single request, or to the update buffer"""
+        if not triples:
+            return
+        self._check_writable()
+        if self.index is not None:
+            self.index.add_all(triples)
+        if self.buffer is not None:
+            self.buffer.addN(triples)
+        else:
+            write_triples(self.graph, triples)
+
+    def insert_data(self, sparql):
+        """Insert the given triples, written as the contents of an INSERT DATA block"""
+        self._check_writable()
+        if self.index is not None:
+            try:
+                self.index.add_all(_pattern_terms(sparql, self.graph.namespace_manager))
+            except ValueError as e:
+                # If we can't follow what is being written, we can no longer trust the index
+                warn(f"Dropping the assertion index: {e}")
+                self.index = None
+        if self.buffer is not None:
+            self.buffer.insert(sparql)
+        else:
+            self.graph.update("INSERT DATA {" + sparql + "}")
+
+    def query(self, sparql):
+        """Query the graph, taking account of anything we have not yet written to it"""
+        if self.buffer is not None:
+            return self.buffer.query(sparql)
+        return self.graph.query(sparql)
+
+    def value(self, subject, predicate):
+        """Return a value for the subject and predicate, taking account of anything we have not yet written"""
+        if self.buffer is not None:
+            return self.buffer.value(subject, predicate)
+        return self.graph.value(subject, predicate)
+
+    def insert_where(self, template, where):
+        """Insert the template triples for each match of the where clause. If our writes are going to a sink
+        rather than to the graph, or have to be indexed, the matches are constructed here and written with
+        add_all()."""
+        self._check_writable()
+        if self.buffer is not None and self.buffer.sink is not None or self.index is not None:
+            # The index has to know what we write, as well
+            self.add_all(list(self.query(f"CONSTRUCT {{\n{template}\n}} WHERE {{\n{where}\n}}")))
+        else:
+            self.graph.update(f"INSERT {{\n{template}\n}} WHERE {{\n{where}\n}}")
+
+    def end_person(self):
+        """Tell the update buffer that a person is complete, so that it can flush if it is time"""
+        if self.buffer is not None:
+            self.buffer.end_person()
 
-    def record_script_run(self, responsible):
+    def _unrecorded_outputs(self, chunksize):
+        """Return the entities in our ledger that are not yet recorded as the output of any run, asking the
+        graph about them chunksize at a time"""
+        outputs = sorted(self.ledger)
+        recorded = set()
+        for i in range(0, len(outputs), chunksize):
+            sparql = f"""
+            SELECT DISTINCT ?a WHERE {{
+                VALUES ?a {{ {' '.join(x.n3() for x in outputs[i:i+chunksize])} }}
+                ?l {self.get_label('L11')} ?a .
+            }}"""
+            recorded.update(row['a'] for row in self.graph.query(sparql))
+        return [x for x in outputs if x not in recorded]
+
+    def flush(self):
+        """Write everything in the update buffer to the graph. This needs to happen before any update
+        that reads from the graph itself, e.g. an INSERT ... WHERE."""
+        if self.buffer is not None:
+            self.buffer.flush()
+
+    def record_script_run(self, responsible, chunksize=10000):
         """To be run after everything else is done. Creates the assertion record for all assertions created here,
         tying each to the factoid or person record that originated it and tying all the assertion records to the
         database creation event."""
         # Find all assertions and readings that have been marked as coming from this software run. We will add the
         # forward property to the ones that don't yet have a forward property. We can keep the reverse property
         # as a 'touched by' indicator, or we can delete it.
-        sparql_criteria = f"""
-            ?a {self.get_label('L11r')} {self.swrun.n3()} .
-        MINUS {{
-            ?l {self.get_label('L11')} ?a .
-        }}
-        """
-        res = self.graph.query(f"SELECT (COUNT(?a) AS ?act) WHERE {{ {sparql_criteria} }}")
-        num_new = 0
-        for row in res:  # there is only one row
-            num_new = row['act'].toPython()
+        self.flush()
+        outputs = None
+        if self.ledger is not None:
+            # We have kept a ledger of what this run produced, so we only need to ask about those
+            outputs = self._unrecorded_outputs(chunksize)
+            num_new = len(outputs)
+        else:
+            # We didn't see the whole run, so we have to look through the graph for what it produced
+            sparql_criteria = f"""
+                ?a {self.get_label('L11r')} {self.swrun.n3()} .
+            MINUS {{
+                ?l {self.get_label('L11')} ?a .
+            }}
+            """
+            res = self.graph.query(f"SELECT (COUNT(?a) AS ?act) WHERE {{ {sparql_criteria} }}")
+            num_new = 0
+            for row in res:  # there is only one row
+                num_new = row['act'].toPython()
         if num_new > 0:
             print(f"Recording {num_new} new assertions in the graph.")
             # Add the ending timestamp to the execution we have
             tstamp = self.graph.value(self.swrun, self.predicates['P4'])
             timenow = datetime.now()
-            self.graph.add((tstamp, self.predicates['P82b'], Literal(timenow, datatype=XSD.dateTimeStamp)))
+            self.add((tstamp, self.predicates['P82b'], Literal(timenow, datatype=XSD.dateTimeStamp)))
 
             # Add the responsible person. TODO this should have more options than just tla
-            self.graph.add((self.swrun, self.predicates['P14'], responsible))
+            self.add((self.swrun, self.predicates['P14'], responsible))
 
             # Put in the forward predicate. LATER delete the reverse predicate if we decide it's a good idea
-            sparql_update = f"""
-        INSERT {{
-            {self.swrun.n3()} {self.get_label('L11')} ?a .
-        }} WHERE {{
-            {sparql_criteria}
-        }}
-            """
-            self.graph.update(sparql_update)
+            if outputs is not None:
+                for i in range(0, num_new, chunksize):
+                    self.add_all([(self.swrun, self.predicates['L11'], a) for a in outputs[i:i+chunksize]])
+            else:
+                self.insert_where(f"{self.swrun.n3()} {self.get_label('L11')} ?a .", sparql_criteria)
+            self.flush()
         else:
             print("No new assertions created on this run.")
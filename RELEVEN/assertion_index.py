@@ -0,0 +1,212 @@
+from rdflib import RDF, Variable
+
+
+# An in-memory index of the STAR assertions in the graph. Most of the patterns the importer asks about are
+# of the form "is there an assertion of class X with subject S, object O, authority A, and perhaps source B
+# and basis C?" - the index answers those with a dictionary lookup, so that only the patterns it cannot
+# express need to go to the triple store. It is loaded once from the graph, and then kept current by
+# telling it about every triple we write.
+#
+# The subject or the object of an assertion may also be an entity that the pattern describes rather than
+# names, such as the ?appellation with a given name in an appellation pattern, or the ?gass that a pair
+# of gender assertions share. For those we keep the types of all entities, and the values of the given
+# value properties, so that we can check what the pattern says about the entity once the assertion has
+# told us which it is.
+
+
+class AssertionIndex:
+    """Keeps the class, subject, object, authority, basis, and source of each STAR assertion, looked up
+    by the (class, subject, object, authority) key or by the same with the subject or the object left
+    open; and the type and the given value properties of every other entity."""
+
+    def __init__(self, assertion_ns, subject, obj, authority, based, source, values=()):
+        # The namespace prefix that all our assertion classes start with, e.g. star:E13_
+        self.assertion_ns = str(assertion_ns)
+        self.subject = subject
+        self.object = obj
+        self.authority = authority
+        self.based = based
+        self.source = source
+        # Which of the assertion's properties are written with the assertion as the subject
+        self.forward = (RDF.type, subject, obj, authority, based)
+        # Which of the other entities' properties we keep
+        self.values = (RDF.type,) + tuple(values)
+        # node -> property -> set of values; the source is kept in the same way though it is an
+        # inverse property
+        self.nodes = dict()
+        # The same for the entities that are not assertions
+        self.entities = dict()
+        # (class, subject, object, authority) -> set of assertions, where either the subject or the
+        # object may be None
+        self.keys = dict()
+        # Keep some statistics
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(1 for n in self.nodes.values() if n.get(RDF.type))
+
+    def class_counts(self):
+        """Return the number of indexed assertions of each class"""
+        counts = dict()
+        for props in self.nodes.values():
+            for cls in props.get(RDF.type, ()):
+                counts[cls] = counts.get(cls, 0) + 1
+        return counts
+
+    def load(self, graph):
+        """Read all the assertion triples, and the entity types and values, from the given graph with a
+        single query."""
+        sparql = f"""
+        CONSTRUCT {{ ?a ?p ?v . ?src {self.source.n3()} ?a . ?e ?q ?w . }}
+        WHERE {{
+            {{
+                ?a a ?cls .
+                FILTER(STRSTARTS(STR(?cls), "{self.assertion_ns}"))
+                {{ ?a ?p ?v . VALUES ?p {{ {' '.join(x.n3() for x in self.forward)} }} }}
+                UNION {{ ?src {self.source.n3()} ?a . }}
+            }} UNION {{
+                ?e ?q ?w . VALUES ?q {{ {' '.join(x.n3() for x in self.values)} }}
+            }}
+        }}"""
+        self.add_all(graph.query(sparql))
+
+    def _is_assertion_class(self, cls):
+        return str(cls).startswith(self.assertion_ns)
+
+    def add(self, triple):
+        """Take note of a triple that has been written to the graph, if it is of interest."""
+        s, p, o = triple
+        if p == RDF.type and not self._is_assertion_class(o) or p in self.values and p != RDF.type:
+            self.entities.setdefault(s, dict()).setdefault(p, set()).add(o)
+            return
+        if p == self.source:
+            node = o
+            val = s
+        elif p in self.forward:
+            node = s
+            val = o
+        else:
+            return
+        props = self.nodes.setdefault(node, dict())
+        if val in props.get(p, ()):
+            return
+        self._unkey(node, props)
+        props.setdefault(p, set()).add(val)
+        self._key(node, props)
+
+    def add_all(self, triples):
+        for t in triples:
+            self.add(t)
+
+    def _node_keys(self, props):
+        keys = []
+        for c in props.get(RDF.type, ()):
+            for a in props.get(self.authority, ()):
+                subjects = props.get(self.subject, ())
+                objects = props.get(self.object, ())
+                keys.extend((c, s, o, a) for s in subjects for o in objects)
+                keys.extend((c, s, None, a) for s in subjects)
+                keys.extend((c, None, o, a) for o in objects)
+        return keys
+
+    def _key(self, node, props):
+        for k in self._node_keys(props):
+            self.keys.setdefault(k, set()).add(node)
+
+    def _unkey(self, node, props):
+        for k in self._node_keys(props):
+            self.keys[k].discard(node)
+
+    def lookup(self, triples):
+        """Look up a pattern, given as a list of triples of rdflib terms and variables. Returns the
+        variable bindings if the pattern is in the index, an empty dictionary if it is definitely
+        not, and None if the pattern is not one that the index can answer."""
+        wanted = dict()
+        # (assertion variable, subject or object property) -> the variable it links to
+        links = dict()
+        for s, p, o in triples:
+            if p == self.source and isinstance(o, Variable) and not isinstance(s, Variable):
+                var, val = o, s
+            elif isinstance(s, Variable) and isinstance(o, Variable) and p in (self.subject, self.object):
+                links[(s, p)] = o
+                continue
+            elif (p in self.forward or p in self.values) and isinstance(s, Variable) \
+                    and not isinstance(o, Variable):
+                var, val = s, o
+            else:
+                return None
+            wanted.setdefault(var, dict()).setdefault(p, set()).add(val)
+
+        # Sort out which of the variables are assertions and which are the entities they link to. Each
+        # assertion needs its class, its authority, and a known subject or object to be keyed on.
+        assertions = [v for v, props in wanted.items()
+                      if any(self._is_assertion_class(c) for c in props.get(RDF.type, ()))]
+        entities = set(links.values())
+        if any(var not in assertions for var, _ in links):
+            return None
+        for var in assertions:
+            props = wanted[var]
+            if not props.get(self.authority) or any(p not in self.forward and p != self.source for p in props):
+                return None
+            ends = [props.get(p) or (var, p) in links for p in (self.subject, self.object)]
+            if not all(ends) or all((var, p) in links for p in (self.subject, self.object)):
+                return None
+        for var in entities:
+            if var in assertions or any(p not in self.values for p in wanted.get(var, ())):
+                return None
+            wanted.setdefault(var, dict())
+        if any(v not in assertions and v not in entities for v in wanted):
+            # Something we could only find by asking the graph
+            return None
+
+        bindings = self._solve(assertions, wanted, links, dict())
+        if bindings is None:
+            self.misses += 1
+            return dict()
+        self.hits += 1
+        return {str(var): node for var, node in bindings.items()}
+
+    def _solve(self, assertions, wanted, links, bound):
+        """Find the first of the given assertion variables, and then the rest of them, binding the
+        entities they link to as we go. Returns the bindings, or None if there are none to be had."""
+        if not assertions:
+            return bound
+        # Take an assertion whose both ends we know, if there is one
+
+        def unknown_ends(v):
+            return sum(1 for p in (self.subject, self.object) if (v, p) in links and links[(v, p)] not in bound)
+        var = min(assertions, key=unknown_ends)
+        rest = [v for v in assertions if v != var]
+        props = wanted[var]
+        slots = dict()
+        free = None
+        for p in (self.subject, self.object):
+            target = links.get((var, p))
+            if target is None:
+                slots[p] = props[p]
+            elif target in bound:
+                slots[p] = {bound[target]}
+            else:
+                slots[p] = {None}
+                free = (p, target)
+        keys = [(c, s, o, a) for c in props[RDF.type] for a in props[self.authority]
+                for s in slots[self.subject] for o in slots[self.object]]
+        candidates = set.intersection(*[self.keys.get(k, set()) for k in keys])
+        for a in sorted(candidates):
+            if not all(v <= self.nodes[a].get(p, set()) for p, v in props.items()):
+                continue
+            options = [{var: a}]
+            if free is not None:
+                p, target = free
+                options = [{var: a, target: e} for e in sorted(self.nodes[a].get(p, ()))
+                           if self._entity_matches(e, wanted[target])]
+            for option in options:
+                found = self._solve(rest, wanted, links, {**bound, **option})
+                if found is not None:
+                    return found
+        return None
+
+    def _entity_matches(self, entity, props):
+        eprops = self.entities.get(entity, dict())
+        return all(v <= eprops.get(p, set()) for p, v in props.items())
@@ -4,6 +4,8 @@ from rdflib import Literal
 from rdflib.plugins.stores import sparqlstore
 
 def add_viewpoint_structures(c):
+    # The viewpoint update reads from the graph itself, so anything we are holding back has to be written first
+    c.flush()
     # Get all our PBW texts that have authors
     expression_sparql = f"""
     SELECT DISTINCT ?author ?expression ?label WHERE {{
@@ -31,11 +33,11 @@ def add_viewpoint_structures(c):
         print(f"Adding viewpoint structure for: {edata['label']}")
         an3 = edata['author'].n3()
         en3 = e.n3()
-        pset = c.ns[f"proposition_set/text{edata['tag']}"].n3()
+        psetnode = c.ns[f"proposition_set/text{edata['tag']}"]
+        pset = psetnode.n3()
         mbelief = c.ns[f"meaning/pbw{edata['tag']}"].n3()
         claim = c.ns[f"claim/pbw{edata['tag']}"].n3()
-        viewpoint_sparql = f"""
-    INSERT {{
+        viewpoint_template = f"""
             {pset} a {c.get_label('I4')} ;    # A set of assertions come from a single text.
                   {c.get_label('L11r')} {c.swrun.n3()} ;
                   {c.get_label('J28')} ?a .
@@ -46,7 +48,8 @@ def add_viewpoint_structures(c):
                    {c.get_label('J2')} {mbelief} ;
                    {c.get_label('P14')} {an3} .
             ?edition {c.star_src} {claim} .    # The text is the source of this argumentation.
-    }} WHERE {{
+"""
+        viewpoint_criteria = f"""
             ?a {c.star_auth} {an3} ;       # some assertion has our author as an authority
                ^{c.star_src} ?passage .    # the assertion was based on some passage... 
             ?a1 a {c.get_assertion_for_predicate('R15')} ;   # which comes from some publication... 
@@ -55,9 +58,11 @@ def add_viewpoint_structures(c):
             ?a2 a {c.get_assertion_for_predicate('R76')} ;   # which is the publication of our text expression.
                 {c.star_subject} ?edition ;
                 {c.star_object} {en3} .
-    }}
-    """
-        c.graph.update(viewpoint_sparql)
+"""
+        c.insert_where(viewpoint_template, viewpoint_criteria)
+        # The proposition set is an output of this run, if there turned out to be any assertions in it
+        if c.ledger is not None and c.value(psetnode, c.predicates['J28']) is not None:
+            c.note_outputs(psetnode)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+import argparse
+import contextlib
+import io
+import RELEVEN.PBWstarConstants
+from rdflib import Graph, Literal
+from time import perf_counter
+from warnings import catch_warnings, simplefilter
+
+# Benchmarks for the machinery of the STAR import. These run against an in-memory graph, so that they
+# need neither the PBW database nor the remote triple store; what they measure is the number of
+# requests we would be sending to the store, and the time we spend on our side preparing them.
+
+
+class CountingGraph(Graph):
+    """An in-memory graph that keeps count of the SPARQL queries and updates it is asked to run. A bulk
+    add counts as an update, since against the remote store it is one."""
+    queries = 0
+    updates = 0
+
+    def query(self, *args, **kwargs):
+        self.queries += 1
+        return super().query(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self.updates += 1
+        return super().update(*args, **kwargs)
+
+    def addN(self, *args, **kwargs):  # noqa: N802
+        self.updates += 1
+        return super().addN(*args, **kwargs)
+
+    def reset(self):
+        self.queries = 0
+        self.updates = 0
+
+
+def make_constants(graph, **kwargs):
+    """Initialise the constants without all the chatter about the source list"""
+    with catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        simplefilter('ignore')
+        return RELEVEN.PBWstarConstants.PBWstarConstants(graph=graph, **kwargs)
+
+
+def appellation_patterns(c, n):
+    """Make n distinct patterns of the sort that the importer's appellation handler makes"""
+    patterns = []
+    for i in range(n):
+        person = c.ns[f"person{i}"]
+        patterns.append(f"""
+        ?a1 {c.star_subject} {person.n3()} ;
+            {c.star_object} ?appel ;
+            a {c.get_assertion_for_predicate('P1')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        ?appel {c.get_label('P190')} {Literal(f'Name {i}', lang='grc').n3()} ;
+            a {c.get_label('E33A')} . """)
+    return patterns
+
+
+def bench_minting(n):
+    """Ensure n assertions twice over, once to create them and once as a resumed run would, with random
+    and with deterministic URI minting, and count the store requests each way."""
+    print(f"Ensuring {n} assertions, then ensuring them again:")
+    for deterministic in (False, True):
+        g = CountingGraph()
+        c = make_constants(g, deterministic=deterministic)
+        patterns = appellation_patterns(c, n)
+        for run in ('first', 'repeat'):
+            g.reset()
+            start = perf_counter()
+            for p in patterns:
+                c.ensure_entities_existence(p)
+            elapsed = perf_counter() - start
+            print(f"  {'deterministic' if deterministic else 'random':13} {run:6} run: {g.queries:5} probe queries, "
+                  f"{g.updates:5} updates, {len(g):6} triples in graph, {elapsed:.2f}s")
+
+
+def bench_buffer(n, size=1000):
+    """Ensure and document n assertions, one at a time as the importer does, with and without the update
+    buffer, and count the store requests each way."""
+    print(f"Ensuring and documenting {n} assertions:")
+    for buffer_size in (0, size):
+        g = CountingGraph()
+        c = make_constants(g, buffer_size=buffer_size)
+        patterns = appellation_patterns(c, n)
+        g.reset()
+        start = perf_counter()
+        for p in patterns:
+            res = c.ensure_entities_existence(p)
+            c.document(c.ns['doc'], res['a1'])
+        c.flush()
+        elapsed = perf_counter() - start
+        requests = g.queries + g.updates
+        print(f"  buffer size {buffer_size:5}: {g.queries:5} probe queries, {g.updates:5} updates, "
+              f"{requests:6} store requests in all, {len(g):6} triples in graph, {elapsed:.2f}s")
+
+
+def person_record_patterns(c, n):
+    """Make the patterns that the importer's gender and identifier handlers make for n persons, in the form
+    that graphimportSTAR.create_assertion_sparql gives them"""
+    patterns = []
+    for i in range(n):
+        person = c.ns[f"person{i}"]
+        patterns.append(f"""
+        ?a1 {c.star_object} {person.n3()} ;
+            {c.star_subject} ?gass ;
+            a {c.get_assertion_for_predicate('P41')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        ?a2 {c.star_object} {c.get_gender('Female' if i % 2 else 'Male').n3()} ;
+            {c.star_subject} ?gass ;
+            a {c.get_assertion_for_predicate('P42')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        """)
+        patterns.append(f"""
+        ?a1 {c.star_subject} {person.n3()} ;
+            {c.star_object} ?appellation ;
+            a {c.get_assertion_for_predicate('P1')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        ?appellation a {c.get_label('E33A')} ;
+            {c.get_label('P190')} {Literal(f'Name {i}', lang='grc').n3()} .
+        """)
+    return patterns
+
+
+def bench_index(n):
+    """Ensure the gender and identifier assertions of n persons twice over, with and without the assertion
+    index, and count the probe queries that reach the graph each way, and how many of the patterns the
+    index could answer."""
+    print(f"Ensuring the person record assertions of {n} persons, then ensuring them again:")
+    for index in (False, True):
+        g = CountingGraph()
+        c = make_constants(g, index=index)
+        patterns = person_record_patterns(c, n)
+        for run in ('first', 'repeat'):
+            g.reset()
+            if index:
+                c.index.hits = c.index.misses = 0
+            start = perf_counter()
+            for p in patterns:
+                c.ensure_entities_existence(p)
+            elapsed = perf_counter() - start
+            answered = f", index answered {c.index.hits + c.index.misses} of {len(patterns)}" if index else ""
+            print(f"  {'indexed' if index else 'unindexed':9} {run:6} run: {g.queries:5} probe queries, "
+                  f"{g.updates:5} updates, {elapsed:.2f}s{answered}")
+
+
+def _label_by_n3(c, lbl):
+    """Look up a label the way get_label used to, for comparison"""
+    try:
+        return c.entitylabels[lbl].n3(c.graph.namespace_manager)
+    except KeyError:
+        return c.predicates[lbl].n3(c.graph.namespace_manager)
+
+
+def _assertion_by_n3(c, p):
+    """Look up an assertion class the way get_assertion_for_predicate used to, for comparison"""
+    nsstr, name = c.predicates[p].n3(c.graph.namespace_manager).split(':')
+    return f"star:E13_{nsstr}_{name.split('_')[0]}"
+
+
+def bench_labels(n):
+    """Build n assertion patterns of the appellation sort, looking up the names on every call as we used to,
+    and from the precomputed tables."""
+    c = make_constants(Graph())
+    print(f"Building {n} assertion patterns:")
+    for how, label, assertion in (('per call', lambda x: _label_by_n3(c, x), lambda x: _assertion_by_n3(c, x)),
+                                  ('tables', c.get_label, c.get_assertion_for_predicate)):
+        start = perf_counter()
+        for i in range(n):
+            f"""
+        ?a1 {label('P140')} {c.ns[f"person{i}"].n3()} ;
+            {label('P141')} ?appel ;
+            a {assertion('P1')} ;
+            {label('P14')} {c.pbw_agent.n3()} .
+        ?appel {label('P190')} {Literal(f'Name {i}', lang='grc').n3()} ;
+            a {label('E33A')} . """
+        elapsed = perf_counter() - start
+        print(f"  {how:8}: {elapsed * 1e6 / n:6.1f} microseconds per pattern")
+
+
+def bench_probes(n):
+    """Look for n existing assertions in a local graph, with a query text for each pattern as we used to,
+    and with a query compiled once for the pattern template."""
+    g = Graph()
+    c = make_constants(g, deterministic=True)
+    patterns = appellation_patterns(c, n)
+    expected = c.ensure_entities_existence_batch(patterns)
+    print(f"Looking for {n} existing assertions:")
+    for how, probe in (('text', lambda i: c._probe_patterns(g, patterns, [i])),
+                       ('prepared', lambda i: c._probe_prepared(g, patterns, [i]))):
+        start = perf_counter()
+        found = [probe(i)[i] for i in range(n)]
+        elapsed = perf_counter() - start
+        assert found == expected
+        print(f"  {how:8}: {elapsed * 1e3 / n:6.2f} milliseconds per probe")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="benchmarks",
+        description="Measure the store requests and overhead of the STAR import machinery"
+    )
+    parser.add_argument('benchmark', choices=['minting', 'buffer', 'index', 'labels', 'probes'],
+                        help="Which benchmark to run")
+    parser.add_argument('-n', '--number', type=int, default=500,
+                        help="How many assertions to work with")
+    args = parser.parse_args()
+    if args.benchmark == 'minting':
+        bench_minting(args.number)
+    elif args.benchmark == 'buffer':
+        bench_buffer(args.number)
+    elif args.benchmark == 'index':
+        bench_index(args.number)
+    elif args.benchmark == 'labels':
+        bench_labels(args.number)
+    elif args.benchmark == 'probes':
+        bench_probes(args.number)
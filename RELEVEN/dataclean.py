@@ -1,13 +1,10 @@
 import pbw
 import config
 import re
+import sys
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-engine = create_engine('mysql+pymysql://' + config.dbstring)
-smaker = sessionmaker(bind=engine)
-session = smaker()
-
 srclist = {
     "Eustathios: Capture of Thessalonike": "Greek",
     "Kekaumenos": "Greek",
@@ -141,34 +138,68 @@ srclist = {
     "Ralph of Caen": "Latin"
 }
 
-languages = {}
-for lang in session.query(pbw.OrigLangAuth).all():
-    languages[lang.oLanguage] = lang.oLangKey
 
-for factoid in session.query(pbw.Factoid).all():
-    if factoid.source == "Seals":
-        continue
-    explang = srclist.get(factoid.source)
-    if explang == "":
-        explang = "(Unspecified)"
-    faclang = factoid.origLang
+def check_columnar(directory):
+    """Run the language check over a columnar export made with pbw_columnar, a whole column at a time"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pbw_columnar import ColumnarReader
+    facts = ColumnarReader(directory).read('factoid_type', columns=['factoidKey', 'source', 'origLang', 'origLDesc'])
+    # Look up the expected language of each factoid's source; it is null if the source is not in our list
+    srcnames = pa.array(list(srclist.keys()))
+    srclangs = pa.array([lang or "(Unspecified)" for lang in srclist.values()])
+    explang = pc.take(srclangs, pc.index_in(facts['source'], value_set=srcnames))
+    # Null compares as None does in Python: unequal to anything but itself
+    same = pc.equal(facts['origLang'], explang)
+    same = pc.if_else(pc.is_null(same), pc.and_(pc.is_null(facts['origLang']), pc.is_null(explang)), same)
+    mismatch = pc.and_(pc.invert(same), pc.and_(pc.fill_null(pc.not_equal(facts['origLDesc'], ""), True),
+                                                pc.fill_null(pc.not_equal(facts['source'], "Seals"), True)))
+    for row in facts.append_column('explang', explang).filter(mismatch).to_pylist():
+        print("Language mismatch factoid %d, source %s: %s vs. %s" % (
+            row['factoidKey'], row['source'], row['explang'], row['origLang']))
 
-    # # Check what is in origLDesc and see if it makes sense
-    # ostr = factoid.origLDesc
-    # if ostr is not None and ostr != "":
-    #     if re.search(r'[Α-Ωα-ω]+', ostr) is not None:
-    #         # It's Greek and should be set as such
-    #         explang = "Greek"
-    #     elif re.search(r'[Ա-Քա-ք]+', ostr) is not None:
-    #         explang = "Armenian"
-    #     elif re.search(r'[\u0620-\u06d1]+', ostr) is not None:
-    #         explang = "Arabic"
-    #     # elif re.search(r'[A-Za-z]+', ostr) is not None:
-    #     #     explang = "Latin"
 
-    if faclang != explang and factoid.origLDesc != "":
-        print("Language mismatch factoid %d, source %s: %s vs. %s" % (
-            factoid.factoidKey, factoid.source, explang, faclang))
-        # factoid.oLangKey = languages.get(explang)
-# session.commit()
-print("Done")
\ No newline at end of file
+def check_orm():
+    """Run the language check factoid by factoid through the ORM"""
+    engine = create_engine('mysql+pymysql://' + config.dbstring)
+    smaker = sessionmaker(bind=engine)
+    session = smaker()
+
+    languages = {}
+    for lang in session.query(pbw.OrigLangAuth).all():
+        languages[lang.oLanguage] = lang.oLangKey
+
+    for factoid in session.query(pbw.Factoid).all():
+        if factoid.source == "Seals":
+            continue
+        explang = srclist.get(factoid.source)
+        if explang == "":
+            explang = "(Unspecified)"
+        faclang = factoid.origLang
+
+        # # Check what is in origLDesc and see if it makes sense
+        # ostr = factoid.origLDesc
+        # if ostr is not None and ostr != "":
+        #     if re.search(r'[Α-Ωα-ω]+', ostr) is not None:
+        #         # It's Greek and should be set as such
+        #         explang = "Greek"
+        #     elif re.search(r'[Ա-Քա-ք]+', ostr) is not None:
+        #         explang = "Armenian"
+        #     elif re.search(r'[\u0620-\u06d1]+', ostr) is not None:
+        #         explang = "Arabic"
+        #     # elif re.search(r'[A-Za-z]+', ostr) is not None:
+        #     #     explang = "Latin"
+
+        if faclang != explang and factoid.origLDesc != "":
+            print("Language mismatch factoid %d, source %s: %s vs. %s" % (
+                factoid.factoidKey, factoid.source, explang, faclang))
+            # factoid.oLangKey = languages.get(explang)
+    # session.commit()
+
+
+# Given the directory of a columnar export, check that; otherwise go to the database
+if len(sys.argv) > 1:
+    check_columnar(sys.argv[1])
+else:
+    check_orm()
+print("Done")
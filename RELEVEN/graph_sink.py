@@ -0,0 +1,85 @@
+import os
+from RELEVEN.local_store import open_local_store
+from rdflib import Graph
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+
+
+# A streaming output for the STAR import in file mode. Rather than keeping the whole graph in memory and
+# serialising it at the end, the importer appends the triples it creates to an N-Triples file as it goes,
+# so that its memory use stays with the working set and a crash loses nothing that was already written.
+#
+# The written triples are also loaded into an embedded Oxigraph store, which keeps them on disk rather than
+# in memory. This is the graph the importer reads from, so that what it has written can still be queried,
+# e.g. by the passes at the end of the run that need the whole graph. The store is kept beside the file,
+# as FILE.oxigraph, along with a note of how much of the file it holds, so that a resumed run only has to
+# load what was appended to the file since the store last saw it.
+
+
+class _Callback:
+    """The sink interface that the N-Triples parser wants"""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def triple(self, s, p, o):
+        self.fn((s, p, o))
+
+
+class NTriplesSink:
+    """Appends triples to the N-Triples file at the given path, and keeps a queryable copy of them in an
+    Oxigraph store beside it. If the file exists already, whatever of it the store doesn't yet hold is
+    loaded into the store first."""
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.storedir = path + '.oxigraph'
+        self.marker = self.storedir + '-loaded'
+        self.graph = open_local_store('oxigraph:' + self.storedir)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        loaded = self._loaded()
+        if loaded > size:
+            # The file is not the one the store was made from; start the store again
+            self.graph.remove((None, None, None))
+            loaded = 0
+        if loaded < size:
+            before = len(self.graph)
+            self.replay(self.graph.add, start=loaded)
+            print(f"Loaded {len(self.graph) - before} triples from {path} into {self.storedir}")
+        self.fh = open(path, 'ab')
+        self._note_loaded()
+
+    def _loaded(self):
+        """Return how many bytes of the file the store holds"""
+        try:
+            with open(self.marker) as fh:
+                return int(fh.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _note_loaded(self):
+        with open(self.marker, 'w') as fh:
+            fh.write(str(self.fh.tell()))
+
+    def replay(self, fn, start=0):
+        """Call the given function with each triple in the file from the given byte offset on, without
+        loading the file into memory"""
+        with open(self.path, 'rb') as fh:
+            fh.seek(start)
+            W3CNTriplesParser(_Callback(fn)).parse(fh)
+
+    def write(self, triples):
+        """Append the given triples to the file, and make sure they are on disk, and then to the store"""
+        g = Graph()
+        for t in triples:
+            g.add(t)
+        self.fh.write(g.serialize(format='nt', encoding='utf-8'))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.graph.addN((s, p, o, self.graph) for s, p, o in g)
+        self._note_loaded()
+        self.written += len(g)
+
+    def close(self):
+        self.fh.close()
+        self.graph.close()
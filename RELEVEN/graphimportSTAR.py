@@ -1,17 +1,23 @@
 import argparse
 import pbw
+import pbw_sqlite
 import RELEVEN.PBWstarConstants
 import RELEVEN.author_viewpoints
+import RELEVEN.graph_sink
+import RELEVEN.local_store
+import RELEVEN.run_journal
+import RELEVEN.sparql_transport
+import RELEVEN.update_buffer
 import config
+import os
 import re
 from datetime import datetime
-from functools import reduce
-from http.client import RemoteDisconnected
+from multiprocessing import get_context
+from multiprocessing.util import Finalize
 from rdflib import Graph, Literal, URIRef
-from rdflib.plugins.stores import sparqlstore
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, event, and_, exists, or_
 from sqlalchemy.orm import sessionmaker
-from time import sleep
+from tempfile import mkstemp, TemporaryDirectory
 from urllib.error import URLError
 from warnings import warn
 
@@ -46,6 +52,33 @@ def _smooth_labels(label):
     return label
 
 
+# The importer in each worker process, which is set up once by _init_worker and used for every chunk
+_worker = None
+
+
+def _init_worker(testmode, execution):
+    """Run once in each worker process: set up the importer that the process will use for all of its
+    chunks, and make sure its database connections are closed when the process exits."""
+    global _worker
+    # The worker has its own SQL session and graph, and mints its URIs deterministically, so that
+    # entities shared with other workers come out the same.
+    _worker = graphimportSTAR(None, testmode=testmode, execution=execution, deterministic=True)
+    Finalize(None, _worker.close, exitpriority=10)
+
+
+def _import_worker(task):
+    """Run in a worker process: import the given persons into a fresh staging graph, and write the staged
+    triples to a file for the coordinator to merge. Returns the persons, the file name and the run statistics."""
+    personkeys, facttype, stagedir = task
+    # Each chunk is staged on its own, as if by a worker of its own
+    _worker.new_staging_graph()
+    stats = _worker.process_persons(facttype=facttype, personkeys=personkeys, finish=False)
+    fd, staged = mkstemp(suffix='.nt', dir=stagedir)
+    os.close(fd)
+    _worker.g.serialize(staged, format='nt', encoding='utf-8')
+    return personkeys, staged, stats
+
+
 def _matchid(var, val):
     return 'MATCH (%s) WHERE %s.uuid = "%s" ' % (var, var, val)
 
@@ -82,57 +115,146 @@ def re_encode(s):
 class graphimportSTAR:
     constants = None
     mysqlsession = None
+    engine = None
 
-    def __init__(self, origgraph, testmode=False, execution=None):
+    def __init__(self, origgraph, testmode=False, execution=None, deterministic=False, buffer_size=0,
+                 flush_persons=None, index=False, journal=None, sink=None, cv_file=None):
         # Set the testing flag
         self.testmode = testmode
         # Record the starting time
         self.starttime = datetime.now()
-        # Connect to the SQL DB
-        engine = create_engine('mysql+mysqlconnector://' + config.dbstring)
+        # Connect to the SQL DB, which might be a local SQLite copy made with pbw_sqlite
+        self.engine = engine = create_engine(pbw_sqlite.db_url())
         smaker = sessionmaker(bind=engine)
         self.mysqlsession = smaker()
+        # We only ever read from the session, so the lookup tables can stay in it for the whole run
+        pbw.cache_lookups(self.mysqlsession)
+        # Count the SQL statements we send, so that we can see how many each person costs
+        self.sql_statements = 0
+        event.listen(engine, 'before_cursor_execute', self._count_sql_statement)
+        # If we are resuming from a journal, we carry on with the run it recorded
+        self.journal = journal
+        if journal is not None and journal.swrun is not None:
+            execution = journal.swrun
         # Are we connecting to the remote service?
         if origgraph == config.graphuri:
             # Make the connection and let the constants module instatiate the graph with all the namespaces
-            store = sparqlstore.SPARQLUpdateStore(origgraph, origgraph + '/statements', method='POST',
-                                                  auth=(config.graphuser, config.graphpw))
+            store = RELEVEN.sparql_transport.PooledSPARQLUpdateStore(origgraph, origgraph + '/statements',
+                                                                     method='POST',
+                                                                     auth=(config.graphuser, config.graphpw))
             # Make / retrieve the global nodes and self.constants
-            self.constants = RELEVEN.PBWstarConstants.PBWstarConstants(store=store, execution=execution)
+            self.constants = RELEVEN.PBWstarConstants.PBWstarConstants(store=store, execution=execution,
+                                                                       deterministic=deterministic,
+                                                                       buffer_size=buffer_size,
+                                                                       flush_persons=flush_persons,
+                                                                       index=index, cv_file=cv_file)
             self.g = self.constants.graph
             loaded = True
+        elif RELEVEN.local_store.is_local_store(origgraph) or sink is not None:
+            # Use the embedded store, which keeps the graph on disk. If we are streaming our output to a
+            # sink, this is the sink's own store, which holds what we have streamed out.
+            self.g = sink.graph if sink is not None else RELEVEN.local_store.open_local_store(origgraph)
+            self.constants = RELEVEN.PBWstarConstants.PBWstarConstants(graph=self.g, execution=execution,
+                                                                       deterministic=deterministic,
+                                                                       buffer_size=buffer_size,
+                                                                       flush_persons=flush_persons,
+                                                                       index=index, sink=sink, cv_file=cv_file)
+            loaded = sink is None
         else:
             # Start an RDF graph, parsing what we started with
             self.g = Graph()
             loaded = False
             try:
-                self.g.parse(origgraph)
-                loaded = True
+                if origgraph is not None:
+                    self.g.parse(origgraph)
+                    loaded = True
             except FileNotFoundError:
                 pass
             # Make / retrieve the global nodes and self.constants
-            self.constants = RELEVEN.PBWstarConstants.PBWstarConstants(graph=self.g, execution=execution)
+            self.constants = RELEVEN.PBWstarConstants.PBWstarConstants(graph=self.g, execution=execution,
+                                                                       deterministic=deterministic,
+                                                                       buffer_size=buffer_size,
+                                                                       flush_persons=flush_persons,
+                                                                       index=index, cv_file=cv_file)
+        self.sink = sink
 
         # How many assertions do we have to start with?
+        self.existing_assertions = 0
         if loaded:
-            res = self.g.triples((None, self.constants.predicates['P140'], None))
-            ct = reduce(lambda x, y: x + 1, res, 0)
-            print(f"Using graph {origgraph} with {ct} existing assertions.")
+            counts = self.constants.assertion_counts()
+            self.existing_assertions = sum(counts.values())
+            print(f"Using graph {origgraph} with {self.existing_assertions} existing assertions.")
+            for cls, ct in sorted(counts.items(), key=lambda x: -x[1]):
+                print(f"    {cls.n3(self.g.namespace_manager)}: {ct}")
+
+        # Keep lookup tables of our persistent entities, which hopefully improves performance. If we have
+        # a journal, these are recorded there and reloaded from there.
+        if journal is not None:
+            # With an update buffer, the journal has to wait for the writes to reach the graph
+            buffer = self.constants.buffer
+            journal.start(self.constants.swrun, deferred=buffer is not None,
+                          ledger=self.constants.ledger is not None)
+            if buffer is not None:
+                buffer.on_flush.append(journal.commit)
+            # The ledger of what the run has produced is kept in the journal, if it has been there all along
+            self.constants.ledger = journal.ledger()
+            self.resolved_authorities = journal.cache('authorities')
+            self.resolved_persons = journal.cache('persons')
+            self.resolved_locations = journal.cache('locations')
+            self.resolved_boulloteria = journal.cache('boulloteria')
+            self.resolved_publications = journal.cache('publications')
+        else:
+            self.resolved_authorities = dict()
+            self.resolved_persons = dict()
+            self.resolved_locations = dict()
+            self.resolved_boulloteria = dict()
+            self.resolved_publications = dict()
+
+    def _urify(self, label):
+        """Utility function to turn STAR predicates into real URIref objects"""
+        p, c = label.split(':')
+        return self.constants.namespaces[p][c]
 
-        # Keep lookup tables of our persistent entities, which hopefully improves performance
+    def _count_sql_statement(self, *args):
+        self.sql_statements += 1
+
+    def close(self):
+        """Close our SQL session and release the database connections, if we haven't already"""
+        if self.engine is None:
+            return
+        self.mysqlsession.close()
+        event.remove(self.engine, 'before_cursor_execute', self._count_sql_statement)
+        self.engine.dispose()
+        self.engine = None
+
+    def new_staging_graph(self):
+        """Start again on a new, empty graph, as a worker does for each chunk of persons. Everything we had
+        resolved or set up was written to the old graph, and would be read from there, so we forget it all
+        along with the graph; only the SQL session and its lookup tables stay."""
+        c = self.constants
+        self.g = Graph()
+        self.constants = RELEVEN.PBWstarConstants.PBWstarConstants(graph=self.g, execution=c.execution,
+                                                                   deterministic=c.deterministic)
         self.resolved_authorities = dict()
         self.resolved_persons = dict()
         self.resolved_locations = dict()
         self.resolved_boulloteria = dict()
         self.resolved_publications = dict()
 
-    def _urify(self, label):
-        """Utility function to turn STAR predicates into real URIref objects"""
-        p, c = label.split(':')
-        return self.constants.namespaces[p][c]
-
-    def collect_person_records(self):
-        """Get a list of people whose floruit matches our needs"""
+    def prefetch_persons(self, persons):
+        """Load the given persons' factoids, and everything about them that the handlers need, with a fixed
+        number of queries for the whole batch."""
+        self.mysqlsession.query(pbw.Person).filter(
+            pbw.Person.personKey.in_([x.personKey for x in persons])
+        ).options(*pbw.factoid_prefetch_options(cached_lookups=pbw.has_cached_lookups(self.mysqlsession))
+                   ).populate_existing().all()
+
+    def collect_person_records(self, personkeys=None):
+        """Get a list of people whose floruit matches our needs, or the people with the given keys"""
+        if personkeys is not None:
+            found = {x.personKey: x for x in
+                     self.mysqlsession.query(pbw.Person).filter(pbw.Person.personKey.in_(personkeys)).all()}
+            return [found[k] for k in personkeys if k in found]
         if self.testmode:
             # Debugging / testing: restrict the list of relevant people
             debugnames = ['Anna', 'Apospharios', 'Bagrat', 'Balaleca', 'Gagik', 'Herve', 'Ioannes', 'Konstantinos',
@@ -141,11 +263,15 @@ class graphimportSTAR:
             return self.mysqlsession.query(pbw.Person).filter(
                 and_(pbw.Person.name.in_(debugnames), pbw.Person.mdbCode.in_(debugcodes))
             ).all()
-        relevant = [x for x in self.mysqlsession.query(pbw.Person).all()
-                    if self.constants.inrange(x.floruit) and len(x.factoids) > 0]
+        # Select the people in our date range who have at least one factoid, and let the database do it
+        has_factoids = exists().where(pbw.FactoidPerson.personKey == pbw.Person.personKey,
+                                      pbw.FactoidPerson.factoidKey == pbw.Factoid.factoidKey)
+        in_range = and_(pbw.Person.floruit.in_(self.constants.eleventh_century), has_factoids)
         # Add the corner cases that we want to include: two emperors and a hegoumenos early in his career
-        for name, code in [('Konstantinos', 8), ('Romanos', 3), ('Neophytos', 107)]:
-            relevant.append(self.mysqlsession.query(pbw.Person).filter_by(name=name, mdbCode=code).scalar())
+        corner_cases = [and_(pbw.Person.name == name, pbw.Person.mdbCode == code)
+                        for name, code in [('Konstantinos', 8), ('Romanos', 3), ('Neophytos', 107)]]
+        relevant = self.mysqlsession.query(pbw.Person).filter(
+            or_(in_range, *corner_cases)).order_by(pbw.Person.personKey).all()
         print("Found %d relevant people" % len(relevant))
         return relevant
 
@@ -208,9 +334,10 @@ class graphimportSTAR:
             sparql += f"\n        {provenance} {c.star_src} ?{label} . "
         return sparql
 
-    def gender_handler(self, sqlperson, graphperson):
+    def _gender_sparql(self, sqlperson, graphperson):
+        """Return the SPARQL pattern for the gender assignment of the person, along with the assertions
+        in it that need to be documented, or None if the gender is unknown."""
         c = self.constants
-        pbwdoc = c.namespaces['pbw'][f"person/{sqlperson.personKey}"]
         pbw_sex = sqlperson.sex
         if pbw_sex == 'Mixed':  # we have already excluded Anonymi
             pbw_sex = 'Unknown'
@@ -229,16 +356,13 @@ class graphimportSTAR:
             sparql = self.create_assertion_sparql('a1', 'P41', '?gass', graphperson, c.pbw_agent)
             sparql += self.create_assertion_sparql('a2', 'P42', '?gass', c.get_gender(pbw_sex), c.pbw_agent)
             sparql += f"?gass a {c.get_label('E17G')} . "
-            # Check and create it if necessary
-            res = c.ensure_entities_existence(sparql)
-            return c.document(pbwdoc, res['a1'], res['a2'])
+            return sparql, ['a1', 'a2']
         return None
 
-    def identifier_handler(self, sqlperson, graphperson):
+    def _identifier_sparql(self, sqlperson, graphperson):
         """The identifier in this context is the 'origName' field, thus an identifier assigned by PBW
         not on the basis of any particular source. We turn this into an Appellation assertion"""
         c = self.constants
-        pbwdoc = c.namespaces['pbw'][f"person/{sqlperson.personKey}"]
         # Strip any parenthetical from the nameOL field
         withparen = re.search(r'(.*)\s+\(.*\)', sqlperson.nameOL)
         if withparen is not None:
@@ -251,9 +375,36 @@ class graphimportSTAR:
         sparql += f"""?appellation a {c.get_label('E33A')} ;
             {c.get_label('P190')} {Literal(appellation, lang=_get_source_lang(sqlperson)).n3()} .
         """
-        # Check and create it if necessary
-        res = c.ensure_entities_existence(sparql)
-        return c.document(pbwdoc, res['a1'])
+        return sparql, ['a1']
+
+    def person_records_handler(self, sqlperson, graphperson, record_types):
+        """Make the assertions that come directly from the person record rather than from factoids. These
+        don't depend on each other, so we can check and create them all in a single round trip."""
+        c = self.constants
+        pbwdoc = c.namespaces['pbw'][f"person/{sqlperson.personKey}"]
+        patterns = []
+        for ftype in record_types:
+            ourftype = _smooth_labels(ftype)
+            try:
+                method = getattr(self, "_%s_sparql" % ourftype.lower())
+            except AttributeError:
+                warn(f"No handler for {ourftype} record info; skipping.")
+                continue
+            pattern = method(sqlperson, graphperson)
+            if pattern is not None:
+                patterns.append(pattern)
+        # Check and create them if necessary
+        results = c.ensure_entities_existence_batch([sparql for sparql, _ in patterns])
+        documented = []
+        for (_, keys), res in zip(patterns, results):
+            documented.extend(c.document(pbwdoc, *[res[x] for x in keys]))
+        return documented or None
+
+    def gender_handler(self, sqlperson, graphperson):
+        return self.person_records_handler(sqlperson, graphperson, ['Gender'])
+
+    def identifier_handler(self, sqlperson, graphperson):
+        return self.person_records_handler(sqlperson, graphperson, ['Identifier'])
 
     def get_source_and_agent(self, factoid):
         """Returns a pair of entities that represent the documentary source and the agent for this factoid.
@@ -304,7 +455,7 @@ class graphimportSTAR:
         boul_node = self.find_or_create_boulloterion(keystr, btitle)
         # See if the boulloterion already exists with an inscription. Be sure to document it if so
         sparql_check = self.create_assertion_sparql('a1', 'P128', boul_node, '?inscription', pbweditor)
-        res = self.g.query("SELECT ?a1 ?inscription WHERE { " + sparql_check + "}")
+        res = c.query("SELECT ?a1 ?inscription WHERE { " + sparql_check + "}")
         if len(res):
             c.document(pbwdoc, _get_single_key(res, 'a1'))
             return boul_node, _get_single_key(res, 'inscription')
@@ -381,6 +532,7 @@ class graphimportSTAR:
 
         # Get some labels
         source_nodes = []
+        source_patterns = []
         for source in pubs:
             # Fix the encoding for the entries we didn't add
             short_name = source.shortName if source.bibKey == 816 else re_encode(source.shortName)
@@ -397,7 +549,9 @@ class graphimportSTAR:
             {c.get_label('P37')} ?srcref ;
             a {c.get_label('E15')}  .
         """
-            res = c.ensure_entities_existence(sn)
+            source_patterns.append(sn)
+        # Check and create all the publications at once
+        for res in c.ensure_entities_existence_batch(source_patterns):
             c.document(None, res['a1'])
             source_nodes.append(res['src'])
         if len(source_nodes) > 1:
@@ -671,7 +825,6 @@ class graphimportSTAR:
             loc_ent = self._find_or_create_identified_entity(
                 self.constants.get_label('E27'), self.constants.pbw_agent,
                 k, sqlloc.locName)
-            self.resolved_locations[k] = loc_ent
             # ...and add the gazetteer links that Charlotte made
             geoagent = self.get_viaf_agent_node([c.cr])
             loc_sparql = ''
@@ -687,6 +840,8 @@ class graphimportSTAR:
             if loc_sparql:
                 res = c.ensure_entities_existence(loc_sparql)
                 c.document(None, *[res[x] for x in to_doc])
+            # Only remember the location once it is complete
+            self.resolved_locations[k] = loc_ent
         return self.resolved_locations[k]
 
     # This one doesn't use an E15 assertion, it is just a thing with a name
@@ -766,7 +921,7 @@ class graphimportSTAR:
                 return
 
         # Fish out the other person(s) with whom identity is being asserted
-        assertions = []
+        patterns = []
         for otherperson in factoid.referents():
             if otherperson.name in ['Anonymi', 'Anonymae']:
                 print(f"Skipping group membership for uncertain identity in factoid {factoid.factoidKey}: {factoid.replace_referents()}")
@@ -775,8 +930,8 @@ class graphimportSTAR:
                                                   self.find_or_create_pbwperson(otherperson), c.pbw_agent)
             # Mark it as a suggestion rather than a full-on assertion
             sparql += f"        ?a1 a {c.get_label('S5')} .\n"
-            res = c.ensure_entities_existence(sparql)
-            assertions.append(res['a1'])
+            patterns.append(sparql)
+        assertions = [res['a1'] for res in c.ensure_entities_existence_batch(patterns)]
 
         if len(assertions):
             # Mark the uncertainty
@@ -891,8 +1046,8 @@ class graphimportSTAR:
         # Add the label if it doesn't already exist, in a backwards-compatible way
         pbwperson = factoid.main_person()[0]
         person_pbwid = f"{pbwperson.name} {pbwperson.mdbCode}"
-        if c.graph.value(deathevent, c.predicates['P3']) is None:
-            c.graph.add((deathevent, c.predicates['P3'], Literal("Death event for " + person_pbwid)))
+        if c.value(deathevent, c.predicates['P3']) is None:
+            c.add((deathevent, c.predicates['P3'], Literal("Death event for " + person_pbwid)))
 
         # Get the description of the death in English and the original language
         olang = _get_source_lang(factoid) or 'grc'
@@ -1049,7 +1204,7 @@ class graphimportSTAR:
             a {c.get_assertion_for_predicate('SP18')} .
         ?kstate a {c.get_label('C3')} .}}
 """
-        res = self.g.query(sparql_check)
+        res = self.constants.query(sparql_check)
         if len(res):
             # We found a kinship between these two people. Return it
             return _get_single_key(res, 'kstate')
@@ -1122,6 +1277,44 @@ class graphimportSTAR:
         tla = self.get_viaf_agent_node([self.constants.ta])
         return self.constants.record_script_run(tla)
 
+    def _record_readings(self, readings):
+        """Assign a reading interpretation event to each of the given factoids, which are tuples of
+        (factoid, assertions created, source reader, source node). The factoid timestamps are checked
+        in a single query, and the readings are created in a single update."""
+        if not readings:
+            return
+        c = self.constants
+        # First get the timestamps on the factoids. Do this separately so we don't have duplicate timestamps
+        ts_patterns = [f"?ts a {c.get_label('E52')}; {c.get_label('P82b')} {Literal(f.creationDate).n3()} ."
+                       for f, _, _, _ in readings]
+        timestamps = c.ensure_entities_existence_batch(ts_patterns)
+
+        data = []
+        for (f, assertions_created, source_reader, source_node), ts in zip(readings, timestamps):
+            factoid_ts = ts['ts']
+            # An I16 Meaning Comprehension was P14 carried out by the authority on the given date,
+            # which P16 used specific object the source,
+            # created an I13 Intended Meaning Belief and J5 holds (it) to be true,
+            # J4 that an I4 proposition set which J28 contains entity reference the assertion.
+            # We will give these deterministic names, to aid performance.
+            pset = c.ns[f'proposition_set/pbw{f.factoidKey}'].n3()
+            mbelief = c.ns[f'meaning/pbw{f.factoidKey}'].n3()
+            reading = c.ns[f'reading/pbw{f.factoidKey}'].n3()
+            data.append(f"""
+            {pset} a {c.get_label('I4')} ;
+                {c.get_label('J28')} {', '.join(x.n3() for x in assertions_created)} .
+            {mbelief} a {c.get_label('I13')} ;
+                {c.get_label('J4')} {pset} ;
+                {c.get_label('J5')} {Literal(True).n3()} .
+            {reading} a {c.get_label('I16')} ;
+                {c.get_label('L11r')} {c.swrun.n3()} ;
+                {c.get_label('P4')} {factoid_ts.n3()} ;
+                {c.get_label('P14')} {source_reader.n3()} ;
+                {c.get_label('P16')} {source_node.n3()} ;
+                {c.get_label('J23')} {mbelief} .""")
+        c.insert_data(''.join(data) + "\n    ")
+        c.note_outputs(*[c.ns[f'reading/pbw{f.factoidKey}'] for f, _, _, _ in readings])
+
     def _person_process_loop(self, person, direct_person_records, factoid_types, used_sources, boulloteria):
         c = self.constants
         # Skip the anonymous groups for now
@@ -1133,16 +1326,12 @@ class graphimportSTAR:
         graph_person = self.find_or_create_pbwperson(person)
 
         # Get the 'factoids' that are directly in the person record
-        for ftype in direct_person_records:
-            ourftype = _smooth_labels(ftype)
-            try:
-                method = getattr(self, "%s_handler" % ourftype.lower())
-                method(person, graph_person)
-            except AttributeError:
-                warn(f"No handler for {ourftype} record info; skipping.")
-
+        if direct_person_records:
+            self.person_records_handler(person, graph_person, direct_person_records)
 
-        # Now get the factoids that are really factoids
+        # Now get the factoids that are really factoids, sorted by type all at once
+        readings = []
+        typed_factoids = person.main_factoids_by_type()
         for ftype in factoid_types:
             ourftype = _smooth_labels(ftype)
             try:
@@ -1150,7 +1339,7 @@ class graphimportSTAR:
             except AttributeError:
                 continue
             fprocessed = 0
-            for f in person.main_factoids(ftype):
+            for f in typed_factoids.get(ftype, []):
                 if ftype in ['Uncertain Ident']:
                     # There is no source, so no individual agent. Just run the factoid processing method.
                     method(f, graph_person)
@@ -1200,40 +1389,20 @@ class graphimportSTAR:
                         warn(f"No PBW reader/editor found for source {source_key} on factoid {f.factoidKey}")
                         continue
 
-                    # First get the timestamp on the factoid. Do this separately so we don't have duplicate timestamps
-                    ts_sparql = f"?ts a {c.get_label('E52')}; {c.get_label('P82b')} {Literal(f.creationDate).n3()} ."
-                    factoid_ts = c.ensure_entities_existence(ts_sparql)['ts']
-
-                    # An I16 Meaning Comprehension was P14 carried out by the authority on the given date,
-                    # which P16 used specific object the source,
-                    # created an I13 Intended Meaning Belief and J5 holds (it) to be true,
-                    # J4 that an I4 proposition set which J28 contains entity reference the assertion.
-                    # We will give these deterministic names, to aid performance.
-                    pset = c.ns[f'proposition_set/pbw{f.factoidKey}'].n3()
-                    mbelief = c.ns[f'meaning/pbw{f.factoidKey}'].n3()
-                    reading = c.ns[f'reading/pbw{f.factoidKey}'].n3()
-                    sparql = f"""
-    INSERT DATA {{
-            {pset} a {c.get_label('I4')} ;
-                {c.get_label('J28')} {', '.join(x.n3() for x in assertions_created)} .
-            {mbelief} a {c.get_label('I13')} ;
-                {c.get_label('J4')} {pset} ;
-                {c.get_label('J5')} {Literal(True).n3()} .
-            {reading} a {c.get_label('I16')} ;
-                {c.get_label('L11r')} {c.swrun.n3()} ;
-                {c.get_label('P4')} {factoid_ts.n3()} ;
-                {c.get_label('P14')} {source_reader.n3()} ;
-                {c.get_label('P16')} {source_node.n3()} ;
-                {c.get_label('J23')} {mbelief} .
-    }}"""
-                    c.graph.update(sparql)
+                    # Save the reading for later, so that we can create all of this person's readings at once
+                    readings.append((f, assertions_created, source_reader, source_node))
 
             if fprocessed > 0:
                 print(f"Ingested {fprocessed} {ftype} factoid(s)")
+
+        # Now make the reading events for all the factoids we ingested
+        self._record_readings(readings)
         return True
 
-    def process_persons(self, facttype=None, skipuntil=None, processed=0):
-        """Go through the relevant person records and process them for factoids"""
+    def process_persons(self, facttype=None, skipuntil=None, processed=0, personkeys=None, finish=True,
+                        prefetch=50):
+        """Go through the relevant person records (or the given ones) and process them for factoids. If
+        finish is False, return the statistics instead of finishing the run."""
         used_sources = set()
         boulloteria = set()
 
@@ -1248,7 +1417,13 @@ class graphimportSTAR:
                              x.typeName != '(Unspecified)']
         # Are we skipping?
         started = skipuntil is None
-        for person in self.collect_person_records():
+        persons = self.collect_person_records(personkeys)
+        if self.journal is not None and self.journal.completed:
+            remaining = [x for x in persons if x.personKey not in self.journal.completed]
+            print(f"Skipping {len(persons) - len(remaining)} persons already completed in this run")
+            persons = remaining
+        prefetched = set()
+        for idx, person in enumerate(persons):
             # Get the person's string name
             person_pbwstr = f"{person.name} {person.mdbCode}"
             if not started:
@@ -1259,34 +1434,111 @@ class graphimportSTAR:
                     # print(f"Skipping past {person_pbwstr}")
                     continue
 
-            for attempt in range(5):
-                try:
+            # Load this person's factoids, and the next few persons' while we are at it
+            if person.personKey not in prefetched:
+                batch = persons[idx:idx+prefetch]
+                self.prefetch_persons(batch)
+                prefetched.update(x.personKey for x in batch)
+            sql_before = self.sql_statements
+            try:
+                # Document all of the person's assertions in one write
+                with self.constants.collect_documentation():
                     result = self._person_process_loop(person, direct_person_records, factoid_types,
                                                        used_sources, boulloteria)
-                    if result:
-                        processed += 1
-                    break
-                except (URLError, RemoteDisconnected, ConnectionResetError) as e:
-                    if attempt == 4:
-                        # RemoteDisconnected has no 'reason' attribute
-                        if isinstance(e, URLError):
-                            print(f"Persistent URLerror {e.reason}.")
-                        else:
-                            print(f"Persistent connection error {e}.")
-                        print(f"Process started at {self.starttime} and ending at {datetime.now()}.")
-                        print(f"Restart with the arguments: -r '{person_pbwstr}' -x '{self.constants.swrun}'")
-                        exit(1)
-                    else:
-                        if isinstance(e, URLError):
-                            print(f"Obtained URLerror {e.reason}; will retry")
-                        else:
-                            print(f"Persistent connection error {e}; will retry")
-                        sleep(attempt * 30)
-                except Exception as e:
-                    print(f"Process started at {self.starttime} and ending at {datetime.now()}.")
-                    print(f"Restart with the arguments: -r '{person_pbwstr}' -x '{self.constants.swrun}'")
-                    raise e
-
+                if result:
+                    processed += 1
+                    print(f"Used {self.sql_statements - sql_before} SQL statements for {person_pbwstr}")
+                if self.journal is not None:
+                    self.journal.person_done(person.personKey)
+                self.constants.end_person()
+            except RELEVEN.sparql_transport.TRANSIENT_ERRORS as e:
+                # The store transport has already retried the request, so the connection is well and truly down
+                # RemoteDisconnected has no 'reason' attribute
+                if isinstance(e, URLError):
+                    print(f"Persistent URLerror {e.reason}.")
+                else:
+                    print(f"Persistent connection error {e}.")
+                print(f"Process started at {self.starttime} and ending at {datetime.now()}.")
+                print(f"Restart with the arguments: {self._restart_arguments(person_pbwstr)}")
+                exit(1)
+            except Exception as e:
+                # Write out what we have done so far, so that the restart can pick up from here
+                self.constants.flush()
+                print(f"Process started at {self.starttime} and ending at {datetime.now()}.")
+                print(f"Restart with the arguments: {self._restart_arguments(person_pbwstr)}")
+                raise e
+
+        if not finish:
+            return processed, used_sources, boulloteria
+        self.finish_run(processed, used_sources, boulloteria)
+
+    def _restart_arguments(self, person_pbwstr):
+        if self.journal is not None:
+            return f"-j '{self.journal.path}'"
+        return f"-r '{person_pbwstr}' -x '{self.constants.swrun}'"
+
+    def process_persons_parallel(self, workers, facttype=None, chunksize=50, personkeys=None, finish=True):
+        """Process the relevant person records (or the given ones) in a pool of worker processes, each of
+        which works on a chunk of persons at a time in its own staging graph. The staged triples are merged
+        into our graph as the chunks come back; since the workers mint their URIs deterministically, the
+        shared entities such as authorities, publications, boulloteria and vocabulary terms come out the
+        same and merge into one. With no workers, the chunks are worked on here, one after another, in the
+        same way. If finish is False, return the statistics instead of finishing the run."""
+        c = self.constants
+        personkeys = [x.personKey for x in self.collect_person_records(personkeys)]
+        if self.journal is not None:
+            personkeys = [x for x in personkeys if x not in self.journal.completed]
+        initargs = (self.testmode, str(c.swrun))
+        with TemporaryDirectory() as stagedir:
+            tasks = [(personkeys[i:i+chunksize], facttype, stagedir) for i in range(0, len(personkeys), chunksize)]
+            if workers:
+                with get_context('spawn').Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                    stats = self._merge_staged(pool.imap_unordered(_import_worker, tasks), len(personkeys))
+                    # Let the workers exit in their own time, so that they close their database connections
+                    pool.close()
+                    pool.join()
+            else:
+                _init_worker(*initargs)
+                try:
+                    stats = self._merge_staged(map(_import_worker, tasks), len(personkeys))
+                finally:
+                    _worker.close()
+        if not finish:
+            return stats
+        self.finish_run(*stats)
+
+    def _merge_staged(self, results, total):
+        """Merge the staged triples of each chunk that the workers return into our graph, and return the
+        statistics of the run"""
+        c = self.constants
+        processed = 0
+        used_sources = set()
+        boulloteria = set()
+        merger = RELEVEN.update_buffer.UpdateBuffer(self.g, sink=self.sink)
+        for done, staged, (wprocessed, wsources, wboulloteria) in results:
+            sg = Graph()
+            sg.parse(staged, format='nt')
+            merger.addN(sg)
+            os.remove(staged)
+            if self.journal is not None:
+                # The chunk has to be in the graph before we can call it done
+                merger.flush()
+            c.note_outputs(*sg.subjects(c.predicates['L11r'], c.swrun))
+            if self.journal is not None:
+                for k in done:
+                    self.journal.person_done(k)
+                self.journal.commit()
+            processed += wprocessed
+            used_sources.update(wsources)
+            boulloteria.update(wboulloteria)
+            print(f"*** {datetime.now().strftime('%d %H:%M:%S')} Merged {len(sg)} staged triples; "
+                  f"{processed} of {total} persons done ***")
+        merger.flush()
+        print(f"Wrote {merger.written} triples to the graph in {merger.requests} requests.")
+        return processed, used_sources, boulloteria
+
+    def finish_run(self, processed, used_sources, boulloteria):
+        """Add the structures that depend on the whole import, record the run, and report on it"""
         # Make a pass through the authored sources and add viewpoints for all of them
         RELEVEN.author_viewpoints.add_viewpoint_structures(self.constants)
 
@@ -1294,6 +1546,10 @@ class graphimportSTAR:
         print(f"Processed {processed} person records.")
         print(f"Used the following sources: {sorted(used_sources)}")
         print(f"Used the following boulloterion IDs: {sorted(boulloteria)}")
+        store = self.g.store
+        if isinstance(store, RELEVEN.sparql_transport.PooledSPARQLUpdateStore):
+            for kind, stats in store.stats.items():
+                print(f"Store {kind} requests: {stats}")
 
 
 # If we are running as main, execute the script
@@ -1306,8 +1562,10 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--testing', action='store_true',
                         help="Run in testing mode with limited data")
     parser.add_argument('-g', '--graph',
-                        default=config.graphuri,
-                        help="Graph containing existing STAR assertions, if any")
+                        default=None,
+                        help="Graph containing existing STAR assertions, if any. This is the triple store "
+                             "URL, a file, or an embedded store given as oxigraph:DIR or berkeleydb:DIR. "
+                             "The default is the triple store in config.py")
     parser.add_argument('-f', '--factoid-type',
                         default=None,
                         help="Process factoids of the single given type")
@@ -1317,19 +1575,80 @@ if __name__ == '__main__':
     parser.add_argument('-x', '--execution',
                         default=None,
                         help="Software execution URI for run being resumed")
+    parser.add_argument('-d', '--deterministic', action='store_true',
+                        help="Mint URIs from the content of each assertion and write without checking for "
+                             "existing assertions first. Only for graphs that were built this way")
+    parser.add_argument('-b', '--buffer-size', type=int, default=0,
+                        help="Collect new triples and write them to the graph in batches of this size")
+    parser.add_argument('--flush-every', type=int, default=None,
+                        help="With --buffer-size, also write out the batch after this many persons")
+    parser.add_argument('-j', '--journal',
+                        default=None,
+                        help="Keep a journal of the run in this file, and resume the run it records if it exists")
+    parser.add_argument('-s', '--stream',
+                        default=None,
+                        help="Append the new triples to this N-Triples file after each person, instead of "
+                             "writing to a graph, so not together with -g. A copy of the file is kept in an "
+                             "Oxigraph store beside it, FILE.oxigraph, so this needs oxrdflib. Implies "
+                             "--deterministic")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Import the persons in this many parallel processes. The workers mint their URIs "
+                             "deterministically, so the graph has to be empty or built with --deterministic")
+    parser.add_argument('-i', '--index', action='store_true',
+                        help="Load the existing assertions into memory at the start, and check for them there")
+    parser.add_argument('--cv-cache',
+                        default=None,
+                        help="Read the controlled vocabularies from this file rather than the graph, if it exists, "
+                             "and save them there at the end")
     args = parser.parse_args()
     # Check that we have an execution if we are resuming
     if args.resume_from is not None and args.execution is None:
         print("Please specify the earlier execution URI to resume the run.")
         exit(1)
+    if args.workers > 1 and args.resume_from is not None:
+        print("Resuming from a named person is not possible with parallel workers.")
+        exit(1)
+    if args.stream is not None and args.graph is not None:
+        print("The new triples go to the --stream file alone, so there is no graph to give with -g.")
+        exit(1)
+    if args.graph is None:
+        args.graph = config.graphuri
 
     # Process the person records
-    gimport = graphimportSTAR(origgraph=args.graph, testmode=args.testing, execution=args.execution)
+    sink = RELEVEN.graph_sink.NTriplesSink(args.stream) if args.stream else None
+    gimport = graphimportSTAR(origgraph=None if sink else args.graph, testmode=args.testing,
+                              execution=args.execution,
+                              deterministic=args.deterministic or sink is not None,
+                              buffer_size=args.buffer_size, flush_persons=args.flush_every, index=args.index,
+                              journal=RELEVEN.run_journal.RunJournal(args.journal) if args.journal else None,
+                              sink=sink, cv_file=args.cv_cache)
     print(f"Ingestion run started at {gimport.starttime}")
-    gimport.process_persons(facttype=args.factoid_type, skipuntil=args.resume_from)
+    if args.workers > 1 and not gimport.constants.deterministic:
+        # The workers write without checking for existing assertions, which would duplicate anything
+        # in the graph that was not minted the way they mint it
+        if gimport.existing_assertions:
+            print("Parallel workers can only add to a graph that was built with --deterministic; "
+                  "rerun with -d if this one was, or without -w if not.")
+            exit(1)
+        print("The graph is empty, so the parallel import will mint its URIs deterministically.")
+        gimport.constants.deterministic = True
+    if args.workers > 1:
+        gimport.process_persons_parallel(args.workers, facttype=args.factoid_type)
+    else:
+        gimport.process_persons(facttype=args.factoid_type, skipuntil=args.resume_from)
     # Where are we writing the graph to? Default is the location in config.py
     filename = args.graph
-    if args.graph != config.graphuri:
+    if sink is not None:
+        # Everything has been written already
+        sink.close()
+    elif RELEVEN.local_store.is_local_store(args.graph):
+        # Everything is in the store already
+        gimport.g.close()
+    elif args.graph != config.graphuri:
         gimport.g.serialize(args.graph)
+    gimport.constants.save_cv()
+    if gimport.journal is not None:
+        gimport.journal.close()
+    gimport.close()
     duration = datetime.now() - gimport.starttime
     print("Done! Ran in %s" % str(duration))
@@ -0,0 +1,39 @@
+from importlib import import_module
+from rdflib import Graph, URIRef
+
+
+# An embedded, on-disk triple store, so that a full import can be run without a triple store service and
+# without holding the whole graph in memory. The store is named with a URI-like string whose scheme says
+# which backend to use, and whose path says where its files are:
+#
+#   oxigraph:/path/to/dir    - Oxigraph, through the oxrdflib package
+#   berkeleydb:/path/to/dir  - Berkeley DB, through rdflib's own store and the berkeleydb package
+#
+# Neither package is needed by anything else here, so they are only imported when one is asked for.
+
+BACKENDS = {
+    'oxigraph': ('Oxigraph', 'oxrdflib'),
+    'berkeleydb': ('BerkeleyDB', 'berkeleydb'),
+}
+
+# The graph that our data goes into; the same one the constants use on the remote store
+DEFAULT_GRAPH = URIRef('https://r11.eu/rdf/resource/')
+
+
+def is_local_store(uri):
+    """Return true if the given string names an embedded store"""
+    return isinstance(uri, str) and uri.split(':', 1)[0] in BACKENDS
+
+
+def open_local_store(uri, identifier=DEFAULT_GRAPH):
+    """Open (or create) the embedded store named by the given string, and return the graph in it with the
+    given identifier."""
+    scheme, path = uri.split(':', 1)
+    plugin, package = BACKENDS[scheme]
+    try:
+        import_module(package)
+    except ImportError as e:
+        raise ImportError(f"The {scheme} store needs the {package} package to be installed") from e
+    graph = Graph(store=plugin, identifier=identifier)
+    graph.open(path, create=True)
+    return graph
@@ -26,7 +26,9 @@ with open('pbw_sources.csv', encoding='utf-8', newline='') as f:
             source = starts_with_any(row[0])
             if source:
                 factoid_text = row[9]
-                for factoid in session.query(pbw.Factoid).filter_by(source=source).all():
+                factoids = session.query(pbw.Factoid).filter_by(source=source).all()
+                pbw.prefetch_referents(session, factoids)
+                for factoid in factoids:
                     engDesc = factoid.replace_referents().replace('>', '').replace('<', '')
                     if engDesc == factoid_text:
                         print(f"Matched row {row[0]} to factoid {factoid.factoidKey}")
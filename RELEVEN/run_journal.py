@@ -0,0 +1,132 @@
+import json
+import os
+from rdflib import URIRef
+
+
+# An append-only journal for an import run, so that an interrupted run can be picked up where it left off.
+# It records the software execution URI of the run, the persons that have been completely written to the
+# graph, the entities that the importer has resolved along the way (authorities, publications, etc.), and,
+# if the run was journaled from its start, the ledger of what it has produced.
+# Each entry is a line of JSON; a partly written line, as a crash might leave, is ignored.
+#
+# If the importer writes through an update buffer, nothing is durable until the buffer is flushed, so in
+# that case the entries are held back until commit() is called after each flush.
+
+
+class RunJournal:
+    """Reads the journal at the given path, if there is one, and appends to it from then on."""
+
+    def __init__(self, path):
+        self.path = path
+        self.swrun = None
+        self.completed = set()
+        self.caches = dict()
+        self.outputs = None
+        self.deferred = False
+        self.pending = []
+        if os.path.exists(path):
+            self._replay()
+        self.fh = open(path, 'a', encoding='utf-8')
+        # Make sure that we don't append to a partly written line
+        if self.fh.tell() > 0:
+            with open(path, 'rb') as fh:
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != b'\n':
+                    self.fh.write('\n')
+
+    def _replay(self):
+        with open(self.path, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last thing written before a crash
+                    continue
+                if 'swrun' in entry:
+                    self.swrun = entry['swrun']
+                    if entry.get('ledger'):
+                        self.outputs = set()
+                elif 'person' in entry:
+                    self.completed.add(entry['person'])
+                elif 'cache' in entry:
+                    self.caches.setdefault(entry['cache'], dict())[entry['key']] = URIRef(entry['uri'])
+                elif 'outputs' in entry and self.outputs is not None:
+                    self.outputs.update(URIRef(x) for x in entry['outputs'])
+        print(f"Journal {self.path} has {len(self.completed)} completed persons for run {self.swrun}")
+
+    def start(self, swrun, deferred=False, ledger=False):
+        """Record the software execution that this run belongs to. If deferred is set, entries are only
+        written when they are committed. If ledger is set, the run is new and its outputs will be kept."""
+        self.deferred = deferred
+        if self.swrun is None:
+            self.swrun = str(swrun)
+            if ledger:
+                self.outputs = set()
+            self._write([{'swrun': self.swrun, 'ledger': ledger}])
+        elif self.swrun != str(swrun):
+            raise ValueError(f"Journal {self.path} belongs to run {self.swrun}, not {swrun}")
+
+    def cache(self, name):
+        """Return a dictionary for the named cache of resolved entities, filled from the journal,
+        that records any new entries in the journal."""
+        return JournaledCache(self, name, self.caches.get(name, dict()))
+
+    def ledger(self):
+        """Return the set of this run's outputs, filled from the journal, that records any new members in
+        the journal; or None if the journal didn't see the start of the run."""
+        if self.outputs is None:
+            return None
+        return JournaledLedger(self, self.outputs)
+
+    def person_done(self, personkey):
+        self.record({'person': personkey})
+        self.completed.add(personkey)
+
+    def record(self, entry):
+        if self.deferred:
+            self.pending.append(entry)
+        else:
+            self._write([entry])
+
+    def commit(self, *args):
+        """Write out the entries that were waiting for the graph to be flushed. Takes and ignores the
+        arguments of a flush callback."""
+        entries = self.pending
+        self.pending = []
+        self._write(entries + [{'flush': len(entries)}])
+
+    def _write(self, entries):
+        for e in entries:
+            self.fh.write(json.dumps(e) + '\n')
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+class JournaledCache(dict):
+    """A dictionary of resolved entity URIs whose new entries are recorded in the journal"""
+
+    def __init__(self, journal, name, entries):
+        super().__init__(entries)
+        self.journal = journal
+        self.name = name
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.journal.record({'cache': self.name, 'key': key, 'uri': str(value)})
+
+
+class JournaledLedger(set):
+    """A set of the run's outputs whose new members are recorded in the journal"""
+
+    def __init__(self, journal, entries):
+        super().__init__(entries)
+        self.journal = journal
+
+    def update(self, *others):
+        new = sorted(str(x) for other in others for x in other if x not in self)
+        super().update(*others)
+        if new:
+            self.journal.record({'outputs': new})
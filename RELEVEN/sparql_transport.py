@@ -0,0 +1,125 @@
+import gzip
+import random
+import requests
+from http.client import RemoteDisconnected
+from io import BytesIO
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+from rdflib.query import Result
+from rdflib.term import BNode
+from requests.adapters import HTTPAdapter
+from time import perf_counter, sleep
+from urllib.error import URLError
+from urllib.parse import urlencode
+
+
+# The HTTP transport for the remote triple store. rdflib opens a new connection for every query and
+# update it sends; here we keep a pool of persistent connections open instead, and retry any request that
+# fails in transit after a short, randomised wait, so that a dropped connection costs us a retry rather
+# than a whole person. We also keep count of how long the requests take.
+
+# The errors that mean a request might well succeed if we send it again
+TRANSIENT_ERRORS = (URLError, RemoteDisconnected, ConnectionResetError,
+                    requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# The server responses that mean the same
+TRANSIENT_STATUS = {502, 503, 504}
+
+_accept = {
+    'xml': 'application/sparql-results+xml, application/rdf+xml',
+    'json': 'application/sparql-results+json',
+    'csv': 'text/csv',
+    'tsv': 'text/tab-separated-values',
+}
+
+
+class TransportStats:
+    """Counts and timings of the requests of one kind, i.e. queries or updates"""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+    def record(self, elapsed):
+        self.requests += 1
+        self.seconds += elapsed
+        self.slowest = max(self.slowest, elapsed)
+
+    def __str__(self):
+        mean = self.seconds / self.requests if self.requests else 0
+        return (f"{self.requests} requests, {self.retries} retries, {self.seconds:.1f}s in all, "
+                f"{mean * 1000:.1f}ms on average, {self.slowest * 1000:.1f}ms at most")
+
+
+class PooledSPARQLUpdateStore(SPARQLUpdateStore):
+    """A SPARQLUpdateStore that sends its requests over a pool of keep-alive connections. Requests that fail
+    in transit are tried again up to the given number of retries, with a randomised backoff that starts at
+    the given number of seconds and doubles each time. If compress is set, request bodies are gzipped."""
+
+    def __init__(self, query_endpoint, update_endpoint, retries=5, backoff=0.5, compress=False, pool_size=4,
+                 timeout=None, **kwargs):
+        super().__init__(query_endpoint, update_endpoint, **kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.compress = compress
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats = {'query': TransportStats(), 'update': TransportStats()}
+
+    def _send(self, kind, url, params, headers, body):
+        """Send a request, retrying it if it fails in transit, and return the response"""
+        headers = dict(self.kwargs.get('headers', {}), **headers)
+        if body is not None:
+            body = body.encode('utf-8')
+            if self.compress:
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+        stats = self.stats[kind]
+        for attempt in range(self.retries + 1):
+            start = perf_counter()
+            try:
+                if body is None:
+                    response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                else:
+                    response = self.session.post(url, params=params, headers=headers, data=body,
+                                                 timeout=self.timeout)
+                if response.status_code not in TRANSIENT_STATUS or attempt == self.retries:
+                    stats.record(perf_counter() - start)
+                    response.raise_for_status()
+                    return response
+            except TRANSIENT_ERRORS:
+                if attempt == self.retries:
+                    raise
+            stats.retries += 1
+            sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _query(self, query, default_graph=None, named_graph=None):
+        self._queries += 1
+        params = dict(self.kwargs.get('params', {}))
+        # A graph without a name is no use to the server
+        if default_graph is not None and not isinstance(default_graph, BNode):
+            params['default-graph-uri'] = default_graph
+        headers = {'Accept': _accept[self.returnFormat]}
+        if self.method == 'GET':
+            params['query'] = query
+            response = self._send('query', self.query_endpoint, params, headers, None)
+        elif self.method == 'POST_FORM':
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            response = self._send('query', self.query_endpoint, params, headers, urlencode({'query': query}))
+        else:
+            headers['Content-Type'] = 'application/sparql-query'
+            response = self._send('query', self.query_endpoint, params, headers, query)
+        return Result.parse(BytesIO(response.content), content_type=response.headers['Content-Type'].split(';')[0])
+
+    def _update(self, update):
+        self._updates += 1
+        headers = {'Accept': _accept[self.returnFormat],
+                   'Content-Type': 'application/sparql-update; charset=UTF-8'}
+        self._send('update', self.update_endpoint, dict(self.kwargs.get('params', {})), headers, update)
+
+    def close(self, commit_pending_transaction=False):
+        super().close(commit_pending_transaction)
+        self.session.close()
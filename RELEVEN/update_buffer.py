@@ -0,0 +1,145 @@
+from rdflib import Graph
+from rdflib.graph import ReadOnlyGraphAggregate
+from rdflib.plugins.stores.sparqlstore import SPARQLStore
+
+
+# A write-behind buffer for the STAR graph. Against a remote store every graph.add and graph.update is its
+# own HTTP request, so instead we collect the triples we want to insert in a local overlay graph, and write
+# them out in bulk once enough of them have accumulated. Until then, anything that needs to read what we
+# have written has to look in the overlay and in the graph together.
+
+
+def runs_sparql(store):
+    """Return true if the store evaluates SPARQL itself, rather than leaving it to rdflib. Oxigraph is
+    recognised by name, since it is an optional dependency; see local_store."""
+    return isinstance(store, SPARQLStore) or type(store).__name__ == 'OxigraphStore'
+
+
+def write_triples(graph, triples):
+    """Write the given triples to the graph in a single request: one SPARQL update for a remote store,
+    or one addN for a local graph."""
+    if isinstance(graph.store, SPARQLStore):
+        data = '\n'.join(f"{s.n3()} {p.n3()} {o.n3()} ." for s, p, o in triples)
+        graph.update("INSERT DATA {\n" + data + "\n}")
+    else:
+        graph.addN((s, p, o, graph) for s, p, o in triples)
+
+
+class UpdateBuffer:
+    """Collects the triples destined for the given graph and writes them in chunks, either when there
+    are max_triples of them or when flush_persons persons have been processed. If a sink is given, the
+    triples are written there instead of to the graph, which should be the sink's own copy of them."""
+
+    def __init__(self, graph, max_triples=10000, flush_persons=None, sink=None):
+        self.graph = graph
+        self.sink = sink
+        self.max_triples = max_triples
+        self.flush_persons = flush_persons
+        self.persons = 0
+        # Keep some statistics
+        self.flushes = 0
+        self.requests = 0
+        self.written = 0
+        self.pending = self._new_overlay()
+        # The pending triples as they were given to us, one list per call, so that a flush never splits
+        # up the triples of one pattern
+        self.groups = []
+        # Functions to call, with this buffer, once everything pending has been written
+        self.on_flush = []
+
+    def _new_overlay(self):
+        overlay = Graph()
+        for k, v in self.graph.namespaces():
+            overlay.bind(k, v, override=True)
+        return overlay
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, triple):
+        self._add_group([triple])
+
+    def addN(self, triples):  # noqa: N802
+        """Add all of the given triples"""
+        self._add_group(list(triples))
+
+    def insert(self, sparql):
+        """Add the triples in the given SPARQL data block, i.e. whatever goes inside INSERT DATA { }"""
+        group = self._new_overlay()
+        group.update("INSERT DATA {" + sparql + "}")
+        self._add_group(list(group))
+
+    def _add_group(self, triples):
+        for t in triples:
+            self.pending.add(t)
+        self.groups.append(triples)
+        if self.max_triples and len(self.pending) >= self.max_triples:
+            self.flush()
+
+    def end_person(self):
+        """Note that a person has been processed, and flush if it is time."""
+        self.persons += 1
+        if self.flush_persons and self.persons % self.flush_persons == 0:
+            self.flush()
+
+    def _chunks(self):
+        """Divide the pending triples into chunks of about max_triples, keeping each group whole"""
+        chunks = []
+        chunk = []
+        seen = set()
+        for group in self.groups:
+            group = [t for t in group if t not in seen]
+            if chunk and self.max_triples and len(chunk) + len(group) > self.max_triples:
+                chunks.append(chunk)
+                chunk = []
+            chunk.extend(group)
+            seen.update(group)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def flush(self):
+        """Write all pending triples to the graph, in chunks of about max_triples per request. The triples
+        are only dropped from the overlay once every chunk has been written, so a failed flush can simply be
+        tried again, and until then whatever was written is still found whole in the overlay."""
+        if not len(self.pending):
+            for callback in self.on_flush:
+                callback(self)
+            return
+        for chunk in self._chunks():
+            if self.sink is not None:
+                self.sink.write(chunk)
+            else:
+                write_triples(self.graph, chunk)
+            self.requests += 1
+        self.written += len(self.pending)
+        self.pending = self._new_overlay()
+        self.groups = []
+        self.flushes += 1
+        for callback in self.on_flush:
+            callback(self)
+
+    # Reading through the overlay
+    def query(self, sparql):
+        """Run a query over the pending triples and the graph together, so that a match may be made of
+        triples from both. A store that runs SPARQL itself can't see our pending triples, and would be
+        asked about each triple pattern separately if rdflib ran the query, so there we flush first."""
+        if not len(self.pending):
+            return self.graph.query(sparql)
+        if runs_sparql(self.graph.store):
+            self.flush()
+            return self.graph.query(sparql)
+        return self.overlay().query(sparql)
+
+    def overlay(self):
+        """Return a read-only view of the pending triples and the graph together, with the graph's prefixes"""
+        view = ReadOnlyGraphAggregate([self.pending, self.graph])
+        view.namespace_manager = self.graph.namespace_manager
+        return view
+
+    def value(self, subject, predicate):
+        """Return a value for the given subject and predicate, pending or written."""
+        v = self.pending.value(subject, predicate)
+        if v is None:
+            v = self.graph.value(subject, predicate)
+        return v
@@ -1,6 +1,8 @@
 ## MySQL access info. Replace uppercase strings as indicated
 passphrase = 'SQLPASSPHRASE'
 dbstring = '%s:%s@%s/%s' % ('SQLUSER', 'SQLHOST', 'SQLDB', passphrase)
+## Or, to use a local SQLite copy of a dump made with pbw_sqlite.py instead of the MySQL server:
+# dburl = 'sqlite:///data/pbw.sqlite'
 
 ## Neo4J access info. Include if necessary, replace uppercase strings as indicated
 graphuri = 'neo4j://%s:7687' % 'NEO4JHOST'
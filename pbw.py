@@ -1,10 +1,14 @@
 import re
 from sqlalchemy import Column, ForeignKey, Table  # DB components
 from sqlalchemy import DateTime, Integer, SmallInteger, String, Text  # Column types
-from sqlalchemy.orm import declarative_base, relationship, backref
+from sqlalchemy.orm import declarative_base, relationship, backref, configure_mappers, joinedload, selectinload
+from sqlalchemy.orm import defaultload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.associationproxy import association_proxy
 
 Base = declarative_base()
+# How a factoid description refers to one of the people associated with the factoid
+_persref = re.compile(r'<PERSREF ID="(\d+)"/>')
 
 
 # ## Simple key-value lookup tables
@@ -123,6 +127,12 @@ class Type(Base):
     typeName = Column(Text)
 
 
+# The simple lookup tables, which are small and never change, so that we can keep them in memory
+LOOKUP_CLASSES = [Accuracy, Bibliography, Collection, Country, DateTypes, DignityOfficeType, FactoidPersonType,
+                  FactoidType, Figure, KinshipType, LanguageSkill, Occupation, OrigLangAuth, Religion, SexAuth,
+                  Source, Type]
+
+
 # ## Slightly less simple key/value lookup tables
 class ActivityFactoid(Base):
     __tablename__ = 'ActivityFactoid'
@@ -561,14 +571,26 @@ class Factoid(Base):
     possession = association_proxy('possessionRecord', 'possessionName')
     narrativeUnit = association_proxy('_assoc_nunit', 'narrativeUnit')
 
+    def _parsed_description(self):
+        """Return the English description split up at its PERSREF tags, as a list alternating between text
+        and the fpKey of the person referred to, together with a dictionary of fpKey -> Person for the
+        people associated with this factoid. These are worked out once per factoid and then kept, unless
+        the description changes."""
+        cached = self.__dict__.get('_persref_cache')
+        if cached is None or cached[0] is not self.engDesc:
+            tokens = _persref.split(self.engDesc or '')
+            for i in range(1, len(tokens), 2):
+                tokens[i] = int(tokens[i])
+            persons = {pf.fpKey: pf.person for pf in self._assoc_persons}
+            cached = (self.engDesc, tokens, persons)
+            self.__dict__['_persref_cache'] = cached
+        return cached[1], cached[2]
+
     def associated_person(self, refKey):
         """Return the Person object for the given key, which comes out of a PERSREF
         in the factoid text.
         :param refKey: the associated key"""
-        for pf in self._assoc_persons:
-            if pf.fpKey == refKey:
-                return pf.person
-        return None
+        return self._parsed_description()[1].get(refKey)
 
     def main_person(self):
         """Return the Person objects for the primary person of this factoid.
@@ -585,23 +607,18 @@ class Factoid(Base):
             if pf.fpType == 'DescRef':
                 referent_objects.append(pf.person)
         if check_persref:
-            pattern = re.compile(r'<PERSREF ID="(\d+)"/>')
+            tokens, persons = self._parsed_description()
             persref_persons = set()
-            for fpid in pattern.findall(self.engDesc):
-                this_person = self.associated_person(int(fpid))
+            for fpid in tokens[1::2]:
+                this_person = persons.get(fpid)
                 if this_person is not None:
                     persref_persons.add(this_person)
             return [x for x in referent_objects if x in persref_persons]
         return referent_objects
 
-    def _persref_as_str(self, m):
-        p = self.associated_person(int(m.group(2)))
-        return str(p)
-
     def replace_referents(self):
-        desc = self.engDesc
-        pattern = re.compile(r'(<PERSREF ID="(\d+)"/>)')
-        return re.sub(pattern, self._persref_as_str, desc)
+        tokens, persons = self._parsed_description()
+        return ''.join(str(persons.get(t)) if i % 2 else t for i, t in enumerate(tokens))
 
 
 class FamilyName(Base):
@@ -684,18 +701,59 @@ class Person(Base):
     factoids = association_proxy('_person_factoids', 'factoid')
     collDBEntries = association_proxy('_assoc_colldb', 'collDB')
 
+    def _factoids_in_session(self, fptype):
+        """Return a query for the factoids, with their types, for which this person is a referent of
+        the given sort. This is one query, rather than one to load the person's links to factoids and
+        then more for each link. Returns None if the links are already loaded (as they are with
+        factoid_prefetch_options), or if there is no session to query; then they are sorted in memory."""
+        if '_person_factoids' in self.__dict__:
+            return None
+        session = object_session(self)
+        if session is None:
+            return None
+        return session.query(Factoid, FactoidType.typeName).join(
+            FactoidPerson, FactoidPerson.factoidKey == Factoid.factoidKey
+        ).join(
+            FactoidPersonType, FactoidPerson.fpTypeKey == FactoidPersonType.fpTypeKey
+        ).outerjoin(
+            FactoidType, Factoid.factoidTypeKey == FactoidType.factoidTypeKey
+        ).filter(
+            FactoidPerson.personKey == self.personKey, FactoidPersonType.fpTypeName == fptype
+        ).order_by(FactoidPerson.fpKey)
+
     def main_factoids(self, ftype=None):
         """Return the list of factoids for which this person is the primary referent.
         :param ftype: the factoid type
         """
+        q = self._factoids_in_session('Primary')
+        if q is not None:
+            if ftype is not None:
+                q = q.filter(FactoidType.typeName == ftype)
+            return [f for f, _ in q]
         main_set = [x.factoid for x in self._person_factoids if x.fpType == 'Primary']
         if ftype is not None:
             return [x for x in main_set if x.factoidType == ftype]
         else:
             return main_set
 
+    def main_factoids_by_type(self):
+        """Return a dictionary of the factoids for which this person is the primary referent, keyed
+        by factoid type."""
+        q = self._factoids_in_session('Primary')
+        if q is not None:
+            pairs = list(q)
+        else:
+            pairs = [(x.factoid, x.factoid.factoidType) for x in self._person_factoids if x.fpType == 'Primary']
+        grouped = dict()
+        for f, ftype in pairs:
+            grouped.setdefault(ftype, []).append(f)
+        return grouped
+
     def ref_factoids(self):
         """Return the list of factoids for which this person is a secondary referent."""
+        q = self._factoids_in_session('DescRef')
+        if q is not None:
+            return [f for f, _ in q]
         return [x.factoid for x in self._person_factoids if x.fpType == 'DescRef']
 
     def may_also_be(self):
@@ -724,3 +782,72 @@ class VariantName(Base):
     # Direct foreign key associations
     _oLangVal = relationship('OrigLangAuth')
     origLang = association_proxy('_oLangVal', 'oLanguage')
+
+
+# ## Lookup cache
+def cache_lookups(session, classes=LOOKUP_CLASSES):
+    """Load every row of the given lookup tables into the session, and keep hold of them for as long as
+    the session lasts. Many-to-one relationships into these tables, and the association proxies built on
+    them such as Factoid.source or Person.sex, are then answered from the session's identity map without
+    any SQL. Committing or rolling back the session expires everything in it, these included, so call
+    this again after that. Returns the number of rows cached."""
+    rows = []
+    for cls in classes:
+        rows.extend(session.query(cls).all())
+    session.info['pbw_lookups'] = rows
+    return len(rows)
+
+
+def has_cached_lookups(session):
+    """Return true if cache_lookups has been called on the given session"""
+    return 'pbw_lookups' in session.info
+
+
+# ## Loader options
+def factoid_prefetch_options(cached_lookups=False):
+    """Return the loader options for a Person query that load each person's factoids along with
+    everything hanging off them that the STAR import reads, in a fixed number of selectin queries
+    rather than one query per relationship per factoid. If the session has its lookup tables cached
+    (see cache_lookups), the relationships into them are left to find their objects there."""
+    # The backref attributes only exist once the mappers are configured
+    configure_mappers()
+    lookup = defaultload if cached_lookups else selectinload
+    factoid_options = [
+        lookup(Factoid._sourceVal),
+        lookup(Factoid._fTypeVal),
+        selectinload(Factoid._assoc_persons).options(lookup(FactoidPerson._fpType)),
+        selectinload(Factoid.boulloterion).options(
+            selectinload(Boulloterion.publication).options(lookup(Published.bibSource)),
+            selectinload(Boulloterion.seals).options(lookup(Seal.collection))),
+        selectinload(Factoid.deathRecord),
+        selectinload(Factoid.ethnicityInfo).selectinload(EthnicityFactoid.ethnicity),
+        selectinload(Factoid.locationInfo).selectinload(FactoidLocation.location),
+        selectinload(Factoid._assoc_dignity).selectinload(DignityFactoid.dignity),
+        selectinload(Factoid.possessionRecord),
+        selectinload(Factoid.kinshipType),
+        selectinload(Factoid.secondName),
+        selectinload(Factoid._langSkillInfo),
+        selectinload(Factoid._occInfo),
+        selectinload(Factoid._relInfo),
+    ]
+    return [
+        lookup(Person._sexValue),
+        selectinload(Person._person_factoids).options(
+            lookup(FactoidPerson._fpType),
+            joinedload(FactoidPerson.factoid).options(*factoid_options))
+    ]
+
+
+def prefetch_referents(session, factoids, chunksize=1000):
+    """Load the people associated with each of the given factoids, so that their PERSREF references can be
+    resolved without any further queries. This is one query per chunksize factoids, rather than one or two
+    per factoid."""
+    pending = [f for f in factoids if '_assoc_persons' not in f.__dict__]
+    for i in range(0, len(pending), chunksize):
+        chunk = {f.factoidKey: f for f in pending[i:i+chunksize]}
+        links = {k: [] for k in chunk}
+        for fp in session.query(FactoidPerson).filter(FactoidPerson.factoidKey.in_(chunk.keys())).options(
+                joinedload(FactoidPerson._fpType)).order_by(FactoidPerson.fpKey):
+            links[fp.factoidKey].append(fp)
+        for k, f in chunk.items():
+            set_committed_value(f, '_assoc_persons', links[k])
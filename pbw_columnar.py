@@ -0,0 +1,161 @@
+import argparse
+import os
+import pbw
+from importlib import import_module
+from sqlalchemy import DateTime, Integer, SmallInteger, create_engine, inspect, select
+from time import perf_counter
+
+# Export the PBW database to Parquet files, one per table plus a few denormalised views, so that checks
+# over the whole database can work on columns of values rather than on millions of ORM objects. The tables
+# and their column types come from the mappings in pbw.py. The files are read back with ColumnarReader,
+# which gives pyarrow tables; pyarrow.compute then works on whole columns at once.
+#
+# Nothing else here needs pyarrow, so it is only imported when an export or a reader is asked for.
+
+
+def _pyarrow():
+    """Import and return pyarrow and its parquet module"""
+    try:
+        return import_module('pyarrow'), import_module('pyarrow.parquet')
+    except ImportError as e:
+        raise ImportError("The columnar export needs the pyarrow package to be installed") from e
+
+
+def _views():
+    """Return the denormalised views we export alongside the tables, as a dictionary of name -> select"""
+    person = pbw.Person.__table__
+    factoid = pbw.Factoid.__table__
+    fp = pbw.FactoidPerson.__table__
+    fptype = pbw.FactoidPersonType.__table__
+    ftype = pbw.FactoidType.__table__
+    source = pbw.Source.__table__
+    olang = pbw.OrigLangAuth.__table__
+    # Every factoid with its type, source and original language spelled out
+    factoid_type = select(
+        factoid.c.factoidKey, factoid.c.factoidTypeKey, ftype.c.typeName.label('factoidType'),
+        factoid.c.sourceKey, source.c.sourceID.label('source'), factoid.c.sourceRef,
+        olang.c.oLanguage.label('origLang'), factoid.c.engDesc, factoid.c.origLDesc
+    ).select_from(
+        factoid.outerjoin(ftype, factoid.c.factoidTypeKey == ftype.c.factoidTypeKey)
+               .outerjoin(source, factoid.c.sourceKey == source.c.sourceKey)
+               .outerjoin(olang, factoid.c.oLangKey == olang.c.oLangKey)
+    ).order_by(factoid.c.factoidKey)
+    # Every link between a person and a factoid, with the person, factoid and source spelled out
+    person_factoid = select(
+        fp.c.fpKey, person.c.personKey, person.c.name, person.c.mdbCode, person.c.floruit,
+        fptype.c.fpTypeName.label('fpType'), factoid.c.factoidKey, ftype.c.typeName.label('factoidType'),
+        factoid.c.sourceKey, source.c.sourceID.label('source'), factoid.c.sourceRef
+    ).select_from(
+        fp.join(person, fp.c.personKey == person.c.personKey)
+          .join(factoid, fp.c.factoidKey == factoid.c.factoidKey)
+          .outerjoin(fptype, fp.c.fpTypeKey == fptype.c.fpTypeKey)
+          .outerjoin(ftype, factoid.c.factoidTypeKey == ftype.c.factoidTypeKey)
+          .outerjoin(source, factoid.c.sourceKey == source.c.sourceKey)
+    ).order_by(fp.c.fpKey)
+    return {'factoid_type': factoid_type, 'person_factoid': person_factoid}
+
+
+def _arrow_type(pa, sqltype):
+    """Return the Arrow type for the given SQLAlchemy column type"""
+    if isinstance(sqltype, SmallInteger):
+        return pa.int16()
+    if isinstance(sqltype, Integer):
+        return pa.int64()
+    if isinstance(sqltype, DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def _arrow_column(pa, values, arrowtype):
+    """Make an Arrow array of the given type from a list of values. A few of the mappings declare a
+    string for what the database has as a number, so we convert those if we have to."""
+    try:
+        return pa.array(values, type=arrowtype)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if arrowtype != pa.string():
+            raise
+        return pa.array([v if v is None or isinstance(v, str) else str(v) for v in values], type=arrowtype)
+
+
+def _write(conn, statement, path, compression, batch_rows):
+    """Run the given select and write its results to a Parquet file at the given path, batch_rows rows
+    at a time. The file is only put in place once it is complete. Returns the number of rows written."""
+    pa, pq = _pyarrow()
+    schema = pa.schema([(c.name, _arrow_type(pa, c.type)) for c in statement.selected_columns])
+    rows = 0
+    tmp = path + '.tmp'
+    with pq.ParquetWriter(tmp, schema, compression=compression) as writer:
+        result = conn.execution_options(stream_results=True).execute(statement)
+        for batch in result.partitions(batch_rows):
+            columns = [_arrow_column(pa, list(values), field.type) for values, field in zip(zip(*batch), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+            rows += len(batch)
+    os.replace(tmp, path)
+    return rows
+
+
+def export_columnar(engine, outdir, compression='zstd', batch_rows=100000, tables=None, verbose=False):
+    """Export the given tables (or all of the tables mapped in pbw.py, and the denormalised views) from
+    the database behind the given engine into Parquet files in outdir, one per table or view. Tables that
+    are mapped but missing from the database are skipped. Returns a dictionary of name -> row count."""
+    os.makedirs(outdir, exist_ok=True)
+    present = set(inspect(engine).get_table_names())
+    statements = {name: select(t) for name, t in pbw.Base.metadata.tables.items() if name in present}
+    statements.update(_views())
+    if tables is not None:
+        statements = {k: v for k, v in statements.items() if k in tables}
+    counts = {}
+    with engine.connect() as conn:
+        for name, statement in statements.items():
+            start = perf_counter()
+            counts[name] = _write(conn, statement, os.path.join(outdir, name + '.parquet'), compression,
+                                  batch_rows)
+            if verbose:
+                print(f"Exported {counts[name]} rows of {name} in {perf_counter() - start:.1f}s")
+    return counts
+
+
+class ColumnarReader:
+    """Gives access to a columnar export of the PBW database. Each table or view is read as a
+    pyarrow.Table, memory-mapped from its file, and only the columns asked for are read at all."""
+
+    def __init__(self, directory):
+        self.pa, self.pq = _pyarrow()
+        self.directory = directory
+        self.tables = sorted(f[:-8] for f in os.listdir(directory) if f.endswith('.parquet'))
+
+    def _path(self, name):
+        if name not in self.tables:
+            raise KeyError(f"No table or view {name} in {self.directory}")
+        return os.path.join(self.directory, name + '.parquet')
+
+    def read(self, name, columns=None, filters=None):
+        """Return the given columns (or all of them) of the named table or view as a pyarrow.Table,
+        restricted to the rows that match the given filters, in the form that pyarrow.parquet takes."""
+        return self.pq.read_table(self._path(name), columns=columns, filters=filters, memory_map=True)
+
+    def column(self, name, column):
+        """Return the given column of the named table or view as a pyarrow.ChunkedArray"""
+        return self.read(name, columns=[column]).column(column)
+
+    def schema(self, name):
+        """Return the schema of the named table or view, without reading any of its rows"""
+        return self.pq.read_schema(self._path(name))
+
+    def __getitem__(self, name):
+        return self.read(name)
+
+
+if __name__ == '__main__':
+    import pbw_sqlite
+    parser = argparse.ArgumentParser(
+        prog="pbw_columnar",
+        description="Export the PBW database to a directory of Parquet files"
+    )
+    parser.add_argument('outdir', help="The directory to write the files to")
+    parser.add_argument('-d', '--database', help="The SQLAlchemy URL of the database, if not the one in config.py")
+    parser.add_argument('-c', '--compression', default='zstd', help="The Parquet compression codec to use")
+    parser.add_argument('-t', '--table', action='append', help="Export only this table or view (repeatable)")
+    args = parser.parse_args()
+    export_columnar(create_engine(args.database or pbw_sqlite.db_url()), args.outdir,
+                    compression=args.compression, tables=args.table, verbose=True)
@@ -0,0 +1,251 @@
+import argparse
+import re
+import sqlite3
+from time import perf_counter
+
+# Load a MySQL dump of the PBW database, such as the ones in data/, into an SQLite file, so that the pbw
+# module can be used without a MySQL server. The dump is read one statement at a time; the table
+# definitions are translated into something SQLite will take, and the rows are parsed out of the
+# extended INSERT statements and bulk-inserted in large transactions. Once everything is loaded, we index
+# the dump's own keys and every foreign key that pbw.py declares, since those are what the ORM joins on.
+#
+# The result can be opened with SQLAlchemy as sqlite:///path/to/file; set config.dburl to that to have
+# the importer and the tests use it.
+
+# MySQL integer types, which become INTEGER so that a primary key on one of them is the rowid
+_int_type = re.compile(r'\b(?:tiny|small|medium|big)?int(?:eger)?(?:\(\d+\))?', re.I)
+# MySQL types that SQLite has no sense of
+_enum_type = re.compile(r"\b(?:enum|set)\((?:'(?:[^'\\]|\\.|'')*',?)*\)", re.I)
+# Column attributes that SQLite does not understand, and has no use for
+_mysql_attrs = re.compile(r"\s+(?:unsigned|zerofill|auto_increment|character set \w+|charset \w+|collate \w+|"
+                          r"on update current_timestamp(?:\(\))?|comment '(?:[^'\\]|\\.|'')*')", re.I)
+# The text types, whose comparisons are case insensitive in MySQL unless their collation is binary
+_text_type = re.compile(r'^(?:var)?char|^(?:tiny|medium|long)?text|^enum|^set', re.I)
+# The column list of a key, possibly with prefix lengths that SQLite does not support
+_key_columns = re.compile(r'\((.*)\)')
+
+# One value in a VALUES list: a quoted string, NULL, a number, or a hex literal
+_value = re.compile(r"""\s*(?:'([^'\\]*(?:(?:\\.|'')[^'\\]*)*)'|(NULL)|(0x[0-9A-Fa-f]+)|([-+]?[0-9.][0-9.eE+-]*))\s*""")
+_escape = re.compile(r"\\(.)|''", re.S)
+_escapes = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a', '%': '\\%', '_': '\\_'}
+_insert = re.compile(r'INSERT(?:\s+IGNORE)?\s+INTO\s+`?(\w+)`?\s*(?:\(([^)]*)\))?\s*VALUES\s*', re.I)
+# MySQL's way of saying that a date is unknown, which neither SQLite nor SQLAlchemy can make sense of
+_zero_dates = {'0000-00-00', '0000-00-00 00:00:00'}
+
+
+def _unescape(match):
+    c = match.group(1)
+    if c is None:
+        return "'"
+    return _escapes.get(c, c)
+
+
+def parse_values(text, start=0):
+    """Parse the rows out of the VALUES list of a MySQL INSERT statement, starting at the given position,
+    and yield each of them as a tuple."""
+    pos = start
+    end = len(text)
+    while pos < end:
+        # Find the start of the next row
+        while pos < end and text[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= end or text[pos] == ';':
+            return
+        if text[pos] != '(':
+            raise ValueError(f"Expected a row at position {pos}: {text[pos:pos+40]}")
+        pos += 1
+        row = []
+        while True:
+            m = _value.match(text, pos)
+            if m is None:
+                raise ValueError(f"Could not parse a value at position {pos}: {text[pos:pos+40]}")
+            string, null, hexval, number = m.groups()
+            if string is not None:
+                if '\\' in string or "''" in string:
+                    string = _escape.sub(_unescape, string)
+                row.append(None if string in _zero_dates else string)
+            elif null is not None:
+                row.append(None)
+            elif hexval is not None:
+                row.append(bytes.fromhex(hexval[2:]))
+            else:
+                # Let the column's type affinity decide what the number becomes
+                row.append(number)
+            pos = m.end()
+            if text[pos] == ',':
+                pos += 1
+            elif text[pos] == ')':
+                pos += 1
+                break
+            else:
+                raise ValueError(f"Unexpected character at position {pos}: {text[pos:pos+40]}")
+        yield tuple(row)
+
+
+def _column_names(keyspec):
+    """Return the column names in a key definition, without backticks or prefix lengths"""
+    cols = _key_columns.search(keyspec).group(1)
+    return [re.sub(r'\(\d+\)', '', c).strip(' `') for c in cols.split(',')]
+
+
+def translate_create(statement):
+    """Translate a MySQL CREATE TABLE statement into SQLite. Return the table name, the translated
+    statement, and a list of the (name, columns) of the keys that should be made into indexes."""
+    header, body = statement.split('(', 1)
+    table = header.split()[-1].strip('`')
+    body, options = body.rsplit(')', 1)
+    # Text comparisons follow the table's collation unless the column says otherwise
+    m = re.search(r'COLLATE\s*=?\s*(\w+)', options, re.I)
+    table_ci = not (m and m.group(1).lower().endswith('_bin'))
+    columns = []
+    indexes = []
+    for line in body.split('\n'):
+        line = line.strip().rstrip(',')
+        if not line:
+            continue
+        upper = line.upper()
+        if upper.startswith('PRIMARY KEY'):
+            columns.append('PRIMARY KEY (%s)' % ', '.join(f'`{c}`' for c in _column_names(line)))
+        elif upper.startswith('UNIQUE'):
+            columns.append('UNIQUE (%s)' % ', '.join(f'`{c}`' for c in _column_names(line)))
+        elif upper.startswith(('KEY', 'INDEX')):
+            name = line.split()[1].strip('`')
+            indexes.append((name, _column_names(line)))
+        elif upper.startswith(('FULLTEXT', 'SPATIAL', 'CONSTRAINT', 'FOREIGN KEY', 'CHECK')):
+            # SQLite can do nothing for us with these; the foreign keys are indexed below
+            continue
+        else:
+            name, coltype = line.split(None, 1)
+            collation = re.search(r'\bCOLLATE\s+(\w+)', coltype, re.I)
+            ci = not collation.group(1).lower().endswith('_bin') if collation else table_ci
+            coltype = _enum_type.sub('TEXT', coltype)
+            coltype = _int_type.sub('INTEGER', coltype, count=1)
+            coltype = _mysql_attrs.sub('', coltype)
+            if ci and _text_type.match(coltype):
+                coltype += ' COLLATE NOCASE'
+            columns.append(f'{name} {coltype}')
+    return table, 'CREATE TABLE `%s` (\n  %s\n)' % (table, ',\n  '.join(columns)), indexes
+
+
+def read_statements(path, encoding='utf-8'):
+    """Yield the SQL statements in the given dump file, one at a time, without comments. This relies on
+    the dump being written as mysqldump writes it, i.e. with one statement per line save for the table
+    definitions, and with newlines in the data escaped."""
+    with open(path, encoding=encoding) as f:
+        statement = []
+        for line in f:
+            if not statement and (line.startswith('--') or not line.strip()):
+                continue
+            statement.append(line)
+            if line.rstrip().endswith(';'):
+                yield ''.join(statement).strip()
+                statement = []
+        if statement:
+            yield ''.join(statement).strip()
+
+
+def load_dump(dumpfile, dbfile, batch_rows=200000, encoding='utf-8', verbose=False):
+    """Load the given MySQL dump file into the given SQLite database file, committing every batch_rows
+    rows, and index its keys. Any tables in the database that the dump also defines are replaced.
+    Returns a dictionary of how many rows went into each table."""
+    start = perf_counter()
+    db = sqlite3.connect(dbfile, isolation_level=None)
+    # We can always load the dump again, so we trade safety for speed while we are doing it
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA cache_size = -200000')
+    counts = {}
+    indexes = []
+    pending = 0
+    db.execute('BEGIN')
+    for statement in read_statements(dumpfile, encoding):
+        upper = statement[:30].upper()
+        if upper.startswith('INSERT'):
+            m = _insert.match(statement)
+            table, collist = m.groups()
+            rows = parse_values(statement, m.end())
+            first = next(rows, None)
+            if first is None:
+                continue
+            target = f'`{table}`'
+            if collist:
+                target += f' ({collist})'
+            sql = f"INSERT INTO {target} VALUES ({', '.join('?' * len(first))})"
+            cursor = db.executemany(sql, _chain(first, rows))
+            counts[table] = counts.get(table, 0) + cursor.rowcount
+            pending += cursor.rowcount
+            if pending >= batch_rows:
+                db.execute('COMMIT')
+                db.execute('BEGIN')
+                pending = 0
+        elif upper.startswith('CREATE TABLE'):
+            table, ddl, keys = translate_create(statement)
+            db.execute(ddl)
+            counts.setdefault(table, 0)
+            indexes.extend((table, name, cols) for name, cols in keys)
+        elif upper.startswith('DROP TABLE'):
+            db.execute(statement.rstrip(';'))
+        # Everything else - SET, LOCK TABLES, the /*! */ directives - is for MySQL's benefit only
+    db.execute('COMMIT')
+    if verbose:
+        print(f"Loaded {sum(counts.values())} rows into {len(counts)} tables in {perf_counter() - start:.1f}s")
+    created = create_indexes(db, indexes, set(counts))
+    if verbose:
+        print(f"Created {created} indexes; {perf_counter() - start:.1f}s in all")
+    db.execute('ANALYZE')
+    db.close()
+    return counts
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def orm_foreign_keys():
+    """Return a list of (table, column) for every foreign key column declared in pbw.py"""
+    import pbw
+    return [(table.name, col.name) for table in pbw.Base.metadata.tables.values()
+            for col in table.columns if col.foreign_keys]
+
+
+def create_indexes(db, keys, tables):
+    """Create the given (table, name, columns) indexes from the dump, and an index on every foreign key
+    column in pbw.py that none of these already covers, for those of the given tables that exist.
+    Returns the number of indexes created."""
+    covered = set()
+    created = 0
+    for table, name, cols in keys:
+        db.execute('CREATE INDEX IF NOT EXISTS `%s_%s` ON `%s` (%s)'
+                   % (table, name, table, ', '.join(f'`{c}`' for c in cols)))
+        covered.add((table, cols[0]))
+        created += 1
+    for table, col in orm_foreign_keys():
+        if table in tables and (table, col) not in covered:
+            db.execute(f'CREATE INDEX IF NOT EXISTS `{table}_{col}` ON `{table}` (`{col}`)')
+            covered.add((table, col))
+            created += 1
+    return created
+
+
+def db_url(driver='mysqlconnector'):
+    """Return the SQLAlchemy URL of the PBW database given in config.py: its dburl if it has one, which
+    might be an SQLite file made with this module, or else the MySQL server in its dbstring, to be reached
+    with the given driver."""
+    import config
+    url = getattr(config, 'dburl', None)
+    return url if url else f'mysql+{driver}://' + config.dbstring
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="pbw_sqlite",
+        description="Load a MySQL dump of the PBW database into an SQLite file"
+    )
+    parser.add_argument('dump', help="The MySQL dump file, e.g. data/liv-14-june-2017-utf8.sql")
+    parser.add_argument('database', help="The SQLite file to load it into")
+    parser.add_argument('-b', '--batch-rows', type=int, default=200000,
+                        help="How many rows to insert in each transaction")
+    parser.add_argument('-e', '--encoding', default='utf-8', help="The character encoding of the dump")
+    args = parser.parse_args()
+    load_dump(args.dump, args.database, batch_rows=args.batch_rows, encoding=args.encoding, verbose=True)
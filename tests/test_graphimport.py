@@ -3,7 +3,8 @@ import re
 import unittest
 from collections import Counter, defaultdict
 from functools import reduce
-from rdflib import RDF, Literal
+from rdflib import RDF, RDFS, Literal
+from rdflib.compare import isomorphic
 from rdflib.exceptions import UniquenessError
 from rdflib.plugins.stores import sparqlstore
 from RELEVEN import PBWstarConstants, graphimportSTAR
@@ -1428,5 +1429,36 @@ select (count(?r) as ?numrdg) where {{
             self.assertTrue(triple in gimport.g, f"Triple {triple} exists in both graphs")
 
 
+    def test_parallel(self):
+        """If we import the test people in chunks, the way the workers do, and merge what the chunks
+        staged, we should get the same graph as from a serial import."""
+        if config.dbmode == 'prod':
+            self.skipTest("skipping data regeneration test for production")
+        execution = 'test-parallel-run'
+        try:
+            serial = graphimportSTAR.graphimportSTAR(origgraph=None, testmode=True, execution=execution,
+                                                     deterministic=True)
+            serial.process_persons(finish=False)
+        except DatabaseError:
+            self.skipTest("Cannot run data regeneration test without a MySQL connection.")
+        # Work on the chunks here rather than in a pool, so that we can see what each of them does
+        parallel = graphimportSTAR.graphimportSTAR(origgraph=None, testmode=True, execution=execution,
+                                                   deterministic=True)
+        processed, _, _ = parallel.process_persons_parallel(0, chunksize=4, finish=False)
+        self.assertGreater(processed, 4, "The test people take more than one chunk")
+        self.assertTrue(isomorphic(serial.g, parallel.g), "Merged chunks make the same graph as a serial import")
+        # Author groups and bibliographies are made of members that other chunks may have made already
+        for cls in ('E74A', 'E73B'):
+            groups = {g: set(serial.g.objects(g, RDFS.label))
+                      for g in serial.g.subjects(RDF.type, serial.constants.entitylabels[cls])}
+            self.assertTrue(groups, f"There are groups of class {cls}")
+            for g, labels in groups.items():
+                self.assertSetEqual(labels, set(parallel.g.objects(g, RDFS.label)), f"Group {g} has the same labels")
+                for label in labels:
+                    self.assertNotIn('XX ANON', label, f"Group {g} knows all its members")
+        serial.close()
+        parallel.close()
+
+
 if __name__ == '__main__':
     unittest.main()
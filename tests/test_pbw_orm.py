@@ -1,8 +1,8 @@
 # coding=utf-8
 import unittest
 import pbw
-import config
-from sqlalchemy import create_engine
+import pbw_sqlite
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
 
@@ -11,8 +11,8 @@ class TestConnections(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        engine = create_engine('mysql+mysqlconnector://' + config.dbstring)
-        smaker = sessionmaker(bind=engine)
+        cls.engine = create_engine(pbw_sqlite.db_url())
+        smaker = sessionmaker(bind=cls.engine)
         cls.session = smaker()
 
     def lookup_person(self, name, num):
@@ -49,6 +49,36 @@ class TestConnections(unittest.TestCase):
                   'Religion', 'Eunuchs', 'Alternative Name', 'Uncertain Ident']:
             self.assertListEqual([], alexios1.main_factoids(t))
         self.assertIsNone(alexios1.may_also_be())
+        # The grouped variant agrees with the per-type lookups
+        grouped = alexios1.main_factoids_by_type()
+        self.assertEqual(1999, sum(len(x) for x in grouped.values()))
+        for t in ['Narrative', 'Authorship', 'Death', 'Description', 'Dignity/Office', 'Second Name', 'Kinship',
+                  'Location', 'Possession']:
+            self.assertListEqual(alexios1.main_factoids(t), grouped[t])
+
+    def test_cached_lookups(self):
+        session = sessionmaker(bind=self.engine)()
+        self.assertGreater(pbw.cache_lookups(session), 0)
+        self.assertTrue(pbw.has_cached_lookups(session))
+        alexios = session.query(pbw.Person).filter_by(name='Alexios', mdbCode=1).scalar()
+        links = alexios._person_factoids
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            # None of the lookups behind these proxies should go to the database
+            self.assertEqual('Male', alexios.sex)
+            self.assertEqual('Greek', alexios.origLang)
+            types = {fp.fpType for fp in links}
+            for fp in links:
+                fp.factoid.source, fp.factoid.factoidType, fp.factoid.origLang
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count)
+            session.close()
+        self.assertEqual({'Primary', 'DescRef'}, types)
+        self.assertEqual([], statements)
 
     def test_alter_ego(self):
         person = self.lookup_person('Niketas', 20214)
@@ -208,6 +238,31 @@ class TestConnections(unittest.TestCase):
         for p in boull.publication:
             self.assertEqual(p.publicationRef, expected_pubs[p.bibSource.shortName])
 
+    def test_prefetch(self):
+        # Once the person is loaded with the prefetch options, the factoid handling should need no more queries
+        session = sessionmaker(bind=self.engine)()
+        statements = []
+
+        def listener(*args):
+            statements.append(args[2])
+        event.listen(self.engine, 'before_cursor_execute', listener)
+        try:
+            alexios5 = session.query(pbw.Person).filter_by(name='Alexios', mdbCode=5).options(
+                *pbw.factoid_prefetch_options()).scalar()
+            prefetch_count = len(statements)
+            self.assertEqual(alexios5.sex, 'Male')
+            for f in alexios5.main_factoids():
+                (f.source, f.factoidType, f.main_person(), f.deathRecord, f.ethnicityInfo, f.kinshipType,
+                 f.dignityOffice, f.secondName, f.religion, f.occupation, f.languageSkill, f.possession)
+                if f.locationInfo is not None:
+                    self.assertIsNotNone(f.locationInfo.location)
+                if f.boulloterion is not None:
+                    [(p.bibSource, s.collection) for p in f.boulloterion.publication for s in f.boulloterion.seals]
+            self.assertEqual(prefetch_count, len(statements))
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', listener)
+            session.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,317 @@
+# coding=utf-8
+import os
+import sqlite3
+import unittest
+import pbw
+import pbw_columnar
+import pbw_sqlite
+from importlib.util import find_spec
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from tempfile import TemporaryDirectory
+
+# A small dump in the form that mysqldump writes, with a few of the PBW tables in it
+DUMP = r"""-- MySQL dump 10.13  Distrib 5.7.18, for Linux (x86_64)
+--
+-- Host: localhost    Database: pbw
+-- ------------------------------------------------------
+
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET NAMES utf8 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+
+--
+-- Table structure for table `Person`
+--
+
+DROP TABLE IF EXISTS `Person`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `Person` (
+  `personKey` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `name` varchar(255) CHARACTER SET utf8 DEFAULT NULL,
+  `nameOL` varchar(255) DEFAULT NULL COMMENT 'The name, in the original language',
+  `mdbCode` int(11) DEFAULT NULL,
+  `descName` varchar(255) DEFAULT NULL,
+  `sexKey` tinyint(4) DEFAULT NULL,
+  `oLangKey` int(11) DEFAULT NULL,
+  `floruit` varchar(50) DEFAULT NULL,
+  `firstDate` smallint(6) DEFAULT NULL,
+  `firstDateType` int(11) DEFAULT NULL,
+  `lastDate` smallint(6) DEFAULT NULL,
+  `lastDateType` int(11) DEFAULT NULL,
+  `bibliography` mediumtext,
+  `notes` text,
+  `creationDate` datetime DEFAULT NULL,
+  `tstamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`personKey`),
+  KEY `name` (`name`(20),`mdbCode`)
+) ENGINE=MyISAM AUTO_INCREMENT=4 DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+LOCK TABLES `Person` WRITE;
+/*!40000 ALTER TABLE `Person` DISABLE KEYS */;
+INSERT INTO `Person` VALUES (1,'Alexios','Ἀλέξιος',1,'Alexios I Komnenos, emperor',2,2,'E/L 11',1081,NULL,1118,NULL,'','He said \"it\'s\" a\nnew line','2002-01-01 00:00:00','2017-06-14 10:00:00'),(2,'Anna','Ἄννα',62,'Anna Komnene',3,2,'',NULL,NULL,NULL,NULL,NULL,NULL,'0000-00-00 00:00:00','2017-06-14 10:00:00'),(3,'Eirene','Εἰρήνη',61,'Eirene Doukaina',3,2,'',NULL,NULL,NULL,NULL,NULL,'50% of \\ it','2002-01-01 00:00:00','2017-06-14 10:00:00');
+/*!40000 ALTER TABLE `Person` ENABLE KEYS */;
+UNLOCK TABLES;
+
+DROP TABLE IF EXISTS `SexAuth`;
+CREATE TABLE `SexAuth` (
+  `sexKey` tinyint(4) NOT NULL,
+  `sexValue` enum('Male','Female','Eunuch','(Unspecified)') COLLATE utf8_bin NOT NULL,
+  PRIMARY KEY (`sexKey`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_general_ci;
+INSERT INTO `SexAuth` VALUES (2,'Male'),(3,'Female');
+
+DROP TABLE IF EXISTS `FactoidType`;
+CREATE TABLE `FactoidType` (
+  `factoidTypeKey` int(11) NOT NULL,
+  `typeName` varchar(50) NOT NULL,
+  PRIMARY KEY (`factoidTypeKey`),
+  UNIQUE KEY `typeName` (`typeName`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `FactoidType` VALUES (1,'Narrative'),(2,'Death');
+
+DROP TABLE IF EXISTS `FactoidPersonType`;
+CREATE TABLE `FactoidPersonType` (
+  `fpTypeKey` int(11) NOT NULL,
+  `fpTypeName` varchar(20) NOT NULL,
+  PRIMARY KEY (`fpTypeKey`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `FactoidPersonType` VALUES (2,'Primary'),(3,'DescRef');
+
+DROP TABLE IF EXISTS `Source`;
+CREATE TABLE `Source` (
+  `sourceKey` smallint(6) NOT NULL AUTO_INCREMENT,
+  `sourceID` varchar(255) DEFAULT NULL,
+  `sourceBib` text,
+  PRIMARY KEY (`sourceKey`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `Source` VALUES (1,'Anna Komnene','Annae Comnenae Alexias'),(2,'Zonaras',NULL);
+
+DROP TABLE IF EXISTS `OrigLangAuth`;
+CREATE TABLE `OrigLangAuth` (
+  `oLangKey` int(11) NOT NULL,
+  `oLanguage` varchar(20) NOT NULL,
+  PRIMARY KEY (`oLangKey`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `OrigLangAuth` VALUES (2,'Greek');
+
+DROP TABLE IF EXISTS `Factoid`;
+CREATE TABLE `Factoid` (
+  `factoidKey` int(11) NOT NULL AUTO_INCREMENT,
+  `sourceKey` smallint(6) DEFAULT NULL,
+  `sourceRef` varchar(255) DEFAULT NULL,
+  `factoidTypeKey` int(11) DEFAULT NULL,
+  `oLangKey` int(11) DEFAULT NULL,
+  `collDBKey` smallint(6) DEFAULT NULL,
+  `boulloterionKey` int(11) DEFAULT NULL,
+  `engDesc` text,
+  `origLDesc` text,
+  `notes` text,
+  `needsAttn` tinyint(1) DEFAULT '0',
+  `creationDate` datetime DEFAULT NULL,
+  `tstamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`factoidKey`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `Factoid` VALUES (10,1,'1.1',1,2,NULL,NULL,'<PERSREF ID=\"1\"/> married <PERSREF ID=\"2\"/>',NULL,NULL,0,NULL,'2017-06-14 10:00:00'),(11,2,'15.11',2,2,NULL,NULL,'Alexios died',NULL,NULL,0,NULL,'2017-06-14 10:00:00');
+INSERT INTO `Factoid` VALUES (12,1,'P.3',1,2,NULL,NULL,'Anna wrote',NULL,NULL,0,NULL,'2017-06-14 10:00:00');
+
+DROP TABLE IF EXISTS `FactoidPerson`;
+CREATE TABLE `FactoidPerson` (
+  `fpKey` int(11) NOT NULL AUTO_INCREMENT,
+  `factoidKey` int(11) NOT NULL,
+  `personKey` int(11) NOT NULL,
+  `fpTypeKey` int(11) NOT NULL,
+  PRIMARY KEY (`fpKey`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `FactoidPerson` VALUES (1,10,1,2),(2,10,3,3),(3,11,1,2),(4,12,2,2),(5,12,1,3);
+/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
+
+-- Dump completed on 2017-06-14 10:00:00
+"""
+
+
+class TestSQLiteLoad(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = TemporaryDirectory()
+        dump = os.path.join(cls.tmpdir.name, 'pbw.sql')
+        with open(dump, 'w', encoding='utf-8') as f:
+            f.write(DUMP)
+        cls.dbfile = os.path.join(cls.tmpdir.name, 'pbw.sqlite')
+        # Load in tiny batches, so that we go through more than one transaction
+        cls.counts = pbw_sqlite.load_dump(dump, cls.dbfile, batch_rows=2)
+        cls.engine = create_engine('sqlite:///' + cls.dbfile)
+        cls.session = sessionmaker(bind=cls.engine)()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        cls.engine.dispose()
+        cls.tmpdir.cleanup()
+
+    def test_counts(self):
+        self.assertEqual({'Person': 3, 'SexAuth': 2, 'FactoidType': 2, 'FactoidPersonType': 2, 'Source': 2,
+                          'OrigLangAuth': 1, 'Factoid': 3, 'FactoidPerson': 5}, self.counts)
+
+    def test_values(self):
+        db = sqlite3.connect(self.dbfile)
+        notes = dict(db.execute('SELECT personKey, notes FROM Person'))
+        self.assertEqual('He said "it\'s" a\nnew line', notes[1])
+        self.assertIsNone(notes[2])
+        self.assertEqual('50% of \\ it', notes[3])
+        # Numbers go into integer columns as integers
+        self.assertEqual([(1, int)], [(k, type(k)) for k, in db.execute('SELECT personKey FROM Person LIMIT 1')])
+        # Zero dates are no date at all
+        self.assertIsNone(db.execute('SELECT creationDate FROM Person WHERE personKey = 2').fetchone()[0])
+        db.close()
+
+    def test_indexes(self):
+        db = sqlite3.connect(self.dbfile)
+        indexed = {(t, c) for t, c in db.execute(
+            "SELECT m.name, i.name FROM sqlite_master m, pragma_index_list(m.name) l, pragma_index_info(l.name) i "
+            "WHERE m.type = 'table'")}
+        db.close()
+        for key in [('Person', 'name'), ('FactoidPerson', 'personKey'), ('FactoidPerson', 'factoidKey'),
+                    ('FactoidPerson', 'fpTypeKey'), ('Factoid', 'sourceKey'), ('Factoid', 'factoidTypeKey')]:
+            self.assertIn(key, indexed)
+
+    def test_orm(self):
+        # The ORM works against the loaded database as it does against MySQL
+        alexios = self.session.query(pbw.Person).filter_by(name='Alexios', mdbCode=1).scalar()
+        self.assertEqual('<Alexios 1>', str(alexios))
+        self.assertEqual('Male', alexios.sex)
+        self.assertEqual('Ἀλέξιος', alexios.nameOL)
+        self.assertEqual(2, len(alexios.main_factoids()))
+        self.assertEqual(1, len(alexios.main_factoids('Death')))
+        self.assertEqual(['Anna wrote'], [f.engDesc for f in alexios.ref_factoids()])
+        self.assertEqual(2017, alexios.tstamp.year)
+        # Text comparisons are case insensitive, as they are in MySQL
+        self.assertEqual(alexios, self.session.query(pbw.Person).filter_by(name='alexios').scalar())
+
+    def test_typed_factoids(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', count)
+        alexios = self.session.query(pbw.Person).filter_by(name='Alexios', mdbCode=1).scalar()
+        self.session.expire(alexios, ['_person_factoids'])
+        statements.clear()
+        # Each of these is a single query
+        self.assertEqual([10], [f.factoidKey for f in alexios.main_factoids('Narrative')])
+        self.assertEqual([10, 11], [f.factoidKey for f in alexios.main_factoids()])
+        self.assertEqual([12], [f.factoidKey for f in alexios.ref_factoids()])
+        grouped = alexios.main_factoids_by_type()
+        self.assertEqual({'Narrative': [10], 'Death': [11]},
+                         {k: [f.factoidKey for f in v] for k, v in grouped.items()})
+        self.assertEqual(4, len(statements))
+        # Once the links are loaded, the answers come from them and are the same
+        self.assertEqual(3, len(alexios._person_factoids))
+        self.assertEqual([10], [f.factoidKey for f in alexios.main_factoids('Narrative')])
+        self.assertEqual([12], [f.factoidKey for f in alexios.ref_factoids()])
+        self.assertEqual(grouped, alexios.main_factoids_by_type())
+
+    def test_cached_lookups(self):
+        session = sessionmaker(bind=self.engine)()
+        self.addCleanup(session.close)
+        # Only some of the lookup tables are in our little database
+        lookups = [pbw.FactoidPersonType, pbw.FactoidType, pbw.OrigLangAuth, pbw.SexAuth, pbw.Source]
+        self.assertEqual(9, pbw.cache_lookups(session, classes=lookups))
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', count)
+        links = session.query(pbw.FactoidPerson).order_by(pbw.FactoidPerson.fpKey).all()
+        self.assertEqual(1, len(statements))
+        self.assertEqual(['Primary', 'DescRef', 'Primary', 'Primary', 'DescRef'], [fp.fpType for fp in links])
+        self.assertEqual(['Anna Komnene', 'Anna Komnene', 'Zonaras', 'Anna Komnene', 'Anna Komnene'],
+                         [fp.factoid.source for fp in links])
+        self.assertEqual({'Narrative', 'Death'}, {fp.factoid.factoidType for fp in links})
+        self.assertEqual({'Greek'}, {fp.factoid.origLang for fp in links})
+        self.assertEqual({'Male', 'Female'}, {fp.person.sex for fp in links})
+        self.assertEqual(1, len(statements))
+
+    def test_referents(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', count)
+        self.session.expire_all()
+        factoids = self.session.query(pbw.Factoid).order_by(pbw.Factoid.factoidKey).all()
+        statements.clear()
+        # The people for the whole batch come in one query, and after that we need no more
+        pbw.prefetch_referents(self.session, factoids)
+        self.assertEqual(1, len(statements))
+        self.assertEqual('<Alexios 1> married <Eirene 61>', factoids[0].replace_referents())
+        self.assertEqual(['<Eirene 61>'], [str(p) for p in factoids[0].referents()])
+        self.assertEqual('Alexios died', factoids[1].replace_referents())
+        self.assertEqual([], factoids[2].referents())
+        self.assertEqual(['<Alexios 1>'], [str(p) for p in factoids[2].referents(check_persref=False)])
+        self.assertEqual(1, len(statements))
+        # A changed description is parsed again
+        factoids[1].engDesc = 'Death of <PERSREF ID="3"/>'
+        self.assertEqual('Death of <Alexios 1>', factoids[1].replace_referents())
+        self.session.rollback()
+
+
+@unittest.skipUnless(find_spec('pyarrow'), "the columnar export needs pyarrow")
+class TestColumnarExport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = TemporaryDirectory()
+        dump = os.path.join(cls.tmpdir.name, 'pbw.sql')
+        with open(dump, 'w', encoding='utf-8') as f:
+            f.write(DUMP)
+        dbfile = os.path.join(cls.tmpdir.name, 'pbw.sqlite')
+        pbw_sqlite.load_dump(dump, dbfile)
+        cls.engine = create_engine('sqlite:///' + dbfile)
+        cls.outdir = os.path.join(cls.tmpdir.name, 'columnar')
+        # Write in small batches, so that the files have more than one row group
+        cls.counts = pbw_columnar.export_columnar(cls.engine, cls.outdir, batch_rows=2)
+        cls.reader = pbw_columnar.ColumnarReader(cls.outdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+        cls.tmpdir.cleanup()
+
+    def test_tables(self):
+        # Only the tables that are in the database get exported, along with the views
+        self.assertEqual(['Factoid', 'FactoidPerson', 'FactoidPersonType', 'FactoidType', 'OrigLangAuth', 'Person',
+                          'SexAuth', 'Source',
+                          'factoid_type', 'person_factoid'], self.reader.tables)
+        self.assertEqual(3, self.counts['Person'])
+        self.assertEqual(5, self.counts['person_factoid'])
+        # The columns are typed according to the mappings
+        schema = self.reader.schema('Person')
+        self.assertEqual('int64', str(schema.field('personKey').type))
+        self.assertEqual('int16', str(schema.field('firstDate').type))
+        self.assertEqual('timestamp[us]', str(schema.field('tstamp').type))
+        self.assertEqual('string', str(schema.field('name').type))
+        # This one is a string in the mapping, though not in the database
+        self.assertEqual('string', str(self.reader.schema('Factoid').field('boulloterionKey').type))
+
+    def test_views(self):
+        import pyarrow.compute as pc
+        pf = self.reader.read('person_factoid', filters=[('name', '=', 'Alexios')])
+        self.assertEqual(3, pf.num_rows)
+        primary = pf.filter(pc.equal(pf['fpType'], 'Primary'))
+        self.assertEqual(['Narrative', 'Death'], primary['factoidType'].to_pylist())
+        self.assertEqual(['Anna Komnene', 'Zonaras', 'Anna Komnene'], pf['source'].to_pylist())
+        ft = self.reader.read('factoid_type', columns=['factoidKey', 'factoidType'])
+        self.assertEqual({'Narrative': 2, 'Death': 1},
+                         {x['values']: x['counts'] for x in pc.value_counts(ft['factoidType']).to_pylist()})
+        self.assertEqual(['Alexios', 'Anna', 'Eirene'], self.reader.column('Person', 'name').to_pylist())
+
+
+if __name__ == '__main__':
+    unittest.main()
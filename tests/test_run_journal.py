@@ -0,0 +1,87 @@
+# coding=utf-8
+import os
+import tempfile
+import unittest
+from rdflib import URIRef
+from RELEVEN.run_journal import RunJournal
+
+
+# The journal is a plain file, so these tests need nothing but a temporary directory.
+class RunJournalTests(unittest.TestCase):
+    tmpdir = None
+    path = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'run.journal')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_replay(self):
+        swrun = URIRef('https://r11.eu/rdf/resource/run1')
+        journal = RunJournal(self.path)
+        journal.start(swrun, ledger=True)
+        authorities = journal.cache('authorities')
+        authorities['Anna Komnene'] = URIRef('https://r11.eu/rdf/resource/anna')
+        ledger = journal.ledger()
+        ledger.update([URIRef('https://r11.eu/rdf/resource/a1')])
+        journal.person_done(101)
+        journal.close()
+        # A restarted run picks up where this one left off
+        resumed = RunJournal(self.path)
+        self.assertEqual(str(swrun), resumed.swrun)
+        self.assertSetEqual({101}, resumed.completed)
+        self.assertDictEqual({'Anna Komnene': URIRef('https://r11.eu/rdf/resource/anna')},
+                             resumed.cache('authorities'))
+        self.assertSetEqual({URIRef('https://r11.eu/rdf/resource/a1')}, resumed.ledger())
+        # Starting it with the same run is fine, and records nothing new
+        size = os.path.getsize(self.path)
+        resumed.start(swrun, ledger=False)
+        self.assertEqual(size, os.path.getsize(self.path))
+        resumed.close()
+
+    def test_torn_line(self):
+        journal = RunJournal(self.path)
+        journal.start('run1')
+        journal.person_done(101)
+        journal.close()
+        # A crash in the middle of writing leaves half a line at the end
+        with open(self.path, 'a', encoding='utf-8') as fh:
+            fh.write('{"person": 10')
+        resumed = RunJournal(self.path)
+        self.assertSetEqual({101}, resumed.completed)
+        # What comes next starts on a line of its own
+        resumed.person_done(102)
+        resumed.close()
+        self.assertSetEqual({101, 102}, RunJournal(self.path).completed)
+
+    def test_deferred(self):
+        journal = RunJournal(self.path)
+        journal.start('run1', deferred=True)
+        journal.cache('persons')['Alexios 5'] = URIRef('https://r11.eu/rdf/resource/alexios5')
+        journal.person_done(101)
+        # Nothing is on record until the commit, as if the run had crashed before its flush
+        early = RunJournal(self.path)
+        self.assertEqual('run1', early.swrun)
+        self.assertSetEqual(set(), early.completed)
+        self.assertDictEqual(dict(), early.cache('persons'))
+        early.close()
+        journal.commit()
+        journal.close()
+        resumed = RunJournal(self.path)
+        self.assertSetEqual({101}, resumed.completed)
+        self.assertIn('Alexios 5', resumed.cache('persons'))
+        resumed.close()
+
+    def test_wrong_run(self):
+        journal = RunJournal(self.path)
+        journal.start('run1')
+        journal.close()
+        resumed = RunJournal(self.path)
+        self.assertRaises(ValueError, resumed.start, 'run2')
+        resumed.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# coding=utf-8
+import gzip
+import json
+import unittest
+from unittest import mock
+import requests
+from rdflib import Graph, URIRef
+from RELEVEN import sparql_transport
+
+
+def _response(status, body=b'', content_type='application/sparql-results+json'):
+    """Make a response like the ones the store would send"""
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.headers['Content-Type'] = content_type
+    response.url = 'http://store.example/repositories/test'
+    return response
+
+
+_graph = URIRef('https://r11.eu/rdf/resource/')
+_results = json.dumps({'head': {'vars': ['s']},
+                       'results': {'bindings': [{'s': {'type': 'uri', 'value': 'https://r11.eu/rdf/resource/a'}}]}
+                       }).encode('utf-8')
+
+
+# These tests put a mock in place of the HTTP session, so they need no triple store.
+class PooledStoreTests(unittest.TestCase):
+    store = None
+    session = None
+    waits = None
+
+    def setUp(self):
+        with mock.patch.object(sparql_transport.requests, 'Session') as session:
+            self.store = sparql_transport.PooledSPARQLUpdateStore(
+                'http://store.example/repositories/test', 'http://store.example/repositories/test/statements',
+                method='POST', returnFormat='json', retries=3, backoff=0.5)
+        self.session = session.return_value
+        self.assertIs(self.session, self.store.session)
+        # Record the backoff instead of waiting for it
+        self.waits = []
+        patcher = mock.patch.object(sparql_transport, 'sleep', self.waits.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def query(self):
+        return list(Graph(self.store, identifier=_graph).query("SELECT ?s WHERE { ?s ?p ?o }"))
+
+    def test_query(self):
+        self.session.post.return_value = _response(200, _results)
+        self.assertListEqual([URIRef('https://r11.eu/rdf/resource/a')], [row['s'] for row in self.query()])
+        args = self.session.post.call_args
+        self.assertEqual('application/sparql-query', args.kwargs['headers']['Content-Type'])
+        self.assertTrue(args.kwargs['data'].endswith(b"SELECT ?s WHERE { ?s ?p ?o }"))
+        self.assertEqual(str(_graph), str(args.kwargs['params']['default-graph-uri']))
+        stats = self.store.stats['query']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual(0, stats.retries)
+        self.assertEqual(0, self.store.stats['update'].requests)
+
+    def test_retry_on_status(self):
+        self.session.post.side_effect = [_response(503), _response(502), _response(200, _results)]
+        self.assertEqual(1, len(self.query()))
+        self.assertEqual(3, self.session.post.call_count)
+        # The waits are random, but each is within a backoff that doubles
+        self.assertEqual(2, len(self.waits))
+        for attempt, wait in enumerate(self.waits):
+            self.assertLessEqual(0, wait)
+            self.assertLessEqual(wait, 0.5 * 2 ** attempt)
+        stats = self.store.stats['query']
+        self.assertEqual(1, stats.requests)
+        self.assertEqual(2, stats.retries)
+
+    def test_retry_on_connection_error(self):
+        self.session.post.side_effect = [requests.exceptions.ConnectionError("reset"), _response(200, _results)]
+        self.assertEqual(1, len(self.query()))
+        self.assertEqual(1, len(self.waits))
+        self.assertEqual(1, self.store.stats['query'].retries)
+
+    def test_give_up(self):
+        self.session.post.side_effect = requests.exceptions.ConnectionError("down")
+        self.assertRaises(requests.exceptions.ConnectionError, self.query)
+        # The first try and three retries
+        self.assertEqual(4, self.session.post.call_count)
+        self.assertEqual(3, self.store.stats['query'].retries)
+        self.assertEqual(0, self.store.stats['query'].requests)
+        # A server that stays unavailable is given up on as well
+        self.session.post.reset_mock()
+        self.session.post.side_effect = None
+        self.session.post.return_value = _response(503)
+        self.assertRaises(requests.exceptions.HTTPError, self.query)
+        self.assertEqual(4, self.session.post.call_count)
+
+    def test_no_retry_on_client_error(self):
+        self.session.post.return_value = _response(400, b'Bad query', 'text/plain')
+        self.assertRaises(requests.exceptions.HTTPError, self.query)
+        self.assertEqual(1, self.session.post.call_count)
+        self.assertListEqual([], self.waits)
+        self.assertEqual(1, self.store.stats['query'].requests)
+        self.assertEqual(0, self.store.stats['query'].retries)
+
+    def test_compressed_update(self):
+        self.store.compress = True
+        self.session.post.return_value = _response(204)
+        update = 'INSERT DATA { <https://r11.eu/rdf/resource/a> <https://r11.eu/rdf/resource/p> "Ἄννα" . }'
+        Graph(self.store, identifier=_graph).update(update)
+        args = self.session.post.call_args
+        self.assertEqual('http://store.example/repositories/test/statements', args.args[0])
+        self.assertEqual('gzip', args.kwargs['headers']['Content-Encoding'])
+        # The update goes into our graph, with the text intact
+        sent = gzip.decompress(args.kwargs['data']).decode('utf-8')
+        self.assertIn(f"GRAPH {_graph.n3()}", sent)
+        self.assertIn('"Ἄννα"', sent)
+        self.assertEqual(1, self.store.stats['update'].requests)
+        self.assertIn('1 requests, 0 retries', str(self.store.stats['update']))
+
+
+if __name__ == '__main__':
+    unittest.main()
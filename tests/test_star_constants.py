@@ -0,0 +1,403 @@
+# coding=utf-8
+import os
+import tempfile
+import unittest
+from importlib.util import find_spec
+from unittest import mock
+from rdflib import Graph, Literal, RDFS
+from RELEVEN import PBWstarConstants, local_store
+from RELEVEN.graph_sink import NTriplesSink
+from RELEVEN.update_buffer import UpdateBuffer
+
+
+class _FailingSink:
+    """A sink that keeps what it is given, and fails on the second write it is asked for"""
+
+    def __init__(self):
+        self.chunks = []
+        self.failed = False
+
+    def write(self, triples):
+        if len(self.chunks) == 1 and not self.failed:
+            self.failed = True
+            raise IOError("Write failed")
+        self.chunks.append(list(triples))
+
+    def value(self, subject, predicate):
+        return None
+
+
+# These tests run against a local in-memory graph, so they need neither the PBW database nor GraphDB.
+class StarConstantsTests(unittest.TestCase):
+    graph = None
+    constants = None
+
+    def setUp(self):
+        self.graph = Graph()
+        self.constants = PBWstarConstants.PBWstarConstants(graph=self.graph, deterministic=True)
+        # These are set up when first used; do it now, so that the tests only see what they write themselves
+        self.assertIsNotNone(self.constants.swrun)
+        self.assertIsNotNone(self.constants.pbw_agent)
+
+    def appellation_sparql(self, person, name):
+        c = self.constants
+        return f"""
+        ?a1 {c.star_subject} {c.ns[person].n3()} ;
+            {c.star_object} ?appel ;
+            a {c.get_assertion_for_predicate('P1')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        ?appel {c.get_label('P190')} {Literal(name).n3()} ;
+            a {c.get_label('E33A')} . """
+
+    def test_deterministic_minting(self):
+        c = self.constants
+        sparql = self.appellation_sparql('person1', 'Anna')
+        minted = c.mint_uris_for_query(sparql)
+        self.assertSetEqual({'a1', 'appel'}, set(minted.keys()))
+        self.assertDictEqual(minted, c.mint_uris_for_query(sparql))
+        # The layout of the pattern shouldn't matter, only its content
+        reordered = f"""?appel a {c.get_label('E33A')} ; {c.get_label('P190')} {Literal('Anna').n3()} .
+            ?a1 {c.star_auth} {c.pbw_agent.n3()} ; a {c.get_assertion_for_predicate('P1')} ;
+                {c.star_object} ?appel ; {c.star_subject} <{c.ns['person1']}>"""
+        self.assertDictEqual(minted, c.mint_uris_for_query(reordered))
+        # The same name for a different person is a different appellation
+        other = c.mint_uris_for_query(self.appellation_sparql('person2', 'Anna'))
+        self.assertNotEqual(minted['appel'], other['appel'])
+        self.assertNotEqual(minted['a1'], other['a1'])
+
+    def test_blind_insert(self):
+        c = self.constants
+        patterns = [self.appellation_sparql(f"person{i}", 'Anna') for i in range(5)]
+        first = [c.ensure_entities_existence(p) for p in patterns]
+        size = len(self.graph)
+        second = [c.ensure_entities_existence(p) for p in patterns]
+        self.assertListEqual(first, second)
+        self.assertEqual(size, len(self.graph), "Ensuring the patterns again should not change the graph")
+        # A run that doesn't mint deterministically should find what we made
+        self.constants.deterministic = False
+        self.assertListEqual(first, c.ensure_entities_existence_batch(patterns))
+        self.assertEqual(size, len(self.graph))
+
+    def test_update_buffer(self):
+        c = PBWstarConstants.PBWstarConstants(graph=self.graph, buffer_size=1000)
+        size = len(self.graph)
+        patterns = [self.appellation_sparql(f"person{i}", 'Anna') for i in range(5)]
+        first = c.ensure_entities_existence_batch(patterns)
+        self.assertEqual(size, len(self.graph), "Nothing should be written before the flush")
+        self.assertGreater(len(c.buffer), 0)
+        # The pending assertions are found through the overlay
+        self.assertListEqual(first, c.ensure_entities_existence_batch(patterns))
+        self.assertEqual(c.value(first[0]['appel'], c.predicates['P190']), Literal('Anna'))
+        c.flush()
+        self.assertEqual(0, len(c.buffer))
+        self.assertGreater(len(self.graph), size)
+        self.assertListEqual(first, c.ensure_entities_existence_batch(patterns))
+        self.assertEqual(0, len(c.buffer), "Flushed assertions should be found in the graph")
+        # A pattern that is partly written and partly still pending is found as well
+        pattern = self.appellation_sparql('person9', 'Irene')
+        scratch = Graph()
+        made = PBWstarConstants.PBWstarConstants(graph=scratch).ensure_entities_existence(pattern)
+        appel = [t for t in scratch if t[0] == made['appel']]
+        for t in scratch:
+            if t not in appel:
+                self.graph.add(t)
+        c.buffer.addN(appel)
+        size = len(self.graph)
+        self.assertDictEqual(made, c.ensure_entities_existence_batch([pattern])[0])
+        self.assertEqual(len(appel), len(c.buffer), "Nothing new should be buffered")
+        c.flush()
+        self.assertEqual(size + len(appel), len(self.graph))
+
+    def test_update_buffer_flush(self):
+        ns = self.constants.ns
+        p = self.constants.predicates['P190']
+        buffer = UpdateBuffer(self.graph, max_triples=None)
+        # A query finds a match made of triples both written and pending
+        self.graph.add((ns['x1'], p, ns['x2']))
+        buffer.add((ns['x2'], p, Literal('Anna')))
+        res = buffer.query(f"SELECT ?s WHERE {{ ?s {p.n3()} ?o . ?o {p.n3()} 'Anna' . }}")
+        self.assertListEqual([ns['x1']], [row['s'] for row in res])
+        # A group of triples is never split across chunks, and a failed flush leaves everything pending
+        sink = _FailingSink()
+        buffer = UpdateBuffer(self.graph, max_triples=None, sink=sink)
+        for name in ('u', 't'):
+            buffer.addN([(ns[f'{name}{i}'], p, Literal(i)) for i in range(2)])
+        buffer.max_triples = 3
+        self.assertRaises(IOError, buffer.flush)
+        self.assertEqual(4, len(buffer))
+        self.assertListEqual([2], [len(chunk) for chunk in sink.chunks])
+        buffer.flush()
+        self.assertEqual(0, len(buffer))
+        self.assertListEqual([2, 2, 2], [len(chunk) for chunk in sink.chunks], "The first chunk is sent again")
+
+    def test_assertion_index(self):
+        c = PBWstarConstants.PBWstarConstants(graph=self.graph, index=True)
+        person = c.ns['person1']
+        simple = f"""
+        ?a1 {c.star_subject} {person.n3()} ;
+            {c.star_object} {c.get_gender('Female').n3()} ;
+            a {c.get_assertion_for_predicate('P41')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        {c.ns['source1'].n3()} {c.star_src} ?a1 ."""
+        # A pattern the index can't express goes to the graph
+        described = f"""
+        ?a1 {c.star_subject} {person.n3()} ;
+            {c.star_object} ?desc ;
+            a {c.get_assertion_for_predicate('P3')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        ?desc {c.get_label('P3')} {Literal('A monk').n3()} ."""
+        self.assertIsNone(c.index.lookup(PBWstarConstants._pattern_terms(described, self.graph.namespace_manager)))
+        created = c.ensure_entities_existence(simple)
+        self.assertEqual(1, c.index.misses)
+        self.assertDictEqual(created, c.ensure_entities_existence(simple))
+        self.assertEqual(1, c.index.hits)
+        # A new index loaded from the graph knows about the assertion
+        fresh = PBWstarConstants.PBWstarConstants(graph=self.graph, index=True)
+        self.assertDictEqual(created, fresh.ensure_entities_existence(simple))
+        self.assertEqual(1, fresh.index.hits)
+
+    def test_assertion_index_entities(self):
+        c = PBWstarConstants.PBWstarConstants(graph=self.graph, index=True)
+        person = c.ns['person1']
+        # The patterns as the importer's gender and identifier handlers make them, where the assertions'
+        # subject or object is an entity the pattern only describes
+
+        def gender_sparql(sex):
+            return f"""
+        ?a1 {c.star_object} {person.n3()} ;
+            {c.star_subject} ?gass ;
+            a {c.get_assertion_for_predicate('P41')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .
+        ?a2 {c.star_object} {c.get_gender(sex).n3()} ;
+            {c.star_subject} ?gass ;
+            a {c.get_assertion_for_predicate('P42')} ;
+            {c.star_auth} {c.pbw_agent.n3()} ."""
+        gender = gender_sparql('Female')
+        identifier = self.appellation_sparql('person1', 'Anna')
+        created = c.ensure_entities_existence_batch([gender, identifier])
+        self.assertEqual(2, c.index.misses)
+        self.assertListEqual(created, c.ensure_entities_existence_batch([gender, identifier]))
+        self.assertEqual(2, c.index.hits)
+        # Another name is another appellation, and another gender another assignment
+        other = c.ensure_entities_existence_batch([gender_sparql('Male'),
+                                                   self.appellation_sparql('person1', 'Irene')])
+        self.assertEqual(4, c.index.misses)
+        self.assertNotEqual(created[0]['gass'], other[0]['gass'])
+        self.assertNotEqual(created[1]['appel'], other[1]['appel'])
+        # A new index loaded from the graph knows about them
+        fresh = PBWstarConstants.PBWstarConstants(graph=self.graph, index=True)
+        self.assertListEqual(created, fresh.ensure_entities_existence_batch([gender, identifier]))
+        self.assertEqual(2, fresh.index.hits)
+
+    def test_egroups(self):
+        c = self.constants
+        members = [c.ns['member1'], c.ns['member2']]
+        for m, name in zip(members, ('Alice', 'Bob')):
+            self.graph.add((m, RDFS.label, Literal(name)))
+        group = c.ensure_egroup_existence('E74A', 'P107', members)
+        self.assertEqual(Literal('Alice; Bob'), self.graph.value(group, RDFS.label))
+        # A hit in the cache adds nothing
+        size = len(self.graph)
+        self.assertEqual(group, c.ensure_egroup_existence('E74A', 'P107', members))
+        self.assertEqual(size, len(self.graph))
+        # The same members under another title are another group
+        titled = c.ensure_egroup_existence('E74A', 'P107', members, title='The siblings')
+        self.assertNotEqual(group, titled)
+        # A group read from the graph with two labels is found by either of them
+        self.graph.add((titled, RDFS.label, Literal('The twins')))
+        fresh = PBWstarConstants.PBWstarConstants(graph=self.graph)
+        for title in ('The siblings', 'The twins'):
+            self.assertEqual(titled, fresh.ensure_egroup_existence('E74A', 'P107', members, title=title))
+        self.assertEqual(group, fresh.ensure_egroup_existence('E74A', 'P107', members))
+
+    def test_document(self):
+        c = self.constants
+        pages = [c.ns[f"page{i}"] for i in range(3)]
+        assertions = [[c.ns[f"assertion{i}{j}"] for j in range(2)] for i in range(3)]
+        size = len(self.graph)
+        with c.collect_documentation():
+            for page, asserted in zip(pages, assertions):
+                c.document(page, *asserted)
+            self.assertEqual(size, len(self.graph), "Documentation should wait for the end of the block")
+        # One type for each page, and a P70 link and a run marker for each assertion
+        self.assertEqual(size + 3 + 12, len(self.graph))
+        self.assertIn((pages[0], c.predicates['P70'], assertions[0][1]), self.graph)
+        # Documenting them all at once gives the same result
+        other = Graph()
+        oc = PBWstarConstants.PBWstarConstants(graph=other, deterministic=True)
+        self.assertIsNotNone(oc.swrun)
+        other_size = len(other)
+        documented = oc.document_many(list(zip(pages, assertions)))
+        self.assertListEqual([a for asserted in assertions for a in asserted], documented)
+        self.assertEqual(other_size + 3 + 12, len(other))
+        self.assertSetEqual(set(self.graph.triples((None, c.predicates['P70'], None))),
+                            set(other.triples((None, oc.predicates['P70'], None))))
+        # A block that fails documents nothing, and its own error is what we see
+        size = len(self.graph)
+        with self.assertRaises(KeyError):
+            with c.collect_documentation():
+                c.document(c.ns['page9'], c.ns['assertion9'])
+                raise KeyError('page9')
+        self.assertEqual(size, len(self.graph))
+        self.assertIsNone(c.documentation)
+
+    def test_record_script_run(self):
+        c = self.constants
+        assertions = [c.ns[f"assertion{i}"] for i in range(5)]
+        # One of them was already recorded by an earlier run
+        earlier = c.ns['earlier_run']
+        self.graph.add((earlier, c.predicates['L11'], assertions[0]))
+        c.document(c.ns['page1'], *assertions)
+        self.assertSetEqual(set(assertions), c.ledger)
+        c.record_script_run(c.pbw_agent)
+        recorded = set(self.graph.objects(c.swrun, c.predicates['L11']))
+        self.assertSetEqual(set(assertions[1:]), recorded)
+        # A resumed run without the ledger finds the same outputs in the graph
+        resumed = PBWstarConstants.PBWstarConstants(graph=self.graph, execution=str(c.swrun))
+        self.assertIsNone(resumed.ledger)
+        self.graph.remove((c.swrun, c.predicates['L11'], None))
+        resumed.record_script_run(c.pbw_agent)
+        self.assertSetEqual(recorded, set(self.graph.objects(c.swrun, c.predicates['L11'])))
+        # A new run keeps its ledger from the start, whether or not its execution has been asked for yet
+        fresh = PBWstarConstants.PBWstarConstants(graph=Graph())
+        fresh.note_outputs(assertions[0])
+        self.assertSetEqual({assertions[0]}, fresh.ledger)
+
+    def test_cv_warm_start(self):
+        c = self.constants
+        genders = {g: c.get_gender(g) for g in ('Female', 'Male')}
+        role, _ = c.get_societyrole('Monk')
+        dignity, _ = c.get_dignity('Protospatharios of the Chrysotriklinos')
+        fresh = PBWstarConstants.PBWstarConstants(graph=self.graph)
+        # The vocabularies are read in when they are first used
+        self.assertEqual(0, len(fresh.cv_loaded))
+        self.assertEqual(genders['Male'], fresh.get_gender('Male'))
+        self.assertDictEqual(genders, fresh.cv['Gender'])
+        fresh.load_cv('SocietyRole')
+        fresh.load_cv('Dignity')
+        self.assertEqual(role, fresh.cv['SocietyRole']['Monk'])
+        # Vocabularies that share a class share their entries, as a lookup would
+        self.assertEqual(role, fresh.cv['Dignity']['Monk'])
+        self.assertNotIn('Protospatharios of the Chrysotriklinos', fresh.cv['SocietyRole'])
+        # Looking them up again writes nothing
+        size = len(self.graph)
+        self.assertEqual(dignity, fresh.get_dignity('Protospatharios of the Chrysotriklinos')[0])
+        self.assertEqual(size, len(self.graph))
+        self.assertEqual(role, fresh.get_societyrole('Monk')[0])
+        # The vocabularies survive a round trip through the sidecar file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cv_file = os.path.join(tmpdir, 'cv.json')
+            fresh.cv_file = cv_file
+            fresh.save_cv()
+            saved = PBWstarConstants.PBWstarConstants(graph=Graph(), cv_file=cv_file)
+            saved.load_cv('Gender')
+            self.assertDictEqual(fresh.cv, saved.cv)
+
+    def test_prepared_probes(self):
+        c = self.constants
+        patterns = [self.appellation_sparql(f"person{i}", name) for i, name in enumerate(['Anna', 'Maria', 'Anna'])]
+        created = c.ensure_entities_existence_batch(patterns)
+        c.deterministic = False
+        c.prepared.clear()
+        self.assertListEqual(created, c.ensure_entities_existence_batch(patterns))
+        # Patterns that differ only in their person and name share a compiled query
+        self.assertEqual(1, len(c.prepared))
+        self.assertDictEqual(c._probe_patterns(self.graph, patterns, [0, 1, 2]),
+                             c._probe_prepared(self.graph, patterns, [0, 1, 2]))
+
+    def test_readonly(self):
+        # Set up a graph with what a writing run would create
+        self.constants.get_gender('Female')
+        size = len(self.graph)
+        c = PBWstarConstants.PBWstarConstants(graph=self.graph, readonly=True)
+        self.assertEqual(self.constants.pbw_agent, c.pbw_agent)
+        self.assertEqual(self.constants.get_gender('Female'), c.get_gender('Female'))
+        self.assertIsNone(c.swrun)
+        self.assertRaises(Exception, c.add, (c.pbw_agent, c.entity_label, Literal('PBW')))
+        self.assertEqual(size, len(self.graph), "Nothing should be written in readonly mode")
+        # Against an empty graph, the agents are simply not there
+        empty = Graph()
+        self.assertIsNone(PBWstarConstants.PBWstarConstants(graph=empty, readonly=True).pbw_agent)
+        self.assertEqual(0, len(empty))
+        # A resumed run keeps its execution, whatever letters its ID starts with
+        resumed = PBWstarConstants.PBWstarConstants(graph=self.graph, readonly=True, execution='data:a1b2')
+        self.assertEqual(resumed.ns['a1b2'], resumed.swrun)
+
+    def test_many_variables(self):
+        c = self.constants
+        # Variable names that are prefixes of each other, as in the boulloterion patterns
+        seals = ''.join(f"""
+        ?seal{i} a {c.get_label('E22S')} ;
+            {c.label_n3} {Literal(f'Seal {i}').n3()} .
+        ?a{i}c {c.star_subject} ?boulloterion ;
+            {c.star_object} ?seal{i} ;
+            a {c.get_assertion_for_predicate('L1')} ;
+            {c.star_auth} {c.pbw_agent.n3()} .""" for i in range(12))
+        pattern = f"?boulloterion a {c.get_label('E22B')} ." + seals
+        res = c.ensure_entities_existence(pattern)
+        self.assertEqual(25, len(set(res.values())))
+        for i in (1, 10, 11):
+            self.assertEqual(Literal(f'Seal {i}'), self.graph.value(res[f"seal{i}"], c.entity_label))
+            self.assertEqual(res[f"seal{i}"], self.graph.value(res[f"a{i}c"], c.predicates['P141']))
+
+    @unittest.skipUnless(find_spec('oxrdflib'), "needs the oxrdflib package")
+    def test_graph_sink(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'out.nt')
+            sink = NTriplesSink(path)
+            c = PBWstarConstants.PBWstarConstants(graph=sink.graph, deterministic=True, sink=sink)
+            patterns = [self.appellation_sparql(f"person{i}", 'Anna') for i in range(3)]
+            first = c.ensure_entities_existence_batch(patterns)
+            c.flush()
+            self.assertGreater(sink.written, 0)
+            # What was streamed out can still be queried, from the store rather than from memory
+            self.assertEqual('Anna', str(c.value(first[0]['appel'], c.predicates['P190'])))
+            c.deterministic = False
+            self.assertListEqual(first, c.ensure_entities_existence_batch(patterns))
+            self.assertEqual(0, len(c.buffer))
+            written = len(sink.graph)
+            sink.close()
+            # A new sink on the same file keeps the store, and doesn't read the file again
+            with mock.patch.object(NTriplesSink, 'replay') as replay:
+                sink = NTriplesSink(path)
+                replay.assert_not_called()
+            self.assertEqual(written, len(sink.graph))
+            sink.close()
+            # If the file has grown since, as it would if we stopped between the file and the store, only
+            # what is new is read
+            extra = (c.ns['person1'], c.predicates['P190'], Literal('Eirene'))
+            with open(path, 'a', encoding='utf-8') as fh:
+                fh.write(' '.join(x.n3() for x in extra) + ' .\n')
+            sink = NTriplesSink(path)
+            self.assertEqual(written + 1, len(sink.graph))
+            self.assertIn(extra, sink.graph)
+            sink.close()
+            # A store that has seen more than the file holds was made from another file, and is made again
+            os.truncate(path, 0)
+            sink = NTriplesSink(path)
+            self.assertEqual(0, len(sink.graph))
+            sink.close()
+
+    @unittest.skipUnless(find_spec('oxrdflib'), "needs the oxrdflib package")
+    def test_local_store(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            uri = f"oxigraph:{tmpdir}"
+            self.assertTrue(local_store.is_local_store(uri))
+            g = local_store.open_local_store(uri)
+            c = PBWstarConstants.PBWstarConstants(graph=g)
+            patterns = [self.appellation_sparql(f"person{i}", 'Anna') for i in range(5)]
+            created = c.ensure_entities_existence_batch(patterns)
+            c.document(c.ns['page1'], *[x['a1'] for x in created])
+            size = len(g)
+            g.close()
+            # What we wrote is there when we open the store again
+            g = local_store.open_local_store(uri)
+            self.assertEqual(size, len(g))
+            c = PBWstarConstants.PBWstarConstants(graph=g, readonly=True)
+            self.assertListEqual(created, c.ensure_entities_existence_batch(patterns))
+            self.assertListEqual([5], list(c.assertion_counts().values()))
+            g.close()
+
+
+if __name__ == '__main__':
+    unittest.main()